@@ -0,0 +1,126 @@
+"""Benchmark configure_synapse's config generation at synthetic scale.
+
+For each service count, generate_configuration and serialization are timed
+in a fresh subprocess, so that the peak RSS reported is attributable to that
+count alone.  Results are compared against baselines.json, and the benchmark
+fails if any of them have regressed by more than the allowed tolerance.
+
+Usage:
+    python -m benchmarks.config_generation [--counts N ...] [--update-baselines]
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import argparse
+
+from benchmarks.synthetic import fake_host_location
+from benchmarks.synthetic import generate_services
+from benchmarks.synthetic import generate_zookeeper_topology
+from synapse_tools.configure_synapse import generate_configuration
+from synapse_tools.configure_synapse import serialize_synapse_config
+
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), 'baselines.json')
+
+DEFAULT_COUNTS = [100, 1000, 10000, 50000]
+
+# A result fails if it exceeds baseline * ratio + slack.  Wall time is noisy,
+# so it gets more room than memory and output size, which are close to
+# deterministic.
+TOLERANCES = {
+    'wall_time_s': (1.5, 0.05),
+    'peak_rss_kb': (1.2, 1024),
+    'output_bytes': (1.01, 0),
+}
+
+
+def measure(count):
+    services = generate_services(count)
+    zookeeper_topology = generate_zookeeper_topology()
+
+    with fake_host_location():
+        start = time.time()
+        synapse_config = generate_configuration(
+            {'bind_addr': '0.0.0.0'}, zookeeper_topology, services)
+        serialized = serialize_synapse_config(synapse_config)
+        wall_time_s = time.time() - start
+
+    return {
+        'wall_time_s': wall_time_s,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'output_bytes': len(serialized),
+    }
+
+
+def measure_in_subprocess(count):
+    output = subprocess.check_output(
+        [sys.executable, '-m', 'benchmarks.config_generation',
+         '--measure', str(count)],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    return json.loads(output)
+
+
+def find_regressions(results, baselines):
+    regressions = []
+    for (count, result) in sorted(results.iteritems(), key=lambda r: int(r[0])):
+        baseline = baselines.get(count)
+        if baseline is None:
+            continue
+        for (metric, (ratio, slack)) in sorted(TOLERANCES.iteritems()):
+            limit = baseline[metric] * ratio + slack
+            if result[metric] > limit:
+                regressions.append(
+                    '%s services: %s of %s exceeds limit of %s' % (
+                        count, metric, result[metric], limit))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--counts', type=int, nargs='+', default=DEFAULT_COUNTS,
+        help='Service counts to benchmark (default: %(default)s).')
+    parser.add_argument(
+        '--update-baselines', action='store_true',
+        help='Record these results as the new baselines instead of '
+             'comparing against the existing ones.')
+    parser.add_argument('--measure', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.measure is not None:
+        print(json.dumps(measure(args.measure)))
+        return 0
+
+    results = {}
+    for count in args.counts:
+        result = measure_in_subprocess(count)
+        results[str(count)] = result
+        print('%6d services: %.3fs, %dKB peak RSS, %d bytes' % (
+            count, result['wall_time_s'], result['peak_rss_kb'],
+            result['output_bytes']))
+
+    if args.update_baselines:
+        with open(BASELINES_PATH, 'w') as fp:
+            json.dump(results, fp, sort_keys=True, indent=4, separators=(',', ': '))
+            fp.write('\n')
+        return 0
+
+    with open(BASELINES_PATH) as fp:
+        baselines = json.load(fp)
+    regressions = find_regressions(results, baselines)
+    for regression in regressions:
+        print('REGRESSION: %s' % regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,200 @@
+"""Benchmark how long HAProxy takes to parse and reload generated configs.
+
+For each service count, a synapse config is generated from synthetic
+services by the real generate_configuration, rendered into an haproxy.cfg
+the way synapse renders it, and then run through the HAProxy binary:
+
+* parse: `haproxy -c`
+* start: starting a daemonized HAProxy, which returns once it has bound
+  every listener
+* reload: starting a second one with -sf, as the reload command does
+
+Listeners are bound to loopback, and everything else is written to a
+temporary directory.  The reload time is how long synapse_qdisc_tool protect
+holds SYNs in the plug, so the first count whose reload exceeds the latency
+budget is reported.  If the HAProxy binary is absent, the benchmark is
+skipped.
+
+Usage:
+    python -m benchmarks.haproxy_reload [--counts N ...] [--haproxy PATH]
+        [--budget-ms MS]
+"""
+
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import argparse
+
+from benchmarks.synthetic import fake_host_location
+from benchmarks.synthetic import FIRST_PROXY_PORT
+from benchmarks.synthetic import generate_services
+from benchmarks.synthetic import generate_zookeeper_topology
+from synapse_tools.configure_synapse import generate_configuration
+from synapse_tools.configure_synapse import HAPROXY_PATH
+
+
+DEFAULT_COUNTS = [100, 1000, 5000, 10000]
+
+DEFAULT_BUDGET_MS = 100
+
+# Backend servers rendered per service.  They never receive traffic, and with
+# the default 10m check interval are not checked during the benchmark either.
+SERVERS_PER_SERVICE = 3
+
+BIND_ADDRESS = '127.0.0.1'
+
+
+def render_haproxy_cfg(synapse_config, socket_path,
+                       servers_per_service=SERVERS_PER_SERVICE):
+    """Render synapse_config into an haproxy.cfg in the same way that
+    synapse does.  The stats socket is moved to socket_path, and the stats
+    listener is left out so as not to clash with a running haproxy."""
+    haproxy = synapse_config['haproxy']
+    lines = ['global']
+    for line in haproxy['global']:
+        if line.startswith('stats socket '):
+            line = 'stats socket %s level admin' % socket_path
+        lines.append('\t%s' % line)
+
+    lines.append('\ndefaults')
+    lines.extend('\t%s' % line for line in haproxy['defaults'])
+
+    for (name, entry) in sorted(synapse_config['services'].iteritems()):
+        service_haproxy = entry['haproxy']
+        lines.append('\nfrontend %s' % name)
+        lines.extend('\t%s' % line for line in service_haproxy['frontend'])
+        lines.extend('\t%s' % line for line in service_haproxy['listen'])
+        lines.append('\tbind %s:%s' % (haproxy['bind_address'], service_haproxy['port']))
+        lines.append('\tdefault_backend %s' % name)
+
+        lines.append('\nbackend %s' % name)
+        lines.extend('\t%s' % line for line in service_haproxy['backend'])
+        lines.extend('\t%s' % line for line in service_haproxy['listen'])
+        for i in range(servers_per_service):
+            lines.append('\tserver 10.1.0.%d:31000_%s 10.1.0.%d:31000 %s' % (
+                i + 1, name, i + 1, service_haproxy['server_options']))
+
+    return '\n'.join(lines) + '\n'
+
+
+def _timed_call(command):
+    start = time.time()
+    returncode = subprocess.call(command)
+    return (returncode, time.time() - start)
+
+
+def _read_pids(pid_path):
+    try:
+        with open(pid_path) as fp:
+            return [int(line) for line in fp.read().split()]
+    except IOError:
+        return []
+
+
+def _kill_all(pids):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def measure(haproxy_path, count):
+    services = generate_services(count)
+    with fake_host_location():
+        synapse_config = generate_configuration(
+            {'bind_addr': BIND_ADDRESS}, generate_zookeeper_topology(), services)
+
+    directory = tempfile.mkdtemp(prefix='haproxy_reload_benchmark')
+    config_path = os.path.join(directory, 'haproxy.cfg')
+    pid_path = os.path.join(directory, 'haproxy.pid')
+    with open(config_path, 'w') as fp:
+        fp.write(render_haproxy_cfg(
+            synapse_config, os.path.join(directory, 'haproxy.sock')))
+
+    started_pids = []
+    try:
+        (returncode, parse_s) = _timed_call(
+            [haproxy_path, '-c', '-q', '-f', config_path])
+        if returncode != 0:
+            raise RuntimeError('%s failed to parse %s' % (haproxy_path, config_path))
+
+        start_command = [haproxy_path, '-D', '-f', config_path, '-p', pid_path]
+        (returncode, start_s) = _timed_call(start_command)
+        started_pids.extend(_read_pids(pid_path))
+        if returncode != 0:
+            raise RuntimeError('%s failed to start' % haproxy_path)
+
+        (returncode, reload_s) = _timed_call(
+            start_command + ['-sf'] + [str(pid) for pid in started_pids])
+        started_pids.extend(_read_pids(pid_path))
+        if returncode != 0:
+            raise RuntimeError('%s failed to reload' % haproxy_path)
+
+        return {
+            'parse_s': parse_s,
+            'start_s': start_s,
+            'reload_s': reload_s,
+            'config_bytes': os.path.getsize(config_path),
+        }
+    finally:
+        _kill_all(started_pids)
+        shutil.rmtree(directory)
+
+
+def first_count_over_budget(results, budget_ms):
+    for (count, result) in sorted(results.iteritems()):
+        if result['reload_s'] * 1000 > budget_ms:
+            return count
+    return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--counts', type=int, nargs='+', default=DEFAULT_COUNTS,
+        help='Service counts to benchmark (default: %(default)s).')
+    parser.add_argument(
+        '--haproxy', default=HAPROXY_PATH,
+        help='HAProxy binary to benchmark (default: %(default)s).')
+    parser.add_argument(
+        '--budget-ms', type=float, default=DEFAULT_BUDGET_MS,
+        help='Reload latency budget (default: %(default)s).')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if not os.access(args.haproxy, os.X_OK):
+        print('Skipping: %s is not an executable' % args.haproxy)
+        return 0
+
+    max_count = 65535 - FIRST_PROXY_PORT
+    if max(args.counts) > max_count:
+        print('Service counts must be at most %d' % max_count)
+        return 1
+
+    results = {}
+    for count in args.counts:
+        result = measure(args.haproxy, count)
+        results[count] = result
+        print('%6d services: parse %.3fs, start %.3fs, reload %.3fs, %d bytes' % (
+            count, result['parse_s'], result['start_s'], result['reload_s'],
+            result['config_bytes']))
+
+    over_budget = first_count_over_budget(results, args.budget_ms)
+    if over_budget is None:
+        print('Every reload was within the %dms budget' % args.budget_ms)
+    else:
+        print('Reloads exceed the %dms budget from %d services' % (
+            args.budget_ms, over_budget))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""Synthetic smartstack namespaces for benchmarking config generation."""
+
+import contextlib
+import random
+
+import mock
+
+from synapse_tools import configure_synapse
+
+
+FIRST_PROXY_PORT = 20000
+
+DISCOVER_TYPES = ('region', 'habitat', 'superregion')
+
+CHAOS_OPTIONS = (
+    {'fail': 'drop'},
+    {'fail': 'error_503'},
+    {'delay': '300ms'},
+)
+
+GROUPINGS = {
+    'ecosystem': 'prod',
+    'habitat': 'uswest1aprod',
+    'region': 'uswest1-prod',
+    'superregion': 'norcal-prod',
+}
+
+
+def generate_services(count, seed=0):
+    """Return count (service.namespace, namespace_config) tuples, varying the
+    options which affect the shape of the generated stanza."""
+    rng = random.Random(seed)
+    services = []
+    for i in range(count):
+        config = {
+            'proxy_port': FIRST_PROXY_PORT + i,
+            'discover': rng.choice(DISCOVER_TYPES),
+            'mode': 'tcp' if rng.random() < 0.1 else 'http',
+        }
+        if rng.random() < 0.5:
+            config['timeout_server_ms'] = rng.choice((1000, 3000, 10000))
+        if rng.random() < 0.2:
+            config['timeout_connect_ms'] = rng.choice((200, 500))
+        if rng.random() < 0.2:
+            config['retries'] = rng.choice((1, 2))
+        if rng.random() < 0.3:
+            config['healthcheck_uri'] = '/healthcheck_%d' % i
+        if rng.random() < 0.1:
+            config['extra_headers'] = {'X-Mode': rng.choice(('ro', 'rw'))}
+        if rng.random() < 0.1:
+            config['extra_healthcheck_headers'] = {'X-Mode': 'ro'}
+        if rng.random() < 0.05:
+            config['chaos'] = {'ecosystem': {'prod': rng.choice(CHAOS_OPTIONS)}}
+        services.append(('service_%d.main' % i, config))
+    return services
+
+
+def generate_zookeeper_topology(count=5):
+    return ['10.0.0.%d:2181' % (i + 1) for i in range(count)]
+
+
+@contextlib.contextmanager
+def fake_host_location():
+    """Answer location and grouping lookups without reading /nail/etc."""
+    with contextlib.nested(
+            mock.patch.object(configure_synapse, 'get_current_location',
+                              side_effect=GROUPINGS.get),
+            mock.patch.object(configure_synapse, 'get_my_grouping',
+                              side_effect=GROUPINGS.get)):
+        yield
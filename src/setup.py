@@ -21,6 +21,7 @@ setup(
         'plumbum>=1.6.0,<1.7.0',
         'psutil>=2.1.1,<2.2.0',
         'PyYAML>=3.11,<4.0.0',
+        'pyinotify>=0.9.4,<0.10.0',
         'pyroute2>=0.3.4,<0.4.0',
         'paasta-tools==0.14.1',
     ],
@@ -29,6 +30,7 @@ setup(
             'configure_synapse=synapse_tools.configure_synapse:main',
             'haproxy_synapse_reaper=synapse_tools.haproxy_synapse_reaper:main',
             'synapse_qdisc_tool=synapse_tools.haproxy.qdisc_tool:main',
+            'synapse_dump_server_state=synapse_tools.haproxy.server_state:main',
         ],
     },
 )
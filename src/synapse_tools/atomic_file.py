@@ -0,0 +1,81 @@
+"""Helpers for replacing files without readers ever seeing a partial write."""
+
+import hashlib
+import json
+import os
+import tempfile
+
+
+def write_temp_file(path, chunks):
+    """Write an iterable of chunks to a new temporary file next to path,
+    hashing them as they are written.  The file is not synced.
+
+    :returns: a tuple of (temporary file path, sha1 hexdigest of contents)
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    content_hash = hashlib.sha1()
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as fp:
+        try:
+            for chunk in chunks:
+                content_hash.update(chunk)
+                fp.write(chunk)
+        except:
+            os.unlink(fp.name)
+            raise
+    return (fp.name, content_hash.hexdigest())
+
+
+def replace_with_temp_file(temp_path, path, mode=None):
+    """fsync temp_path and rename it over path, so readers see either the old
+    or the new file in full."""
+    fd = os.open(temp_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        if mode is not None:
+            os.fchmod(fd, mode)
+    finally:
+        os.close(fd)
+    os.rename(temp_path, path)
+
+
+def write_atomically(path, contents, mode=None):
+    (temp_path, _) = write_temp_file(path, [contents])
+    try:
+        replace_with_temp_file(temp_path, path, mode=mode)
+    except:
+        os.unlink(temp_path)
+        raise
+
+
+def write_json_atomically(path, data):
+    write_atomically(path, json.dumps(data))
+
+
+def content_hash_path(path):
+    return path + '.sha1'
+
+
+def read_content_hash(path):
+    """Return the content hash recorded for path by write_content_hash, or
+    None if there isn't one or path has been replaced since."""
+    try:
+        with open(content_hash_path(path)) as fp:
+            (content_hash, inode, size) = fp.read().split()
+        st = os.stat(path)
+    except (IOError, OSError, ValueError):
+        return None
+
+    # Every write_atomically creates a new inode, so this catches the file
+    # being replaced by anything other than us.
+    if (int(inode), int(size)) != (st.st_ino, st.st_size):
+        return None
+    return content_hash
+
+
+def write_content_hash(path, content_hash):
+    """Record content_hash as the hash of path's current contents in a sidecar
+    file."""
+    st = os.stat(path)
+    write_atomically(
+        content_hash_path(path),
+        '%s %d %d\n' % (content_hash, st.st_ino, st.st_size))
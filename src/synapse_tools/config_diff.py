@@ -0,0 +1,168 @@
+"""Structured comparison of two synapse configurations.
+
+Rather than treating any byte difference in the synapse config file as a
+reason to restart synapse, classify what actually changed and pick the
+cheapest action that will apply it.
+
+Configs are compared by digests of their parts rather than in full, so that
+a config which was streamed to disk can be compared without loading either
+it or its predecessor.
+"""
+
+from synapse_tools.stanza_cache import hash_inputs
+
+
+# Change classes
+NO_CHANGE = 'no_change'
+GLOBAL_CHANGE = 'global'
+SERVICE_HAPROXY_CHANGE = 'service_haproxy'
+SERVICES_ADDED_OR_REMOVED = 'services_added_or_removed'
+DISCOVERY_CHANGE = 'discovery'
+
+# Actions, cheapest first
+ACTION_NONE = 'none'
+ACTION_RESTART = 'restart'
+ACTIONS = [ACTION_NONE, ACTION_RESTART]
+
+# Synapse only reads its configuration at startup, so every change to its
+# contents needs a restart to take effect.  Changes which only affect the
+# formatting of the file need nothing at all.
+CHANGE_ACTIONS = {
+    NO_CHANGE: ACTION_NONE,
+    GLOBAL_CHANGE: ACTION_RESTART,
+    SERVICE_HAPROXY_CHANGE: ACTION_RESTART,
+    SERVICES_ADDED_OR_REMOVED: ACTION_RESTART,
+    DISCOVERY_CHANGE: ACTION_RESTART,
+}
+
+# Keys of a service entry which control how synapse finds backends, as
+# opposed to how haproxy is configured for them
+DISCOVERY_KEYS = ('discovery', 'default_servers', 'use_previous_backends')
+
+
+class ConfigDiff(object):
+
+    def __init__(self, global_changes, added, removed, haproxy_changed,
+                 discovery_changed):
+        self.global_changes = sorted(global_changes)
+        self.added = sorted(added)
+        self.removed = sorted(removed)
+        self.haproxy_changed = sorted(haproxy_changed)
+        self.discovery_changed = sorted(discovery_changed)
+
+    @property
+    def change_classes(self):
+        classes = set()
+        if self.global_changes:
+            classes.add(GLOBAL_CHANGE)
+        if self.added or self.removed:
+            classes.add(SERVICES_ADDED_OR_REMOVED)
+        if self.haproxy_changed:
+            classes.add(SERVICE_HAPROXY_CHANGE)
+        if self.discovery_changed:
+            classes.add(DISCOVERY_CHANGE)
+        return classes or set([NO_CHANGE])
+
+    @property
+    def action(self):
+        """The cheapest action which applies every change in this diff."""
+        return max(
+            (CHANGE_ACTIONS[change_class] for change_class in self.change_classes),
+            key=ACTIONS.index,
+        )
+
+    def summary(self):
+        parts = []
+        for (label, names) in (
+                ('global', self.global_changes),
+                ('added', self.added),
+                ('removed', self.removed),
+                ('haproxy changed', self.haproxy_changed),
+                ('discovery changed', self.discovery_changed)):
+            if names:
+                parts.append('%s: %s' % (label, ', '.join(names)))
+        return '; '.join(parts) or 'no changes'
+
+
+def _changed_keys(old, new):
+    return [
+        key for key in set(old) | set(new)
+        if old.get(key) != new.get(key)
+    ]
+
+
+def _digest_of_keys(entry, keys):
+    """Digest the items of entry whose keys are in keys.  Missing keys and
+    keys set to None are treated alike."""
+    return hash_inputs(dict(
+        (key, value) for (key, value) in entry.iteritems()
+        if key in keys and value is not None))
+
+
+def service_digests(service):
+    """Digests of how synapse discovers a service's backends, and of
+    everything else in its entry."""
+    other_keys = set(service) - set(DISCOVERY_KEYS)
+    return {
+        'discovery': _digest_of_keys(service, DISCOVERY_KEYS),
+        'haproxy': _digest_of_keys(service, other_keys),
+    }
+
+
+def global_digests(config):
+    """Digests of each top level section of a config except the services,
+    with the haproxy section split up by key."""
+    digests = dict(
+        (key, hash_inputs(value)) for (key, value) in config.iteritems()
+        if key not in ('services', 'haproxy') and value is not None)
+    digests.update(
+        ('haproxy.%s' % key, hash_inputs(value))
+        for (key, value) in config.get('haproxy', {}).iteritems()
+        if value is not None)
+    return digests
+
+
+def config_digests(config):
+    return {
+        'global': global_digests(config),
+        'services': dict(
+            (name, service_digests(service))
+            for (name, service) in config.get('services', {}).iteritems()),
+    }
+
+
+def diff_configs(old_config, new_config):
+    """Compare two synapse configurations (as dicts).  An old_config of None
+    means there is no existing configuration."""
+    return diff_digests(
+        None if old_config is None else config_digests(old_config),
+        config_digests(new_config))
+
+
+def diff_digests(old_digests, new_digests):
+    """Compare two synapse configurations by their config_digests.  An
+    old_digests of None means there is no existing configuration."""
+    if old_digests is None:
+        return ConfigDiff(['config'], new_digests['services'], [], [], [])
+
+    old_services = old_digests['services']
+    new_services = new_digests['services']
+
+    global_changes = _changed_keys(old_digests['global'], new_digests['global'])
+
+    haproxy_changed = []
+    discovery_changed = []
+    for name in set(old_services) & set(new_services):
+        changed_keys = _changed_keys(old_services[name], new_services[name])
+        if 'discovery' in changed_keys:
+            discovery_changed.append(name)
+        if 'haproxy' in changed_keys:
+            haproxy_changed.append(name)
+
+    return ConfigDiff(
+        global_changes=global_changes,
+        added=set(new_services) - set(old_services),
+        removed=set(old_services) - set(new_services),
+        haproxy_changed=haproxy_changed,
+        discovery_changed=discovery_changed,
+    )
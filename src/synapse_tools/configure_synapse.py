@@ -1,50 +1,155 @@
 """Update the synapse configuration file and restart synapse if anything has
 changed."""
 
-import filecmp
+import cProfile
+import hashlib
 import json
+import logging
 import os
-import shutil
+import re
 import subprocess
-import tempfile
+import time
 
+import argparse
 import yaml
+from environment_tools.config import DATA_DIRECTORY
 from environment_tools.type_utils import get_current_location
-from paasta_tools.marathon_tools import get_all_namespaces
-
+from paasta_tools.utils import DEFAULT_SOA_DIR
+
+from synapse_tools.atomic_file import read_content_hash
+from synapse_tools.atomic_file import replace_with_temp_file
+from synapse_tools.atomic_file import write_atomically
+from synapse_tools.atomic_file import write_content_hash
+from synapse_tools.atomic_file import write_json_atomically
+from synapse_tools.atomic_file import write_temp_file
+from synapse_tools.config_diff import ACTION_RESTART
+from synapse_tools.config_diff import config_digests
+from synapse_tools.config_diff import diff_configs
+from synapse_tools.config_diff import diff_digests
+from synapse_tools.config_diff import global_digests
+from synapse_tools.config_diff import service_digests
+from synapse_tools.consumer_scope import scope_services
+from synapse_tools.cpu_topology import haproxy_concurrency
+from synapse_tools.cpu_topology import stats_socket_lines
+from synapse_tools.file_watcher import FileWatcher
+from synapse_tools.json_stream import COMPACT
+from synapse_tools.json_stream import INDENTED
+from synapse_tools.json_stream import iter_json_chunks
+from synapse_tools.json_stream import StreamedDict
+from synapse_tools.namespace_loader import NamespaceLoader
+from synapse_tools.resolution_cache import shared_resolution_cache
+from synapse_tools.shared_options import hoist_common_options
+from synapse_tools.sharding import get_shard_count
+from synapse_tools.sharding import partition_services
+from synapse_tools.sharding import shard_path
+from synapse_tools.sizing import BUFSIZE
+from synapse_tools.sizing import compute_sizing
+from synapse_tools.sizing import get_memory_budget_bytes
+from synapse_tools.stanza_cache import hash_inputs
+from synapse_tools.stanza_cache import StanzaCache
+from synapse_tools.stanza_cache import StanzaFileCache
+from synapse_tools.timing import PhaseTimer
+from synapse_tools.traffic_priority import port_priorities
+from synapse_tools.traffic_priority import PRIORITY_MAP_PATH
+from synapse_tools.traffic_priority import update_priority_map
+from synapse_tools.traffic_priority import validate_priorities
+
+
+log = logging.getLogger(__name__)
 
 SYNAPSE_TOOLS_CONFIG_PATH = '/etc/synapse/synapse-tools.conf.json'
 
 
 def get_config():
     with open(SYNAPSE_TOOLS_CONFIG_PATH) as synapse_config:
-        return json.load(synapse_config)
+        config = json.load(synapse_config)
+    # Check this up front, rather than failing part way through a run
+    get_shard_count(config)
+    return config
 
 SYNAPSE_RESTART_COMMAND = ['service', 'synapse', 'restart']
+# Each shard's synapse runs as its own service, e.g. synapse-0
+SYNAPSE_SHARD_SERVICE = 'synapse-%d'
 
 ZOOKEEPER_TOPOLOGY_PATH = '/nail/etc/zookeeper_discovery/infrastructure/local.yaml'
 
+# Each file in here contains this host's value for one location type or
+# grouping, e.g. /nail/etc/habitat
+GROUPINGS_DIR = '/nail/etc'
+LOCATION_TYPES_PATH = os.path.join(DATA_DIRECTORY, 'location_types.json')
+
 HAPROXY_PATH = '/usr/bin/haproxy-synapse'
 HAPROXY_CONFIG_PATH = '/var/run/synapse/haproxy.cfg'
 HAPROXY_SOCKET_FILE_PATH = '/var/run/synapse/haproxy.sock'
 HAPROXY_PID_FILE_PATH = '/var/run/synapse/haproxy.pid'
+HAPROXY_STATS_PORT = 3212
+SYNAPSE_STATE_FILE_PATH = '/var/run/synapse/state.json'
+HAPROXY_SERVER_STATE_FILE_PATH = '/var/run/synapse/haproxy.state'
 FILE_OUTPUT_PATH = '/var/run/synapse/services'
+STANZA_CACHE_PATH = '/var/run/synapse/stanza_cache.json'
+# With streaming_output, stanzas are cached here instead and kept on disk
+STANZA_FILE_CACHE_PATH = '/var/run/synapse/stanza_cache.jsonl'
+NAMESPACE_INDEX_PATH = '/var/run/synapse/namespace_index.json'
 
 # Command used to start/reload haproxy.   Note that we touch the pid file first
 # in case it doesn't exist;  otherwise the reload will fail.
-HAPROXY_RELOAD_CMD = 'touch %s && PID=$(cat %s) && %s -f %s -p %s -sf $PID' % (
-    HAPROXY_PID_FILE_PATH, HAPROXY_PID_FILE_PATH, HAPROXY_PATH,
-    HAPROXY_CONFIG_PATH, HAPROXY_PID_FILE_PATH)
-# Hack to fix SRV-2141 and OPS-8144 until we can get a proper solution
-HAPROXY_RELOAD_WITH_SLEEP = '%s && sleep 0.010' % (HAPROXY_RELOAD_CMD)
-HAPROXY_PROTECT_CMD = "sudo /usr/bin/synapse_qdisc_tool protect bash -c '%s'"
-HAPROXY_PROTECTED_RELOAD_CMD = HAPROXY_PROTECT_CMD % HAPROXY_RELOAD_WITH_SLEEP
-
-# Global maximum number of connections.
+HAPROXY_RELOAD_CMD = 'touch %(pid)s && PID=$(cat %(pid)s) && %(haproxy)s -f %(config)s -p %(pid)s -sf $PID'
+# Traffic stays blocked until the new haproxy is listening on every port (see
+# SRV-2141 and OPS-8144)
+HAPROXY_PROTECT_CMD = (
+    'sudo /usr/bin/synapse_qdisc_tool protect%%(protect_options)s '
+    "--wait-listening %%(pid)s %%(config)s bash -c '%s'")
+# Bounds on the bytes queued while traffic is blocked, between which
+# synapse_qdisc_tool sizes the limit from the SYN rate it has seen
+PLUG_LIMIT_OPTIONS = (
+    ('haproxy.plug_limit_min_bytes', '--min-plug-limit-bytes'),
+    ('haproxy.plug_limit_max_bytes', '--max-plug-limit-bytes'),
+)
+HAPROXY_PROTECTED_RELOAD_CMD = HAPROXY_PROTECT_CMD % HAPROXY_RELOAD_CMD
+# Reloading by passing the listening sockets from the old haproxy to the new
+# one over the stats socket.  Nothing is dropped, so traffic doesn't need to
+# be blocked while it happens.  haproxy exits if it can't fetch the sockets,
+# so this is only tried if the old haproxy is running and was started with
+# expose-fd listeners, which the exposed pid file records.  Otherwise (e.g.
+# the first start, or the first reload after switching from qdisc reloads),
+# or if it fails, the protected reload is used instead.
+HAPROXY_SEAMLESS_RELOAD_CMD = (
+    'touch %(pid)s && PID=$(cat %(pid)s) && '
+    '{ [ -S %(socket)s ] && cmp -s %(pid)s %(exposed_pid)s && kill -0 $PID && '
+    '%(haproxy)s -f %(config)s -p %(pid)s -x %(socket)s -sf $PID || '
+    '%(protected_reload)s; } && '
+    'cp %(pid)s %(exposed_pid)s')
+# The first version supporting expose-fd listeners and -x
+SEAMLESS_RELOAD_MIN_VERSION = (1, 8)
+RELOAD_STRATEGIES = ('qdisc', 'seamless')
+
+# Saving the server state is done before traffic is blocked, to keep the time
+# spent blocked to a minimum.
+HAPROXY_DUMP_SERVER_STATE_CMD = '/usr/bin/synapse_dump_server_state %s %s'
+# The first version supporting server-state-file and show servers state
+SERVER_STATE_MIN_VERSION = (1, 6)
+
+# Global maximum number of connections, unless sized to a memory budget.
 MAXIMUM_CONNECTIONS = 10000
 
 HACHECK_PORT = 6666
 
+# Per-service alternatives to the default 'option forceclose' for HTTP
+# services, and the backend connection reuse policies they allow
+KEEPALIVE_MODES = ('forceclose', 'http-server-close', 'http-keep-alive')
+HTTP_REUSE_MODES = ('never', 'safe', 'aggressive', 'always')
+
+# How long an idle keep-alive connection is held open.  Keep this short: an
+# old haproxy holding idle connections after a reload cannot exit until they
+# close.
+DEFAULT_TIMEOUT_KEEPALIVE_MS = 1000
+
+LOG_FORMAT = '%(levelname)s %(message)s'
+
+# In --watch mode, regenerate the config at least this often even if none of
+# the watched files have changed.
+WATCH_REFRESH_INTERVAL_S = 60
+
 
 def get_zookeeper_topology():
     with open(ZOOKEEPER_TOPOLOGY_PATH) as fp:
@@ -54,32 +159,164 @@ def get_zookeeper_topology():
     return zookeeper_topology
 
 
-def generate_base_config(synapse_tools_config):
+def protect_options(synapse_tools_config):
+    """Extra synapse_qdisc_tool protect options, for any plug limit bounds
+    that are configured."""
+    return ''.join(
+        ' %s %d' % (option, int(synapse_tools_config[key]))
+        for (key, option) in PLUG_LIMIT_OPTIONS
+        if key in synapse_tools_config
+    )
+
+
+def exposed_pid_path(pid_path):
+    """Where the pids of an haproxy started with expose-fd listeners are
+    recorded."""
+    return pid_path + '.exposed'
+
+
+def haproxy_reload_command(config_path, pid_path, socket_path=None,
+                           server_state_path=None, seamless=False,
+                           extra_protect_options=''):
+    """If server_state_path is given, the running haproxy's server state is
+    saved there (via socket_path) before reloading.  If seamless is set, the
+    listening sockets are handed over via socket_path rather than blocking
+    traffic during the reload, when the running haproxy allows it."""
+    params = {
+        'pid': pid_path, 'haproxy': HAPROXY_PATH, 'config': config_path,
+        'socket': socket_path, 'protect_options': extra_protect_options,
+        'exposed_pid': exposed_pid_path(pid_path)}
+    command = HAPROXY_PROTECTED_RELOAD_CMD % params
+    if seamless:
+        command = HAPROXY_SEAMLESS_RELOAD_CMD % dict(
+            params, protected_reload=command)
+    if server_state_path is not None:
+        command = '%s; %s' % (
+            HAPROXY_DUMP_SERVER_STATE_CMD % (socket_path, server_state_path),
+            command)
+    return command
+
+
+def get_haproxy_version(haproxy_path=HAPROXY_PATH):
+    """Return haproxy's (major, minor) version, or None if it can't be
+    run."""
+    try:
+        output = subprocess.check_output([haproxy_path, '-v'])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    match = re.search(r'HA-?Proxy version (\d+)\.(\d+)', output)
+    if match is None:
+        return None
+    return (int(match.group(1)), int(match.group(2)))
+
+
+def resolve_haproxy_version():
+    """Memoized get_haproxy_version, invalidated when the binary changes."""
+    return shared_resolution_cache.get(
+        ('haproxy_version', HAPROXY_PATH),
+        [HAPROXY_PATH],
+        lambda: get_haproxy_version(HAPROXY_PATH),
+    )
+
+
+def use_seamless_reload(synapse_tools_config):
+    """Whether haproxy.reload_strategy asks for seamless reloads and the
+    installed haproxy supports them.  Otherwise reloads fall back to blocking
+    traffic with synapse_qdisc_tool."""
+    strategy = synapse_tools_config.get('haproxy.reload_strategy', 'qdisc')
+    if strategy not in RELOAD_STRATEGIES:
+        raise ValueError('haproxy.reload_strategy must be one of %s, not %r' % (
+            ', '.join(RELOAD_STRATEGIES), strategy))
+    if strategy != 'seamless':
+        return False
+    version = resolve_haproxy_version()
+    if version is None or version < SEAMLESS_RELOAD_MIN_VERSION:
+        log.warn('haproxy version %s does not support seamless reloads, '
+                 'falling back to qdisc reloads' % (version,))
+        return False
+    return True
+
+
+def use_server_state(synapse_tools_config):
+    """Whether haproxy.preserve_server_state is set and the installed
+    haproxy supports it."""
+    if not synapse_tools_config.get('haproxy.preserve_server_state', False):
+        return False
+    version = resolve_haproxy_version()
+    if version is None or version < SERVER_STATE_MIN_VERSION:
+        log.warn('haproxy version %s does not support server state files, '
+                 'not preserving server state across reloads' % (version,))
+        return False
+    return True
+
+
+def synapse_restart_command(shard=None):
+    if shard is None:
+        return SYNAPSE_RESTART_COMMAND
+    return ['service', SYNAPSE_SHARD_SERVICE % shard, 'restart']
+
+
+def generate_base_config(synapse_tools_config, service_count=0):
     haproxy_inter = synapse_tools_config.get('haproxy.defaults.inter', '10m')
+    # Set by shard_config when generating one of several shards
+    shard = synapse_tools_config.get('shard')
+    haproxy_config_path = shard_path(HAPROXY_CONFIG_PATH, shard)
+    haproxy_socket_path = shard_path(HAPROXY_SOCKET_FILE_PATH, shard)
+    stats_port = HAPROXY_STATS_PORT + (shard or 0)
+    seamless = use_seamless_reload(synapse_tools_config)
+
+    (server_state_path, server_state_lines, defaults_server_state_lines) = (
+        None, [], [])
+    if use_server_state(synapse_tools_config):
+        server_state_path = shard_path(HAPROXY_SERVER_STATE_FILE_PATH, shard)
+        server_state_lines = ['server-state-file %s' % server_state_path]
+        defaults_server_state_lines = ['load-server-state-from-file global']
+    (processes, _, concurrency_lines) = haproxy_concurrency(
+        synapse_tools_config, shard=shard)
+
+    (maxconn, sizing_lines, defaults_sizing_lines) = (
+        MAXIMUM_CONNECTIONS, [], [])
+    budget_bytes = get_memory_budget_bytes(synapse_tools_config)
+    if budget_bytes is not None:
+        (maxconn, frontend_maxconn, sizing_lines) = compute_sizing(
+            budget_bytes, service_count,
+            processes=processes * get_shard_count(synapse_tools_config))
+        defaults_sizing_lines = ['maxconn %d' % frontend_maxconn]
+
     base_config = {
         # We'll fill this section in
         'services': {},
-        'file_output': {'output_directory': FILE_OUTPUT_PATH},
+        # Synapse deletes any files here for services it isn't watching, so
+        # each shard needs a directory of its own
+        'file_output': {'output_directory': shard_path(FILE_OUTPUT_PATH, shard)},
         'haproxy': {
             'bind_address': synapse_tools_config['bind_addr'],
             'restart_interval': 60,
             'restart_jitter': 0.1,
-            'state_file_path': '/var/run/synapse/state.json',
+            'state_file_path': shard_path(SYNAPSE_STATE_FILE_PATH, shard),
             'state_file_ttl': 30 * 60,
-            'reload_command': HAPROXY_PROTECTED_RELOAD_CMD,
-            'socket_file_path': HAPROXY_SOCKET_FILE_PATH,
-            'config_file_path': HAPROXY_CONFIG_PATH,
+            'reload_command': haproxy_reload_command(
+                haproxy_config_path,
+                shard_path(HAPROXY_PID_FILE_PATH, shard),
+                socket_path=haproxy_socket_path,
+                server_state_path=server_state_path,
+                seamless=seamless,
+                extra_protect_options=protect_options(synapse_tools_config)),
+            'socket_file_path': haproxy_socket_path,
+            'config_file_path': haproxy_config_path,
             'do_writes': True,
             'do_reloads': True,
-            'do_socket': True,
-
-            'global': [
-                'daemon',
-                'maxconn %d' % MAXIMUM_CONNECTIONS,
-                'stats socket %s level admin' % HAPROXY_SOCKET_FILE_PATH,
-
+            # Synapse can only update servers over the socket of the first
+            # process, so with several it has to reload haproxy instead
+            'do_socket': processes == 1,
+
+            'global': ['daemon'] + concurrency_lines + sizing_lines + [
+                'maxconn %d' % maxconn,
+            ] + stats_socket_lines(
+                haproxy_socket_path, processes, expose_fd=seamless,
+            ) + server_state_lines + [
                 # Default of 16k is too small and causes HTTP 400 errors
-                'tune.bufsize 32768',
+                'tune.bufsize %d' % BUFSIZE,
 
                 # Add random jitter to checks
                 'spread-checks 50',
@@ -146,11 +383,12 @@ def generate_base_config(synapse_tools_config):
                 ('default-server on-error fastinter error-limit 1'
                  ' inter {inter} downinter 30s fastinter 30s'
                  ' rise 1 fall 2'.format(inter=haproxy_inter)),
-            ],
+            ] + defaults_sizing_lines + defaults_server_state_lines,
 
             'extra_sections': {
                 'listen stats': [
-                    'bind :3212',
+                    'bind :%d' % stats_port,
+                ] + (['bind-process 1'] if processes > 1 else []) + [
                     'mode http',
                     'stats enable',
                     'stats uri /',
@@ -163,19 +401,122 @@ def generate_base_config(synapse_tools_config):
     return base_config
 
 
-def generate_configuration(synapse_tools_config, zookeeper_topology, services):
-    synapse_config = generate_base_config(synapse_tools_config)
+def generate_configuration(synapse_tools_config, zookeeper_topology, services,
+                           stanza_cache=None, timer=None):
+    """Generate the full synapse configuration.
+
+    If a StanzaCache is supplied, services whose inputs are unchanged since
+    the stanza was cached are not regenerated.  If a PhaseTimer is supplied,
+    the time taken for each service is recorded in it.  If consumer scoping
+    is configured, only the services this host depends on are included.  If
+    hoist_common_options is set, options shared by every service are moved
+    into the haproxy defaults section.
+    """
+    services = scope_services(synapse_tools_config, services)
+    synapse_config = generate_base_config(
+        synapse_tools_config, service_count=count_proxied_services(services))
+    synapse_config['services'] = dict(iter_service_entries(
+        zookeeper_topology, services, stanza_cache=stanza_cache, timer=timer))
+    if synapse_tools_config.get('hoist_common_options', False):
+        synapse_config = hoist_common_options(synapse_config)
+    return synapse_config
+
+
+def generate_configuration_chunks(synapse_tools_config, zookeeper_topology,
+                                  services, stanza_cache=None, timer=None,
+                                  digests=None):
+    """Generate the serialized synapse configuration as an iterator of
+    chunks.  Each service entry is generated as it is serialized, so the full
+    configuration is never held in memory.
 
-    for (service_name, service_info) in services:
+    If a dict is supplied as digests, the config's config_digests are filled
+    in as the chunks are consumed, for comparing it with the previous config
+    without reading either back.
+
+    hoist_common_options is not supported, since it needs every service entry
+    before any of the configuration can be written.
+    """
+    if synapse_tools_config.get('hoist_common_options', False):
+        log.warn('hoist_common_options is ignored with streaming_output')
+    services = scope_services(synapse_tools_config, services)
+    synapse_config = generate_base_config(
+        synapse_tools_config, service_count=count_proxied_services(services))
+    entries = iter_service_entries(
+        zookeeper_topology, services, stanza_cache=stanza_cache, timer=timer)
+    if digests is not None:
+        digests['global'] = global_digests(synapse_config)
+        digests['services'] = {}
+        entries = iter_digested_entries(entries, digests['services'])
+    synapse_config['services'] = StreamedDict(entries)
+    return iter_json_chunks(
+        synapse_config,
+        compact=synapse_tools_config.get('compact_output', False))
+
+
+def iter_digested_entries(entries, service_digests_by_name):
+    """Pass (service_name, entry) pairs through, recording each entry's
+    service_digests as it goes."""
+    for (service_name, entry) in entries:
+        service_digests_by_name[service_name] = service_digests(entry)
+        yield (service_name, entry)
+
+
+def count_proxied_services(services):
+    return sum(
+        1 for (_, service_info) in services
+        if service_info.get('proxy_port') is not None)
+
+
+def iter_service_entries(zookeeper_topology, services, stanza_cache=None,
+                         timer=None):
+    """Yield (service_name, synapse service entry) pairs for every service
+    with a proxy_port, sorted by service name."""
+    services = dict(services)
+    topology_hash = hash_inputs(zookeeper_topology)
+
+    for service_name in sorted(services):
+        service_info = services[service_name]
         if service_info.get('proxy_port') is None:
             continue
 
-        synapse_config['services'][service_name] = haproxy_cfg_for_service(
-            service_name,
-            service_info,
-            zookeeper_topology)
-
-    return synapse_config
+        start = time.time()
+        if stanza_cache is None:
+            service = haproxy_cfg_for_service(
+                service_name,
+                service_info,
+                zookeeper_topology)
+        else:
+            key = stanza_cache_key(service_name, service_info, topology_hash)
+            service = stanza_cache.get(service_name, key)
+            if service is None:
+                service = haproxy_cfg_for_service(
+                    service_name,
+                    service_info,
+                    zookeeper_topology)
+                stanza_cache.put(service_name, key, service)
+
+        if timer is not None:
+            timer.record_service(service_name, time.time() - start)
+        yield (service_name, service)
+
+
+def stanza_cache_key(service_name, service_info, topology_hash):
+    """Hash every input that haproxy_cfg_for_service depends on: the
+    service's own config, this host's location and chaos groupings, and the
+    zookeeper topology."""
+    discover_type = service_info.get('discover', 'region')
+    groupings = dict(
+        (grouping_type, resolve_grouping(grouping_type))
+        for grouping_type in (service_info.get('chaos') or {})
+    )
+    return hash_inputs(
+        service_name,
+        service_info,
+        resolve_location(discover_type),
+        groupings,
+        topology_hash,
+        HACHECK_PORT,
+    )
 
 
 def haproxy_cfg_for_service(service_name, service_info, zookeeper_topology):
@@ -248,6 +589,12 @@ def haproxy_cfg_for_service(service_name, service_info, zookeeper_topology):
     if mode == 'tcp':
         listen_options.append('mode tcp')
 
+    if mode == 'http':
+        (keepalive_listen_options, keepalive_backend_options) = keepalive_options(
+            service_name, service_info)
+        listen_options.extend(keepalive_listen_options)
+        backend_options.extend(keepalive_backend_options)
+
     retries = service_info.get('retries')
     if retries is not None:
         listen_options.append('retries %d' % retries)
@@ -267,7 +614,7 @@ def haproxy_cfg_for_service(service_name, service_info, zookeeper_topology):
         listen_options.append('timeout server %dms' % timeout_server_ms)
 
     discover_type = service_info.get('discover', 'region')
-    location = get_current_location(discover_type)
+    location = resolve_location(discover_type)
 
     discovery = {
         'method': 'zookeeper',
@@ -295,9 +642,52 @@ def haproxy_cfg_for_service(service_name, service_info, zookeeper_topology):
         }
     }
 
+    # Synapse ignores this; it records which prio qdisc band the service's
+    # traffic is steered into
+    priority = service_info.get('priority')
+    if priority is not None:
+        service['priority'] = priority
+
     return service
 
 
+def keepalive_options(service_name, service_info):
+    """ Return a tuple of
+    (additional_listen_options, additional_backend_options) which replace the
+    default 'option forceclose' with the service's keepalive_mode, and set
+    its http_reuse policy. """
+    http_reuse = service_info.get('http_reuse')
+    if http_reuse is not None and http_reuse not in HTTP_REUSE_MODES:
+        log.warn('Ignoring unknown http_reuse %s for %s' % (http_reuse, service_name))
+        http_reuse = None
+
+    # Backend connections can only be reused if they are kept alive
+    default_keepalive_mode = 'forceclose' if http_reuse is None else 'http-keep-alive'
+    keepalive_mode = service_info.get('keepalive_mode', default_keepalive_mode)
+    if keepalive_mode not in KEEPALIVE_MODES:
+        log.warn('Ignoring unknown keepalive_mode %s for %s' % (keepalive_mode, service_name))
+        keepalive_mode = 'forceclose'
+
+    if keepalive_mode == 'forceclose':
+        if http_reuse is not None:
+            log.warn('Ignoring http_reuse %s for %s, since keepalive_mode '
+                     'forceclose closes backend connections' % (
+                         http_reuse, service_name))
+        return [], []
+
+    # These go in both the frontend and the backend, since otherwise the
+    # frontend's forceclose from the defaults section would win
+    listen_options = [
+        'option %s' % keepalive_mode,
+        'timeout http-keep-alive %dms' % service_info.get(
+            'timeout_keepalive_ms', DEFAULT_TIMEOUT_KEEPALIVE_MS),
+    ]
+    backend_options = []
+    if http_reuse is not None:
+        backend_options.append('http-reuse %s' % http_reuse)
+    return listen_options, backend_options
+
+
 def chaos_options(chaos_dict, discovery_dict):
     """ Return a tuple of
     (additional_frontend_options, replacement_discovery_dict) """
@@ -344,39 +734,354 @@ def merge_dict_for_my_grouping(chaos_dict):
     """
     result = {}
     for grouping_type, grouping_dict in chaos_dict.iteritems():
-        my_grouping = get_my_grouping(grouping_type)
+        my_grouping = resolve_grouping(grouping_type)
         entry = grouping_dict.get(my_grouping, {})
         result.update(entry)
     return result
 
 
 def get_my_grouping(grouping_type):
-    with open('/nail/etc/{0}'.format(grouping_type)) as fd:
+    with open(os.path.join(GROUPINGS_DIR, grouping_type)) as fd:
         return fd.read().strip()
 
 
-def main():
-    my_config = get_config()
+def resolve_location(location_type):
+    """Memoized get_current_location, invalidated when the files it reads
+    change."""
+    return shared_resolution_cache.get(
+        ('location', location_type),
+        [os.path.join(GROUPINGS_DIR, location_type), LOCATION_TYPES_PATH],
+        lambda: get_current_location(location_type),
+    )
 
-    new_synapse_config = generate_configuration(
-        my_config, get_zookeeper_topology(), get_all_namespaces()
+
+def resolve_grouping(grouping_type):
+    """Memoized get_my_grouping, invalidated when the file it reads
+    changes."""
+    return shared_resolution_cache.get(
+        ('grouping', grouping_type),
+        [os.path.join(GROUPINGS_DIR, grouping_type)],
+        lambda: get_my_grouping(grouping_type),
     )
 
-    with tempfile.NamedTemporaryFile() as tmp_file:
-        new_synapse_config_path = tmp_file.name
-        with open(new_synapse_config_path, 'w') as fp:
-            json.dump(new_synapse_config, fp, sort_keys=True, indent=4, separators=(',', ': '))
 
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--watch', action='store_true',
+        help='Keep running, and regenerate the config whenever one of its '
+             'input files changes.')
+    parser.add_argument(
+        '--profile', metavar='PATH',
+        help='Write cProfile stats for the run to PATH.  These can be viewed '
+             'with pstats, or converted into a flamegraph.')
+    return parser.parse_args()
+
+
+def read_synapse_config(path):
+    """Return the synapse config currently at path, or None if there isn't a
+    valid one."""
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+
+def serialize_synapse_config(synapse_config, compact=False):
+    if compact:
+        return json.dumps(synapse_config, sort_keys=True, **COMPACT)
+    return json.dumps(synapse_config, sort_keys=True, **INDENTED)
+
+
+def touch_if_unchanged(config_path, content_hash):
+    """If config_path already has the given content, bump its mtime and return
+    True.  Our monitoring system checks the config['config_file'] file age to
+    ensure that it is continually being updated."""
+    if read_content_hash(config_path) != content_hash:
+        return False
+    os.utime(config_path, None)
+    return True
+
+
+def config_digests_path(path):
+    return path + '.digests'
+
+
+def read_config_digests(config_path):
+    """Return the config_digests recorded for config_path by
+    write_config_digests, or None if there aren't any or config_path has
+    changed since."""
+    try:
+        with open(config_digests_path(config_path)) as fp:
+            digests = json.load(fp)
+    except (IOError, ValueError):
+        return None
+    content_hash = read_content_hash(config_path)
+    if content_hash is None or digests.get('content_hash') != content_hash:
+        return None
+    return digests
+
+
+def write_config_digests(config_path, content_hash, digests):
+    write_json_atomically(
+        config_digests_path(config_path),
+        dict(digests, content_hash=content_hash))
+
+
+def apply_config_change(diff, timer, shard=None):
+    log.info('Synapse %sconfig changed (%s): %s; action: %s' % (
+        '' if shard is None else 'shard %d ' % shard,
+        ', '.join(sorted(diff.change_classes)), diff.summary(), diff.action))
+
+    if diff.action == ACTION_RESTART:
+        with timer.phase('restart'):
+            subprocess.check_call(synapse_restart_command(shard))
+
+
+def update_synapse_config(my_config, new_synapse_config, timer=None):
+    """Publish the new synapse config and restart synapse if it changed."""
+    timer = timer or PhaseTimer()
+    config_path = my_config['config_file']
+    with timer.phase('serialization'):
+        serialized = serialize_synapse_config(
+            new_synapse_config, compact=my_config.get('compact_output', False))
+        content_hash = hashlib.sha1(serialized).hexdigest()
+
+    with timer.phase('comparison'):
+        if touch_if_unchanged(config_path, content_hash):
+            return
+        # Work out the cheapest way of applying the changes
+        diff = diff_configs(read_synapse_config(config_path), new_synapse_config)
+
+    with timer.phase('publish'):
         # Match permissions that puppet expects
-        os.chmod(new_synapse_config_path, 0644)
+        write_atomically(config_path, serialized, mode=0644)
+        write_content_hash(config_path, content_hash)
+        # In case streaming_output is turned on later
+        write_config_digests(
+            config_path, content_hash, config_digests(new_synapse_config))
+
+    apply_config_change(diff, timer, shard=my_config.get('shard'))
 
-        # Restart synapse if the config files differ
-        should_restart = not filecmp.cmp(new_synapse_config_path, my_config['config_file'])
 
-        # Always swap new config file into place.  Our monitoring system
-        # checks the config['config_file'] file age to ensure that it is
-        # continually being updated.
-        shutil.copy(new_synapse_config_path, my_config['config_file'])
+def update_synapse_config_from_chunks(my_config, chunks, digests, timer=None):
+    """Like update_synapse_config, but for a config which is generated as it
+    is serialized.  The chunks are written to a temporary file and hashed as
+    they are generated; the temporary file only replaces the live config if
+    its hash differs.
+
+    digests are the new config's config_digests, complete once the chunks
+    have been consumed.  They are compared with those recorded for the live
+    config, so neither config is ever loaded.  If none were recorded,
+    synapse is restarted.
+    """
+    timer = timer or PhaseTimer()
+    config_path = my_config['config_file']
+    with timer.phase('generate_configuration'):
+        (temp_path, content_hash) = write_temp_file(config_path, chunks)
+
+    try:
+        with timer.phase('comparison'):
+            if touch_if_unchanged(config_path, content_hash):
+                return
+            diff = diff_digests(read_config_digests(config_path), digests)
+
+        with timer.phase('publish'):
+            replace_with_temp_file(temp_path, config_path, mode=0644)
+            write_content_hash(config_path, content_hash)
+            write_config_digests(config_path, content_hash, digests)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+    apply_config_change(diff, timer, shard=my_config.get('shard'))
+
+
+def shard_config(my_config, shard):
+    """Return the configure_synapse config for generating one shard."""
+    return dict(
+        my_config,
+        config_file=shard_path(my_config['config_file'], shard),
+        shard=shard,
+    )
 
-        if should_restart:
-            subprocess.check_call(SYNAPSE_RESTART_COMMAND)
+
+def generate_and_update(my_config, zookeeper_topology, services, stanza_cache,
+                        timer):
+    """Generate the synapse config and publish it.  If the shards option is
+    set, services are partitioned across that many synapse configs, each of
+    which is published (and its synapse restarted) independently."""
+    services = validate_priorities(services)
+    # Every shard shares lo, so the priority map covers all of them
+    update_priority_map(port_priorities(services), PRIORITY_MAP_PATH)
+
+    shard_count = get_shard_count(my_config)
+    if shard_count == 1:
+        generate_and_update_shard(
+            my_config, zookeeper_topology, services, stanza_cache, timer)
+        return
+
+    partitions = partition_services(
+        services, shard_count, my_config.get('shard_pins'))
+    shard_config_paths = []
+    for (shard, shard_services) in enumerate(partitions):
+        config = shard_config(my_config, shard)
+        generate_and_update_shard(
+            config, zookeeper_topology, shard_services, stanza_cache, timer)
+        shard_config_paths.append(config['config_file'])
+    update_shard_index(
+        shard_index_path(my_config['config_file']), shard_config_paths)
+
+
+def shard_index_path(config_path):
+    return config_path + '.shards'
+
+
+def update_shard_index(index_path, shard_config_paths):
+    """With several shards, index_path lists the shards' config files.  It
+    is touched every run, as touch_if_unchanged does for a single config, so
+    that monitoring can check its age.  The unsharded config_file is left
+    alone, so that the unsharded synapse still has a valid config."""
+    content = serialize_synapse_config({'shards': shard_config_paths})
+    try:
+        with open(index_path) as fp:
+            unchanged = fp.read() == content
+    except IOError:
+        unchanged = False
+    if unchanged:
+        os.utime(index_path, None)
+    else:
+        write_atomically(index_path, content, mode=0644)
+
+
+def generate_and_update_shard(my_config, zookeeper_topology, services,
+                              stanza_cache, timer):
+    """Generate a single synapse config and publish it, streaming it to disk
+    if the streaming_output option is set."""
+    if my_config.get('streaming_output', False):
+        digests = {}
+        chunks = generate_configuration_chunks(
+            my_config, zookeeper_topology, services,
+            stanza_cache=stanza_cache, timer=timer, digests=digests)
+        update_synapse_config_from_chunks(
+            my_config, chunks, digests, timer=timer)
+    else:
+        with timer.phase('generate_configuration'):
+            new_synapse_config = generate_configuration(
+                my_config, zookeeper_topology, services,
+                stanza_cache=stanza_cache, timer=timer)
+        update_synapse_config(my_config, new_synapse_config, timer=timer)
+
+
+def watch():
+    """Regenerate the synapse config whenever one of its inputs changes.
+
+    Inputs are kept in memory between runs and only the ones whose files
+    changed are reloaded.  The config is also regenerated every
+    WATCH_REFRESH_INTERVAL_S regardless, which picks up location changes and
+    keeps the config file fresh for monitoring.
+    """
+    namespace_loader = NamespaceLoader(soa_dir=DEFAULT_SOA_DIR)
+    loaders = {
+        os.path.abspath(SYNAPSE_TOOLS_CONFIG_PATH): ('my_config', get_config),
+        os.path.abspath(ZOOKEEPER_TOPOLOGY_PATH): (
+            'zookeeper_topology', get_zookeeper_topology),
+        os.path.abspath(DEFAULT_SOA_DIR): (
+            'services', namespace_loader.get_all_namespaces),
+    }
+
+    watcher = FileWatcher()
+    watcher.watch_file(SYNAPSE_TOOLS_CONFIG_PATH)
+    watcher.watch_file(ZOOKEEPER_TOPOLOGY_PATH)
+    watcher.watch_tree(DEFAULT_SOA_DIR)
+
+    inputs = dict((name, loader()) for (name, loader) in loaders.itervalues())
+    stanza_cache = None
+
+    while True:
+        timer = PhaseTimer()
+        try:
+            stanza_cache = watch_stanza_cache(inputs['my_config'], stanza_cache)
+            generate_and_update(
+                inputs['my_config'], inputs['zookeeper_topology'],
+                inputs['services'], stanza_cache, timer)
+            if isinstance(stanza_cache, StanzaFileCache):
+                stanza_cache.save(STANZA_FILE_CACHE_PATH)
+            timer.emit()
+        except Exception:
+            log.exception('Failed to update synapse config')
+
+        changed = watcher.wait_for_changes(WATCH_REFRESH_INTERVAL_S)
+        for path in changed:
+            (name, loader) = loaders[path]
+            log.info('%s changed, reloading %s' % (path, name))
+            try:
+                inputs[name] = loader()
+            except Exception:
+                # Most likely we caught a file halfway through being
+                # updated; keep the old value until the next change.
+                log.exception('Failed to reload %s' % name)
+
+
+def watch_stanza_cache(my_config, stanza_cache):
+    """Return the stanza cache for the next watch run.  It is kept in memory
+    between runs, unless streaming_output is set, when it is kept on disk so
+    that memory use doesn't grow with the size of the whole config."""
+    if my_config.get('streaming_output', False):
+        if not isinstance(stanza_cache, StanzaFileCache):
+            stanza_cache = StanzaFileCache.load(STANZA_FILE_CACHE_PATH)
+    elif not isinstance(stanza_cache, StanzaCache):
+        if stanza_cache is not None:
+            stanza_cache.close()
+        stanza_cache = StanzaCache()
+    return stanza_cache
+
+
+def load_stanza_cache(my_config):
+    """Return (stanza cache, path to save it to) for a single run."""
+    if my_config.get('streaming_output', False):
+        return (StanzaFileCache.load(STANZA_FILE_CACHE_PATH),
+                STANZA_FILE_CACHE_PATH)
+    return (StanzaCache.load(STANZA_CACHE_PATH), STANZA_CACHE_PATH)
+
+
+def run_once(timer):
+    with timer.phase('get_config'):
+        my_config = get_config()
+
+    with timer.phase('get_zookeeper_topology'):
+        zookeeper_topology = get_zookeeper_topology()
+
+    with timer.phase('get_all_namespaces'):
+        namespace_loader = NamespaceLoader.load(
+            NAMESPACE_INDEX_PATH, soa_dir=DEFAULT_SOA_DIR)
+        services = namespace_loader.get_all_namespaces()
+        namespace_loader.save(NAMESPACE_INDEX_PATH)
+    log.info('Parsed %d changed smartstack files' % namespace_loader.parsed)
+
+    (stanza_cache, stanza_cache_path) = load_stanza_cache(my_config)
+    generate_and_update(
+        my_config, zookeeper_topology, services, stanza_cache, timer)
+    stanza_cache.save(stanza_cache_path)
+    log.info('Stanza cache: %d hits, %d misses' % (
+        stanza_cache.hits, stanza_cache.misses))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    args = parse_args()
+    if args.watch:
+        watch()
+        return
+
+    timer = PhaseTimer()
+    if args.profile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(run_once, timer)
+        finally:
+            profiler.dump_stats(args.profile)
+    else:
+        run_once(timer)
+    timer.emit()
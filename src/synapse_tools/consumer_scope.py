@@ -0,0 +1,119 @@
+"""Restrict the services proxied on a host to the ones it actually uses.
+
+By default every host proxies every smartstack namespace.  If either of the
+following options are set in synapse-tools.conf.json, only the namespaces
+they list are proxied:
+
+* consumer_dependencies_file: a YAML list of namespaces ("service.namespace")
+  or whole services ("service") that this host talks to.
+* consumer_local_services: a list of services deployed on this host.  The
+  namespaces each of them declares as "smartstack" entries in its
+  dependencies.yaml are proxied.
+
+A dependencies file that is missing, unreadable or empty, or options that
+list no dependencies at all, more likely mean a broken deploy than a host
+that uses nothing, so scoping is then skipped with a warning rather than
+dropping every service.
+"""
+
+import logging
+import os
+
+import yaml
+from paasta_tools.utils import DEFAULT_SOA_DIR
+
+
+log = logging.getLogger(__name__)
+
+
+def load_dependencies_file(path):
+    """Return the set of dependencies listed in path, or None if it can't
+    be read or lists none."""
+    try:
+        with open(path) as fp:
+            dependencies = yaml.safe_load(fp)
+    except (IOError, yaml.YAMLError) as e:
+        log.warn('Could not read consumer dependencies from %s: %s' % (path, e))
+        return None
+    if not dependencies or not isinstance(dependencies, list):
+        log.warn('%s does not list any consumer dependencies' % path)
+        return None
+    return set(dependencies)
+
+
+def read_declared_dependencies(service, soa_dir=DEFAULT_SOA_DIR):
+    """Return the smartstack namespaces that any instance of service declares
+    as a dependency in its dependencies.yaml, e.g.
+
+    main:
+        - smartstack: service_two.main
+        - well-known: memcached
+    """
+    path = os.path.join(soa_dir, service, 'dependencies.yaml')
+    try:
+        with open(path) as fp:
+            dependencies = yaml.safe_load(fp) or {}
+    except IOError:
+        log.warn('No dependencies.yaml for local service %s' % service)
+        return set()
+
+    namespaces = set()
+    for instance_dependencies in dependencies.itervalues():
+        for dependency in instance_dependencies or []:
+            if isinstance(dependency, dict) and 'smartstack' in dependency:
+                namespaces.add(dependency['smartstack'])
+    return namespaces
+
+
+def get_consumer_dependencies(synapse_tools_config, soa_dir=DEFAULT_SOA_DIR):
+    """Return the set of namespaces and services this host depends on, or
+    None if consumer scoping is not enabled or can't be applied."""
+    dependencies_file = synapse_tools_config.get('consumer_dependencies_file')
+    local_services = synapse_tools_config.get('consumer_local_services')
+    if dependencies_file is None and local_services is None:
+        return None
+
+    dependencies = set()
+    if dependencies_file is not None:
+        file_dependencies = load_dependencies_file(dependencies_file)
+        if file_dependencies is None:
+            log.warn('Not applying consumer scoping')
+            return None
+        dependencies |= file_dependencies
+    for service in local_services or []:
+        dependencies |= read_declared_dependencies(service, soa_dir)
+    if not dependencies:
+        log.warn('No consumer dependencies found, not applying consumer scoping')
+        return None
+    return dependencies
+
+
+def filter_services(services, dependencies):
+    """Return the (service.namespace, namespace_config) tuples whose namespace
+    or service appear in dependencies."""
+    return [
+        (service_name, service_info)
+        for (service_name, service_info) in services
+        if service_name in dependencies or
+        service_name.split('.', 1)[0] in dependencies
+    ]
+
+
+def scope_services(synapse_tools_config, services, soa_dir=DEFAULT_SOA_DIR):
+    """Apply consumer scoping to services if it is enabled, logging how many
+    services were dropped."""
+    dependencies = get_consumer_dependencies(synapse_tools_config, soa_dir)
+    if dependencies is None:
+        return services
+
+    scoped = filter_services(services, dependencies)
+    (kept, total) = (count_proxied(scoped), count_proxied(services))
+    log.info('Consumer scoping kept %d of %d proxied services (%d dropped)' % (
+        kept, total, total - kept))
+    return scoped
+
+
+def count_proxied(services):
+    return sum(
+        1 for (_, service_info) in services
+        if service_info.get('proxy_port') is not None)
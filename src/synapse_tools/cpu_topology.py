@@ -0,0 +1,110 @@
+"""Spread HAProxy across this host's CPUs.
+
+By default HAProxy runs as a single process on a single core.  The
+haproxy.nbproc and haproxy.nbthread options in synapse-tools.conf.json run it
+as several processes or threads instead; either may be "auto", meaning one
+per physical core.  Unless haproxy.cpu_map is false, each process or thread
+is pinned to its own CPU, preferring separate physical cores over
+hyperthread siblings.
+"""
+
+CPUINFO_PATH = '/proc/cpuinfo'
+
+
+def parse_cpuinfo(contents):
+    """Return a (cpu, physical package, core) tuple for each logical CPU
+    described by the contents of /proc/cpuinfo.  CPUs without topology
+    information (e.g. on some VMs) are treated as separate cores."""
+    topology = []
+    for block in contents.strip().split('\n\n'):
+        fields = {}
+        for line in block.splitlines():
+            (key, _, value) = line.partition(':')
+            fields[key.strip()] = value.strip()
+        if 'processor' not in fields:
+            continue
+        cpu = int(fields['processor'])
+        topology.append((
+            cpu,
+            int(fields.get('physical id', 0)),
+            int(fields.get('core id', cpu)),
+        ))
+    return topology
+
+
+def read_cpu_topology(path=CPUINFO_PATH):
+    with open(path) as fp:
+        return parse_cpuinfo(fp.read())
+
+
+def physical_core_count(topology):
+    return len(set((package, core) for (_, package, core) in topology))
+
+
+def spread_cpus(topology):
+    """Order CPUs so that the first thread of every physical core comes
+    before any of their hyperthread siblings."""
+    threads_seen = {}
+    ranked = []
+    for (cpu, package, core) in sorted(topology):
+        sibling = threads_seen.get((package, core), 0)
+        threads_seen[(package, core)] = sibling + 1
+        ranked.append((sibling, cpu))
+    return [cpu for (_, cpu) in sorted(ranked)]
+
+
+def _resolve_count(value, topology):
+    if value == 'auto':
+        return physical_core_count(topology)
+    return int(value)
+
+
+def haproxy_concurrency(synapse_tools_config, shard=None, read_topology=None):
+    """Return (nbproc, nbthread, global config lines) for HAProxy.  Each
+    shard is pinned to a different set of CPUs."""
+    if ('haproxy.nbproc' not in synapse_tools_config and
+            'haproxy.nbthread' not in synapse_tools_config):
+        return (1, 1, [])
+
+    topology = (read_topology or read_cpu_topology)()
+    processes = _resolve_count(
+        synapse_tools_config.get('haproxy.nbproc', 1), topology)
+    threads = _resolve_count(
+        synapse_tools_config.get('haproxy.nbthread', 1), topology)
+    if processes > 1 and threads > 1:
+        raise ValueError('haproxy.nbproc and haproxy.nbthread are mutually exclusive')
+
+    lines = []
+    if processes > 1:
+        lines.append('nbproc %d' % processes)
+    if threads > 1:
+        lines.append('nbthread %d' % threads)
+
+    count = max(processes, threads)
+    if count > 1 and synapse_tools_config.get('haproxy.cpu_map', True):
+        cpus = spread_cpus(topology)
+        offset = (shard or 0) * count
+        for i in range(count):
+            cpu = cpus[(offset + i) % len(cpus)]
+            if processes > 1:
+                lines.append('cpu-map %d %d' % (i + 1, cpu))
+            else:
+                lines.append('cpu-map 1/%d %d' % (i + 1, cpu))
+
+    return (processes, threads, lines)
+
+
+def stats_socket_lines(socket_path, processes, expose_fd=False):
+    """Each HAProxy process needs its own stats socket.  The first process
+    keeps socket_path, so that synapse and other tools can still find it.  If
+    expose_fd is set, the sockets will hand over listeners to a new HAProxy
+    during a seamless reload."""
+    options = 'level admin' + (' expose-fd listeners' if expose_fd else '')
+    if processes == 1:
+        return ['stats socket %s %s' % (socket_path, options)]
+    return [
+        'stats socket %s %s process 1' % (socket_path, options)
+    ] + [
+        'stats socket %s.%d %s process %d' % (socket_path, process, options, process)
+        for process in range(2, processes + 1)
+    ]
@@ -0,0 +1,80 @@
+"""Watch configuration files and directory trees for changes using inotify."""
+
+import logging
+import os
+import time
+
+import pyinotify
+
+
+log = logging.getLogger(__name__)
+
+# Events that indicate a file's contents may have changed.  Editors, puppet
+# and git all tend to replace files by renaming over them, so we watch the
+# containing directory for moves and creations as well as in-place writes.
+WATCH_MASK = (
+    pyinotify.IN_CLOSE_WRITE |
+    pyinotify.IN_CREATE |
+    pyinotify.IN_DELETE |
+    pyinotify.IN_MOVED_FROM |
+    pyinotify.IN_MOVED_TO
+)
+
+
+class FileWatcher(object):
+    """Collects inotify events and reports which of the watched paths have
+    changed."""
+
+    def __init__(self):
+        self.watch_manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(
+            self.watch_manager, default_proc_fun=self._process_event)
+        self._files = set()
+        self._trees = set()
+        self._changed = set()
+
+    def watch_file(self, path):
+        """Watch a single file.  The parent directory is watched so that the
+        file being replaced or recreated is noticed."""
+        path = os.path.abspath(path)
+        self._files.add(path)
+        self.watch_manager.add_watch(os.path.dirname(path), WATCH_MASK)
+
+    def watch_tree(self, path):
+        """Watch every file under a directory, including subdirectories that
+        are created later."""
+        path = os.path.abspath(path)
+        self._trees.add(path)
+        self.watch_manager.add_watch(path, WATCH_MASK, rec=True, auto_add=True)
+
+    def _process_event(self, event):
+        pathname = os.path.abspath(event.pathname)
+        if pathname in self._files:
+            self._changed.add(pathname)
+            return
+        for tree in self._trees:
+            if pathname == tree or pathname.startswith(tree + os.sep):
+                self._changed.add(tree)
+                return
+
+    def wait_for_changes(self, timeout_s, settle_s=0.1):
+        """Block for up to timeout_s waiting for a watched path to change.
+
+        Once something changes, keep collecting events until none have
+        arrived for settle_s, so that a push touching many files results in a
+        single regeneration.  Returns the set of watched paths (as passed to
+        watch_file or watch_tree) that changed.
+        """
+        deadline = time.time() + timeout_s
+        timeout_ms = timeout_s * 1000
+        while self.notifier.check_events(timeout=timeout_ms):
+            self.notifier.read_events()
+            self.notifier.process_events()
+            if self._changed:
+                timeout_ms = settle_s * 1000
+            else:
+                timeout_ms = max(0, deadline - time.time()) * 1000
+
+        changed = self._changed
+        self._changed = set()
+        return changed
@@ -0,0 +1,110 @@
+# -*- coding: utf8 -*-
+""" Manage our iptables rules in a single atomic transaction
+
+Rather than running iptables once per rule added or removed, the current
+rules are read with one iptables-save, the differences from the desired
+rules are worked out here, and all of them are applied with one
+iptables-restore --noflush.  The table is replaced in one commit, so there
+is no window where a rule being replaced is missing.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+
+from plumbum import local
+
+
+log = logging.getLogger(__name__)
+
+# Every rule we add is tagged with this comment, so that we know which rules
+# are ours to remove
+RULE_COMMENT = 'synapse_qdisc_tool'
+
+
+class RuleManager(object):
+    """ Keeps the rules tagged with our comment in one chain of one table
+    in sync with a list of desired rules.
+
+    Rules are compared in the form iptables-save prints them, which is what
+    rule() produces.  legacy_rules are rules we added before they were
+    tagged, which are also treated as ours.
+    """
+
+    def __init__(self, table='mangle', chain='OUTPUT', comment=RULE_COMMENT,
+                 legacy_rules=()):
+        self.table = table
+        self.chain = chain
+        self.comment = comment
+        self.legacy_rules = set(legacy_rules)
+
+    def rule(self, matches, target):
+        """ Return a rule as iptables-save prints it: the matches in the
+        order given, then our comment, then the target """
+        return '-A {0} {1} -m comment --comment {2} -j {3}'.format(
+            self.chain, matches, self.comment, target)
+
+    def is_managed(self, rule):
+        return (
+            '-m comment --comment {0} '.format(self.comment) in rule or
+            rule in self.legacy_rules
+        )
+
+    def current_rules(self):
+        """ Return the rules we manage that are currently installed """
+        output = local['iptables-save']('-t', self.table)
+        prefix = '-A {0} '.format(self.chain)
+        return [
+            line for line in output.splitlines()
+            if line.startswith(prefix) and self.is_managed(line)
+        ]
+
+    def plan(self, current, desired):
+        """ Return (rules to delete, rules to insert) to turn the managed
+        rules in current into desired, including any duplicates """
+        kept = set()
+        deletions = []
+        for rule in current:
+            if rule in desired and rule not in kept:
+                kept.add(rule)
+            else:
+                deletions.append(rule)
+        insertions = [rule for rule in desired if rule not in kept]
+        return (deletions, insertions)
+
+    def restore_input(self, deletions, insertions):
+        prefix = '-A {0} '.format(self.chain)
+        lines = ['*{0}'.format(self.table)]
+        lines.extend(
+            '-D {0} {1}'.format(self.chain, rule[len(prefix):])
+            for rule in deletions)
+        # Insert at the top of the chain, in the order given
+        lines.extend(
+            '-I {0} {1} {2}'.format(self.chain, position, rule[len(prefix):])
+            for (position, rule) in enumerate(insertions, 1))
+        lines.append('COMMIT')
+        return '\n'.join(lines) + '\n'
+
+    def sync(self, desired):
+        """ Make the managed rules match desired, in one transaction.  Does
+        nothing if they already match.
+
+        :returns: a list of the changes made, e.g. ['-A OUTPUT ...']
+        """
+        (deletions, insertions) = self.plan(self.current_rules(), desired)
+        if not deletions and not insertions:
+            log.info('iptables {0} {1} rules are up to date'.format(
+                self.table, self.chain))
+            return []
+
+        restore = local['iptables-restore']['--noflush']
+        (restore << self.restore_input(deletions, insertions))()
+
+        changes = (
+            ['-D' + rule[2:] for rule in deletions] +
+            ['-A' + rule[2:] for rule in insertions]
+        )
+        for change in changes:
+            log.info('iptables -t {0} {1}'.format(self.table, change))
+        return changes
@@ -0,0 +1,211 @@
+# -*- coding: utf8 -*-
+""" Record what each protected reload did to traffic on the plug lane
+
+protect appends one JSON line per reload to a metrics file: when traffic
+was plugged and unplugged, how long the wrapped command ran, and how many
+packets the plug queued and dropped.  The stats subcommand summarises the
+most recent of them, and the plug's limit for the next reload is sized from
+them.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import math
+import os
+
+from synapse_tools.atomic_file import write_atomically
+
+
+PLUG_METRICS_PATH = '/var/run/synapse/plug_metrics.jsonl'
+
+# Once the file grows past this size it is trimmed to its most recent
+# KEEP_RECORDS records
+MAX_FILE_BYTES = 1024 * 1024
+KEEP_RECORDS = 1000
+
+PERCENTILES = (50, 90, 99)
+
+# The plug qdisc's limit is in bytes of queued packets.  It is sized to hold
+# LIMIT_HEADROOM times the SYNs expected during the slowest of the last
+# RATE_WINDOW_RECORDS reloads, at the highest SYN rate seen over them.
+# Until then the plug keeps its current limit, which is the kernel's
+# tx_queue_len * MTU (around 64MB on lo) unless we have set one before.
+MIN_PLUG_LIMIT_BYTES = 10000
+MAX_PLUG_LIMIT_BYTES = 1024 * 1024
+RATE_WINDOW_RECORDS = 50
+LIMIT_HEADROOM = 2
+# Size of a SYN on lo, used until queued packets have been seen
+DEFAULT_SYN_BYTES = 80
+
+# The metrics summarised by the stats subcommand
+SUMMARY_FIELDS = (
+    'plug_duration_ms',
+    'command_runtime_ms',
+    'plug_backlog_bytes',
+    'plug_qlen',
+    'plug_drops',
+    'plug_limit_bytes',
+)
+
+
+def _counter_delta(before, after, field):
+    if not before or not after:
+        return None
+    if before.get(field) is None or after.get(field) is None:
+        return None
+    return after[field] - before[field]
+
+
+def _plugged_packets(before, after):
+    """ The qdisc's packet counter only counts packets as they're dequeued,
+    so it doesn't move while plugged.  Every packet which arrived while
+    plugged was instead either left queued or dropped. """
+    queued = _counter_delta(before, after, 'qlen')
+    dropped = _counter_delta(before, after, 'drops')
+    if queued is None or dropped is None:
+        return None
+    return queued + dropped
+
+
+def build_record(plug_start, plug_end, command_runtime_s, status_at_plug,
+                 status_at_unplug, returncode, plug_limit_bytes=None):
+    """ Build a metrics record for one protected command.
+
+    status_at_plug and status_at_unplug are PlugController.status() results,
+    read just after plugging and just before unplugging, or None if they
+    couldn't be read.  The qdisc's drop counter is cumulative, so the drops
+    for this reload are the difference between the two.
+    """
+    at_plug = status_at_plug or {}
+    at_unplug = status_at_unplug or {}
+    return {
+        'plug_start': plug_start,
+        'plug_end': plug_end,
+        'plug_duration_ms': (plug_end - plug_start) * 1000,
+        'command_runtime_ms': (
+            None if command_runtime_s is None else command_runtime_s * 1000),
+        'plug_backlog_bytes': at_unplug.get('backlog'),
+        'plug_qlen': at_unplug.get('qlen'),
+        'plug_packets': _plugged_packets(status_at_plug, status_at_unplug),
+        'plug_drops': _counter_delta(status_at_plug, status_at_unplug, 'drops'),
+        'plug_packets_total': at_plug.get('packets'),
+        'plug_limit_bytes': plug_limit_bytes,
+        'returncode': returncode,
+    }
+
+
+def read_records(path=PLUG_METRICS_PATH, limit=None):
+    """ Return the most recent limit records, oldest first.  Lines which
+    can't be parsed, e.g. one partly written, are skipped. """
+    records = []
+    try:
+        with open(path) as fp:
+            for line in fp:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except IOError:
+        return []
+    if limit is not None:
+        records = records[-limit:]
+    return records
+
+
+def append_record(record, path=PLUG_METRICS_PATH):
+    with open(path, 'a') as fp:
+        fp.write(json.dumps(record, sort_keys=True) + '\n')
+    if os.path.getsize(path) > MAX_FILE_BYTES:
+        records = read_records(path, limit=KEEP_RECORDS)
+        write_atomically(path, ''.join(
+            json.dumps(r, sort_keys=True) + '\n' for r in records))
+
+
+def syn_rates(records):
+    """ Return the SYN rates, per second, seen on the plug lane: during each
+    reload, from the packets the plug took, and between each pair of
+    consecutive reloads, from the packets the qdisc passed """
+    rates = []
+    for record in records:
+        if record.get('plug_packets') and record.get('plug_duration_ms'):
+            rates.append(
+                record['plug_packets'] / (record['plug_duration_ms'] / 1000))
+    for (before, after) in zip(records, records[1:]):
+        if (before.get('plug_packets_total') is None or
+                after.get('plug_packets_total') is None):
+            continue
+        elapsed_s = after['plug_start'] - before['plug_start']
+        packets = after['plug_packets_total'] - before['plug_packets_total']
+        # The counter restarts from 0 whenever the qdisc is recreated
+        if elapsed_s > 0 and packets >= 0:
+            rates.append(packets / elapsed_s)
+    return rates
+
+
+def syn_bytes(records):
+    """ The largest average size of the packets left queued in the plug """
+    sizes = [
+        record['plug_backlog_bytes'] / record['plug_qlen']
+        for record in records
+        if record.get('plug_qlen') and record.get('plug_backlog_bytes')
+    ]
+    return max(sizes) if sizes else DEFAULT_SYN_BYTES
+
+
+def adaptive_plug_limit(records, min_bytes=MIN_PLUG_LIMIT_BYTES,
+                        max_bytes=MAX_PLUG_LIMIT_BYTES):
+    """ Size the plug's limit in bytes from recent records, between
+    min_bytes and max_bytes.  Without enough history, returns None so the
+    plug's current limit is kept. """
+    recent = records[-RATE_WINDOW_RECORDS:]
+    rates = syn_rates(recent)
+    durations_s = [
+        record['plug_duration_ms'] / 1000 for record in recent
+        if record.get('plug_duration_ms') is not None
+    ]
+    if not rates or not durations_s:
+        return None
+    limit = int(math.ceil(
+        max(rates) * max(durations_s) * syn_bytes(recent) * LIMIT_HEADROOM))
+    return min(max(limit, min_bytes), max_bytes)
+
+
+def percentile(values, pct):
+    """ The nearest-rank percentile of a non-empty list of values """
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100 * len(ordered))) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+
+def summarize(records, fields=SUMMARY_FIELDS, percentiles=PERCENTILES):
+    """ Return, for each field, the percentiles and maximum of the records
+    which have a value for it """
+    summary = {}
+    for field in fields:
+        values = [r[field] for r in records if r.get(field) is not None]
+        if not values:
+            continue
+        stats = dict(
+            ('p%d' % pct, percentile(values, pct)) for pct in percentiles)
+        stats['max'] = max(values)
+        stats['count'] = len(values)
+        if field == 'plug_drops':
+            stats['overflows'] = sum(1 for value in values if value > 0)
+        summary[field] = stats
+    return summary
+
+
+def format_summary(summary, reloads, percentiles=PERCENTILES):
+    columns = ['p%d' % pct for pct in percentiles] + ['max']
+    lines = ['{0} reloads, {1} of which dropped packets'.format(
+        reloads, summary.get('plug_drops', {}).get('overflows', 0))]
+    lines.append('{0:<20}'.format('') + ''.join(
+        '{0:>12}'.format(column) for column in columns))
+    for field in SUMMARY_FIELDS:
+        if field not in summary:
+            continue
+        lines.append('{0:<20}'.format(field) + ''.join(
+            '{0:>12.1f}'.format(summary[field][column]) for column in columns))
+    return '\n'.join(lines)
@@ -4,19 +4,26 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import json
 import logging
 import os
 import subprocess
 import sys
+import time
 
 import argparse
 
+from synapse_tools.haproxy import plug_metrics
 from synapse_tools.haproxy.qdisc_util import check_setup
 from synapse_tools.haproxy.qdisc_util import clear
 from synapse_tools.haproxy.qdisc_util import manage_plug
 from synapse_tools.haproxy.qdisc_util import needs_setup
+from synapse_tools.haproxy.qdisc_util import PlugController
 from synapse_tools.haproxy.qdisc_util import setup
 from synapse_tools.haproxy.qdisc_util import stat
+from synapse_tools.haproxy.readiness import DEFAULT_TIMEOUT_S
+from synapse_tools.haproxy.readiness import wait_until_listening
+from synapse_tools.traffic_priority import PRIORITY_MAP_PATH
 from pwd import getpwnam
 
 
@@ -36,7 +43,7 @@ def stat_cmd(args):
 
 
 def check_setup_cmd(args):
-    return check_setup(INTERFACE_NAME)
+    return check_setup(INTERFACE_NAME, SOURCE_IP, args.priority_map)
 
 
 def manage_plug_cmd(args):
@@ -50,17 +57,27 @@ def manage_plug_cmd(args):
 
 
 def needs_setup_cmd(args):
-    return needs_setup(INTERFACE_NAME)
+    return needs_setup(INTERFACE_NAME, SOURCE_IP, args.priority_map)
 
 
 def setup_cmd(args):
-    return setup(INTERFACE_NAME, SOURCE_IP)
+    return setup(INTERFACE_NAME, SOURCE_IP, args.priority_map)
 
 
 def clear_cmd(args):
     return clear(INTERFACE_NAME, SOURCE_IP)
 
 
+def stats_cmd(args):
+    records = plug_metrics.read_records(args.metrics_file, limit=args.count)
+    if not records:
+        print('No reloads recorded in {0}'.format(args.metrics_file))
+        return 1
+    print(plug_metrics.format_summary(
+        plug_metrics.summarize(records), len(records)))
+    return 0
+
+
 def drop_perms():
     user = getpwnam(os.environ.get('SUDO_USER', 'nobody'))
     uid = user.pw_uid
@@ -71,33 +88,123 @@ def drop_perms():
     os.setuid(uid)
 
 
+def _plug_status(controller):
+    if controller is None:
+        return None
+    try:
+        return controller.status()
+    except:
+        log.exception('Failed to read the plug qdisc statistics')
+        return None
+
+
+def _record_metrics(metrics_file, record):
+    log.info('Plug metrics: {0}'.format(json.dumps(record, sort_keys=True)))
+    if metrics_file is None:
+        return
+    try:
+        plug_metrics.append_record(record, metrics_file)
+    except:
+        log.exception('Failed to record plug metrics in {0}'.format(
+            metrics_file))
+
+
+def _plug_limit(args):
+    """ Size the plug's limit from the SYN rates and reload durations
+    recorded for recent reloads """
+    try:
+        records = plug_metrics.read_records(args.metrics_file)
+    except:
+        log.exception('Failed to read plug metrics from {0}'.format(
+            args.metrics_file))
+        records = []
+    limit = plug_metrics.adaptive_plug_limit(
+        records, min_bytes=args.min_plug_limit_bytes,
+        max_bytes=args.max_plug_limit_bytes)
+    if limit is None:
+        log.info('Not enough plug metrics to size the plug limit, keeping '
+                 'its current limit')
+    else:
+        log.info('Plug limit is {0} bytes'.format(limit))
+    return limit
+
+
 def protect_call_cmd(args):
     if os.getuid() != 0:
         print('Only root can execute protected binaries')
         return 1
 
+    plug_limit_bytes = _plug_limit(args)
+    # One netlink socket is used for plugging and unplugging, so that
+    # unplugging is a single request once the command has finished
+    controller = None
+    status_at_plug = None
+    command_runtime_s = None
+    returncode = None
+    plug_start = time.time()
     try:
         try:
-            manage_plug(INTERFACE_NAME, enable_plug=True)
+            controller = PlugController(INTERFACE_NAME, plug_limit_bytes)
+            controller.plug()
         except:
             # If we fail to plug, it is no big deal, we might
             # drop some traffic but let's not fail to run the
             # command
             log.exception('Failed to enable plug')
-        subprocess.check_call(
-            [args.cmd] + args.args,
-            preexec_fn=drop_perms
-        )
+        status_at_plug = _plug_status(controller)
+        command_start = time.time()
+        try:
+            subprocess.check_call(
+                [args.cmd] + args.args,
+                preexec_fn=drop_perms
+            )
+            returncode = 0
+        except subprocess.CalledProcessError as e:
+            returncode = e.returncode
+            raise
+        finally:
+            command_runtime_s = time.time() - command_start
+        if args.wait_listening:
+            # Only unplug once the new haproxy can accept the queued SYNs
+            (pid_path, config_path) = args.wait_listening
+            try:
+                wait_until_listening(
+                    pid_path, config_path, timeout_s=args.listen_timeout_s)
+            except:
+                log.exception('Failed to check haproxy is listening')
     finally:
+        # Read just before unplugging, while SYNs are still queued
+        status_at_unplug = _plug_status(controller)
         # Netlink comms can be unreliable according to the manpage,
         # so do some retries to ensure we really turn off the plug
         # It would be really bad if we do not turn off the plug
         for i in range(3):
             try:
-                manage_plug(INTERFACE_NAME, enable_plug=False)
+                if controller is None:
+                    controller = PlugController(INTERFACE_NAME, plug_limit_bytes)
+                controller.unplug()
                 break
             except:
                 log.exception('Failed to disable plug, try #%d' % i)
+        plug_end = time.time()
+        log.info('Traffic was plugged for {0:.1f}ms'.format(
+            (plug_end - plug_start) * 1000))
+        record = plug_metrics.build_record(
+            plug_start, plug_end, command_runtime_s,
+            status_at_plug, status_at_unplug, returncode,
+            plug_limit_bytes=plug_limit_bytes)
+        if record['plug_drops']:
+            log.warn('The plug overflowed its {0} limit, dropping {1} '
+                     'SYNs'.format(
+                         'current' if plug_limit_bytes is None
+                         else '{0} byte'.format(plug_limit_bytes),
+                         record['plug_drops']))
+        _record_metrics(args.metrics_file, record)
+        if controller is not None:
+            log.info('Netlink requests: {0}'.format(', '.join(
+                '{0} {1:.3f}ms'.format(name, duration * 1000)
+                for (name, duration) in controller.timings)))
+            controller.close()
 
 
 def parse_options():
@@ -120,9 +227,16 @@ def parse_options():
     needs_setup_parser.set_defaults(func=needs_setup_cmd)
 
     setup_parser = subparsers.add_parser(
-        'setup', help='Setup the qdisc')
+        'setup', help='Setup the qdisc, or update the iptables rules if it '
+                      'is already set up')
     setup_parser.set_defaults(func=setup_cmd)
 
+    for subparser in (check_parser, needs_setup_parser, setup_parser):
+        subparser.add_argument(
+            '--priority-map', default=PRIORITY_MAP_PATH,
+            help='Ports of services with a priority, as written by '
+                 'configure_synapse (default: %(default)s)')
+
     clear_parser = subparsers.add_parser(
         'clear', help='Clear the qdisc and iptables')
     clear_parser.set_defaults(func=clear_cmd)
@@ -136,12 +250,47 @@ def parse_options():
 
     protect_parser = subparsers.add_parser(
         'protect', help='Run a command while network traffic is blocked')
+    protect_parser.add_argument(
+        '--wait-listening', nargs=2, metavar=('PID_FILE', 'HAPROXY_CONFIG'),
+        help='After the command exits, wait until the haproxy processes in '
+             'PID_FILE are listening on every port bound in HAPROXY_CONFIG '
+             'before unplugging')
+    protect_parser.add_argument(
+        '--listen-timeout-s', type=float, default=DEFAULT_TIMEOUT_S,
+        help='Maximum time to wait with --wait-listening '
+             '(default: %(default)s)')
+    protect_parser.add_argument(
+        '--metrics-file', default=plug_metrics.PLUG_METRICS_PATH,
+        help='Append plug metrics for this run to this file '
+             '(default: %(default)s)')
+    protect_parser.add_argument(
+        '--min-plug-limit-bytes', type=int,
+        default=plug_metrics.MIN_PLUG_LIMIT_BYTES,
+        help='Smallest limit on the bytes queued while plugged '
+             '(default: %(default)s)')
+    protect_parser.add_argument(
+        '--max-plug-limit-bytes', type=int,
+        default=plug_metrics.MAX_PLUG_LIMIT_BYTES,
+        help='Largest limit on the bytes queued while plugged; the limit is '
+             'sized between the two from the SYN rates and reload durations '
+             'in --metrics-file (default: %(default)s)')
     protect_parser.add_argument(
         dest='cmd', help='Command to run while traffic is blocked')
     protect_parser.add_argument(
         'args', nargs=argparse.REMAINDER)
     protect_parser.set_defaults(func=protect_call_cmd)
 
+    stats_parser = subparsers.add_parser(
+        'stats', help='Show percentiles of plug metrics for recent reloads')
+    stats_parser.add_argument(
+        '--metrics-file', default=plug_metrics.PLUG_METRICS_PATH,
+        help='File written by protect (default: %(default)s)')
+    stats_parser.add_argument(
+        '--count', type=int, default=100,
+        help='How many of the most recent reloads to summarise '
+             '(default: %(default)s)')
+    stats_parser.set_defaults(func=stats_cmd)
+
     return parser.parse_args()
 
 
@@ -4,11 +4,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import json
 import logging
 import struct
+import time
 
-from plumbum.cmd import grep
-from plumbum.cmd import iptables
+from plumbum import local
 from plumbum.cmd import tc
 
 import pyroute2
@@ -18,56 +19,97 @@ from pyroute2.netlink import NLM_F_ACK
 from pyroute2.netlink import NLM_F_REQUEST
 from pyroute2.netlink.rtnl.tcmsg import tcmsg
 
+from synapse_tools.haproxy.iptables_rules import RuleManager
+from synapse_tools.traffic_priority import PRIORITY_MAP_PATH
+from synapse_tools.traffic_priority import read_priority_map
+
 
 log = logging.getLogger(__name__)
 
 
 def stat(interface_name):
     """ Show status of existing qdisc and iptables rules """
-    for tc_type in ('qdisc', 'class', 'filter'):
-        print('=' * 20 + ' tc {0} '.format(tc_type) + '=' * 20)
-        print(tc['-s', tc_type, 'show', 'dev', interface_name]())
+    print('=' * 20 + ' tc setup ' + '=' * 20)
+    print(json.dumps(describe_setup(interface_name), indent=4, sort_keys=True))
 
     print('=' * 20 + ' iptables rules ' + '=' * 20)
-    print(iptables['-L', '-t', 'mangle']())
+    print(local['iptables-save']('-t', 'mangle'))
     return 0
 
 
-def check_setup(interface_name):
-    """ Checks the existing qdisc and iptables rules """
-    tc_cmd = tc['-s', 'qdisc', 'show', 'dev', interface_name]
-    tc_grep_cmd = grep['qdisc']
-    tc_chain = (tc_cmd | tc_grep_cmd)
-
-    iptables_cmd = iptables['-L', '-t', 'mangle']
-    iptables_grep_cmd = grep['MARK xset 0x' + IPTABLES_MARK]
-    iptables_chain = (iptables_cmd | iptables_grep_cmd)
-
-    tc_run = tc_chain.run(retcode=None)
-    iptables_run = iptables_chain.run(retcode=None)
+def check_setup(interface_name, source_ip=None,
+                priority_map_path=PRIORITY_MAP_PATH):
+    """ Checks the existing qdisc and iptables rules
 
-    if tc_run[0] != 0 or iptables_run[0] != 0:
+    The qdiscs and filters are read over netlink; only iptables-save needs
+    a command to be run.  If source_ip is given, the iptables rules are also
+    compared with the ones setup would sync to the priority map, so that a
+    changed map is reported until setup is rerun.  iptables-save is only run
+    once either way.
+    """
+    description = describe_setup(interface_name)
+    problems = find_setup_problems(description)
+    manager = syn_mark_rule_manager(source_ip)
+    current_rules = _current_iptables_rules(manager)
+    has_mark = _has_iptables_mark(current_rules)
+
+    our_handles = set(EXPECTED_QDISCS)
+    if not has_mark and not any(
+            qdisc['handle'] in our_handles for qdisc in description['qdiscs']):
         log.info('No existing setup for {0}'.format(interface_name))
         return 1
 
-    tc_result = tc_run[1].count('\n')
-    iptables_result = iptables_run[1].count('\n')
-
-    if tc_result == 5 and iptables_result > 0:
-        log.info('Expected setup exists for {0}'.format(interface_name))
-    else:
-        log.error('An unexpected setup exists for {0}'.format(interface_name))
+    if not has_mark:
+        problems.append('no iptables rule marking SYNs')
+    elif source_ip is not None:
+        problems.extend(_iptables_rule_problems(
+            manager, current_rules, interface_name, source_ip,
+            priority_map_path))
+    if problems:
+        log.error('An unexpected setup exists for {0}: {1}'.format(
+            interface_name, '; '.join(problems)))
         return 2
+
+    log.info('Expected setup exists for {0}'.format(interface_name))
     return 0
 
 
-def needs_setup(interface_name):
+def needs_setup(interface_name, source_ip=None,
+                priority_map_path=PRIORITY_MAP_PATH):
     """ Checks if there are no existing qdisc and iptables rules """
-    check_result = check_setup(interface_name)
+    check_result = check_setup(interface_name, source_ip, priority_map_path)
     if check_result == 0:
         return 1
     return 0
 
+
+def _current_iptables_rules(manager):
+    """ Return the rules manager manages, or None if they can't be read """
+    try:
+        return manager.current_rules()
+    except Exception:
+        log.exception('Could not read the iptables rules')
+        return None
+
+
+def _has_iptables_mark(current_rules):
+    if current_rules is None:
+        return False
+    target = '-j MARK --set-xmark {0}'.format(IPTABLES_SET_XMARK)
+    return any(rule.endswith(target) for rule in current_rules)
+
+
+def _iptables_rule_problems(manager, current_rules, interface_name, source_ip,
+                            priority_map_path):
+    desired = desired_iptables_rules(
+        manager, source_ip, interface_name,
+        read_priority_map(priority_map_path))
+    (deletions, insertions) = manager.plan(current_rules, desired)
+    if not deletions and not insertions:
+        return []
+    return ['iptables rules are out of date with {0} ({1} to delete, {2} to '
+            'add)'.format(priority_map_path, len(deletions), len(insertions))]
+
 """
 Create a traffic control setup as follows
            1: root qdisc
@@ -84,6 +126,12 @@ This in combination with an iptables rule allows us to
 redirect SYN packets to the plug during a restart of a
 process sensitivew to that (e.g. haproxy), and then
 unplug later
+
+Other traffic to and from the proxy ports of services with a
+priority is marked to go to the matching prio band, and
+everything else goes to the bands chosen by the prio qdisc's
+default priomap (1 2 2 2 1 2 0 0 1 1 1 1 1 1 1 1).  That puts
+best effort traffic in 1:2, between the two priorities
 """
 ROOT = '1:'
 PRIO_CLASS_FASTEST = '1:1'
@@ -95,6 +143,125 @@ PRIO_QDISC_FAST = '20:'
 PRIO_QDISC_SLOW = '30:'
 PLUG_QDISC = '40:'
 IPTABLES_MARK = '1'
+# How iptables-save prints --set-mark IPTABLES_MARK
+IPTABLES_SET_XMARK = '0x{0:x}/0xffffffff'.format(int(IPTABLES_MARK))
+# The iptables mark and prio class for each service priority
+PRIORITY_MARKS = {
+    'fastest': (2, PRIO_CLASS_FASTEST),
+    'slow': (4, PRIO_CLASS_SLOW),
+}
+# The most ports the multiport match takes in one rule
+MULTIPORT_MAX_PORTS = 15
+
+# The expected parent and kinds of each qdisc.  If we can't create a plug
+# because of an older kernel, it is a fifo instead.
+EXPECTED_QDISCS = {
+    ROOT: ('root', ('prio',)),
+    PRIO_QDISC_FASTEST: (PRIO_CLASS_FASTEST, ('pfifo',)),
+    PRIO_QDISC_FAST: (PRIO_CLASS_FAST, ('pfifo',)),
+    PRIO_QDISC_SLOW: (PRIO_CLASS_SLOW, ('pfifo',)),
+    PLUG_QDISC: (PLUG_CLASS, ('plug', 'pfifo')),
+}
+# The expected (kind, handle, classid) of each filter on the root qdisc
+EXPECTED_FILTERS = [
+    ('fw', int(IPTABLES_MARK), PLUG_CLASS),
+] + sorted(('fw', mark, classid) for (mark, classid) in PRIORITY_MARKS.values())
+
+TC_H_ROOT = 0xFFFFFFFF
+
+
+def format_handle(handle):
+    """ Format a qdisc or class handle the way tc does, e.g. 0x10004 is
+    '1:4' and 0x10000 is '1:' """
+    if handle == TC_H_ROOT:
+        return 'root'
+    (major, minor) = (handle >> 16, handle & 0xFFFF)
+    if minor == 0:
+        return '{0:x}:'.format(major)
+    return '{0:x}:{1:x}'.format(major, minor)
+
+
+def queue_stats(msg):
+    """ Return the queue statistics of a qdisc or class message """
+    stats = msg.get_attr('TCA_STATS') or {}
+    return {
+        'packets': stats.get('packets'),
+        'drops': stats.get('drop'),
+        'overlimits': stats.get('overlimits'),
+        'qlen': stats.get('qlen'),
+        'backlog': stats.get('backlog'),
+    }
+
+
+def describe_setup(interface_name):
+    """ Describe the qdiscs, classes and filters on interface_name, read
+    over netlink rather than parsed from tc's output """
+    ip = IPRoute()
+    try:
+        index = ip.link_lookup(ifname=interface_name)[0]
+        qdiscs = ip.get_qdiscs(index=index)
+        classes = ip.get_classes(index=index)
+        filters = ip.get_filters(index=index, parent=transform_handle(ROOT))
+    finally:
+        ip.close()
+
+    description = {
+        'interface': interface_name,
+        'qdiscs': [
+            dict(queue_stats(msg),
+                 handle=format_handle(msg['handle']),
+                 parent=format_handle(msg['parent']),
+                 kind=msg.get_attr('TCA_KIND'))
+            for msg in qdiscs
+        ],
+        'classes': [
+            dict(queue_stats(msg),
+                 handle=format_handle(msg['handle']),
+                 parent=format_handle(msg['parent']),
+                 kind=msg.get_attr('TCA_KIND'))
+            for msg in classes
+        ],
+        'filters': [],
+        'plug': None,
+    }
+    for msg in filters:
+        # Each filter priority has a header without options; only the
+        # filters themselves are interesting
+        options = msg.get_attr('TCA_OPTIONS')
+        if options is None:
+            continue
+        classid = options.get_attr('TCA_FW_CLASSID')
+        description['filters'].append({
+            'kind': msg.get_attr('TCA_KIND'),
+            'handle': msg['handle'],
+            'classid': None if classid is None else format_handle(classid),
+        })
+    for qdisc in description['qdiscs']:
+        if qdisc['handle'] == PLUG_QDISC:
+            description['plug'] = qdisc
+    return description
+
+
+def find_setup_problems(description):
+    """ Compare a description from describe_setup with the expected
+    topology, returning a list of differences """
+    problems = []
+    qdiscs = dict((qdisc['handle'], qdisc) for qdisc in description['qdiscs'])
+    for (handle, (parent, kinds)) in sorted(EXPECTED_QDISCS.items()):
+        qdisc = qdiscs.get(handle)
+        if qdisc is None:
+            problems.append('qdisc {0} is missing'.format(handle))
+        elif qdisc['parent'] != parent or qdisc['kind'] not in kinds:
+            problems.append('qdisc {0} is {1} under {2}, expected {3} under {4}'.format(
+                handle, qdisc['kind'], qdisc['parent'], '/'.join(kinds), parent))
+
+    filters = [
+        (f['kind'], f['handle'], f['classid']) for f in description['filters']
+    ]
+    for expected in EXPECTED_FILTERS:
+        if expected not in filters:
+            problems.append('filter {0} is missing'.format(expected))
+    return problems
 
 
 def _apply_tc_rules(interface_name):
@@ -129,35 +296,88 @@ def _apply_tc_rules(interface_name):
     tc['filter', 'add', 'dev', interface_name,
        'protocol', 'ip', 'parent', ROOT, 'prio', '1',
        'handle', IPTABLES_MARK, 'fw', 'classid', PLUG_CLASS]()
+    for (mark, classid) in sorted(PRIORITY_MARKS.values()):
+        tc['filter', 'add', 'dev', interface_name,
+           'protocol', 'ip', 'parent', ROOT, 'prio', '2',
+           'handle', str(mark), 'fw', 'classid', classid]()
     # Ensure the device is unplugged by default
     manage_plug(interface_name, enable_plug=False)
 
 
-def _apply_iptables_rule(source_ip):
-    log.info('Creating iptables rule to mark outgoing syns on {0}'.format(
-        source_ip))
-    iptables[
-        '-t', 'mangle', '-I', 'OUTPUT', '-p', 'tcp',
-        '-s', source_ip, '--syn', '-j', 'MARK', '--set-mark', IPTABLES_MARK
-    ]()
-
-
-def setup(interface_name, source_ip):
+def syn_mark_rule_manager(source_ip=None):
+    """ Return a RuleManager for our mangle rules.  A rule marking SYNs from
+    source_ip added before our rules were tagged is also managed. """
+    legacy_rules = []
+    if source_ip is not None:
+        legacy_rules.append(
+            '-A OUTPUT -s {0}/32 -p tcp -m tcp --tcp-flags FIN,SYN,RST,ACK SYN '
+            '-j MARK --set-xmark {1}'.format(source_ip, IPTABLES_SET_XMARK))
+    return RuleManager(table='mangle', chain='OUTPUT', legacy_rules=legacy_rules)
+
+
+def priority_rules(manager, interface_name, port_priorities):
+    """ The mangle rules marking traffic to and from the ports of services
+    with a priority, so the fw filters send it to their band.  SYNs are
+    left alone, so that they still go through the plug lane. """
+    rules = []
+    for priority in sorted(PRIORITY_MARKS):
+        ports = sorted(
+            port for (port, port_priority) in port_priorities.items()
+            if port_priority == priority)
+        (mark, _) = PRIORITY_MARKS[priority]
+        for start in range(0, len(ports), MULTIPORT_MAX_PORTS):
+            port_list = ','.join(
+                str(port) for port in ports[start:start + MULTIPORT_MAX_PORTS])
+            for direction in ('--dports', '--sports'):
+                rules.append(manager.rule(
+                    '-o {0} -p tcp -m multiport {1} {2} '
+                    '-m tcp ! --tcp-flags FIN,SYN,RST,ACK SYN'.format(
+                        interface_name, direction, port_list),
+                    'MARK --set-xmark 0x{0:x}/0xffffffff'.format(mark)))
+    return rules
+
+
+def desired_iptables_rules(manager, source_ip, interface_name='lo',
+                           port_priorities=None):
+    """ The mangle rules marking outgoing SYNs from source_ip, which the fw
+    filter sends to the plug lane, and traffic of services with a priority """
+    return [
+        manager.rule(
+            '-s {0}/32 -p tcp -m tcp --tcp-flags FIN,SYN,RST,ACK SYN'.format(
+                source_ip),
+            'MARK --set-xmark {0}'.format(IPTABLES_SET_XMARK)),
+    ] + priority_rules(manager, interface_name, port_priorities or {})
+
+
+def _apply_iptables_rule(interface_name, source_ip, priority_map_path):
+    port_priorities = read_priority_map(priority_map_path)
+    log.info('Syncing iptables rules to mark outgoing syns on {0} and traffic '
+             'on {1} prioritized ports'.format(source_ip, len(port_priorities)))
+    manager = syn_mark_rule_manager(source_ip)
+    return manager.sync(desired_iptables_rules(
+        manager, source_ip, interface_name, port_priorities))
+
+
+def setup(interface_name, source_ip, priority_map_path=PRIORITY_MAP_PATH):
     """ Sets up qdisc and iptables rules on the provided devices
 
     This effectively creates a normal prio qdisc with an extra plug lane.
     The plug lane always gets traffic based on iptables marks.
     The extra lane can be plugged or unplugged using manage_plug.
+
+    The iptables rules are brought up to date with the priority map even if
+    the qdiscs are already set up, so this can be rerun when it changes.
     """
+    # Only the qdiscs and the SYN mark are checked here, so that a changed
+    # priority map doesn't clear the qdiscs
     status = check_setup(interface_name)
     if status != 0:
         log.info('Clearing any existing config before attempting setup')
         clear(interface_name, source_ip)
+        _apply_tc_rules(interface_name)
     else:
-        log.info('Doing nothing')
-        return 0
-    _apply_tc_rules(interface_name)
-    _apply_iptables_rule(source_ip)
+        log.info('The qdiscs are already set up')
+    _apply_iptables_rule(interface_name, source_ip, priority_map_path)
     return 0
 
 
@@ -167,69 +387,131 @@ def clear(interface_name, source_ip):
     except:
         pass
 
-    # Ensure all iptables rules are purged on the output device
-    while True:
-        try:
-            iptables[
-                '-t', 'mangle', '-D', 'OUTPUT', '-p', 'tcp',
-                '-s', source_ip, '--syn', '-j',
-                'MARK', '--set-mark', IPTABLES_MARK
-            ]()
-        except:
-            break
+    # Remove all of our iptables rules, including any duplicates, at once
+    syn_mark_rule_manager(source_ip).sync([])
+
+
+# See the linux source at include/uapi/linux/pkt_sched.h
+TCQ_PLUG_BUFFER = 0
+TCQ_PLUG_RELEASE_ONE = 1
+TCQ_PLUG_RELEASE_INDEFINITE = 2
+TCQ_PLUG_LIMIT = 3
+
 
+class PlugController(object):
+    """ Plugs and unplugs the plug lane over a single netlink socket
 
-def _manage_plug_via_netlink(interface_name, action='unplug'):
-    """ Manipulates the plug qdisc via netlink
+    The interface index and qdisc handles are resolved once, so that each
+    plug or unplug only sends netlink requests.  How long each request took
+    is recorded in timings, and how long traffic was last plugged for in
+    plug_duration_s.
+
+    If packet_limit is given, the plug qdisc's limit is set to it before
+    each plug.  Despite the name, the limit is in bytes rather than packets
+    (see struct tc_plug_qopt).  Otherwise the qdisc keeps its current limit,
+    which the kernel sets to the device's tx_queue_len times its MTU when
+    the qdisc is created.
 
     FIXME: Once we have a modern userpace, replace this with appropriate
     calls to nl-qdisc-add
     """
-    ip = IPRoute()
-    index = ip.link_lookup(ifname=interface_name)[0]
-    # See the linux source at include/uapi/linux/pkt_sched.h
-    # #define TCQ_PLUG_BUFFER                0
-    # #define TCQ_PLUG_RELEASE_ONE           1
-    # #define TCQ_PLUG_RELEASE_INDEFINITE    2
-    # #define TCQ_PLUG_LIMIT                 3
-    action = {'unplug': 2, 'plug': 0}[action]
-    packet_limit = 10000
-    handle = transform_handle(PLUG_QDISC)
-    parent = transform_handle(PLUG_CLASS)
-    flags = NLM_F_REQUEST | NLM_F_ACK
-    command = pyroute2.netlink.rtnl.RTM_NEWQDISC
-    # This is a bit of magic sauce, inspired by xen's remus project
-    opts = struct.pack('iI', action, packet_limit)
-
-    msg = tcmsg()
-    msg['index'] = index
-    msg['handle'] = handle
-    msg['parent'] = parent
-    msg['attrs'] = [['TCA_KIND', 'plug']]
-    msg['attrs'].append(['TCA_OPTIONS', opts])
-    try:
-        nlm_response = ip.nlm_request(msg, msg_type=command, msg_flags=flags)
-    except pyroute2.netlink.NetlinkError as nle:
-        if nle.code == 22:
-            # This is an old kernel and we're talking to a qfifo, chill
-            log.warn('Detected a non plug qdisc, likely due to an old kernel. '
-                     'If you wish to have zero downtime haproxy restarts, '
-                     'upgrade your kernel. '
-                     'Doing nothing to the SYN traffic lane...')
-            return
-        else:
-            raise
 
-    # As per the netlink manpage (man 7 netlink), we expect an
-    # acknowledgment as a NLMSG_ERROR packet with the error field being 0,
-    # which it looks like pyroute2 treats as None. Really we want it to be
-    # non negative.
-    if not(len(nlm_response) > 0 and
-           nlm_response[0]['event'] == 'NLMSG_ERROR' and
-           nlm_response[0]['header']['error'] is None):
-        raise RuntimeError(
-            'Had an error while communicating with netlink: {0}'.format(
-                nlm_response))
+    def __init__(self, interface_name, packet_limit=None):
+        self.interface_name = interface_name
+        self.packet_limit = packet_limit
+        self.ip = IPRoute()
+        try:
+            self.index = self.ip.link_lookup(ifname=interface_name)[0]
+        except:
+            self.ip.close()
+            raise
+        self.handle = transform_handle(PLUG_QDISC)
+        self.parent = transform_handle(PLUG_CLASS)
+        self.timings = []
+        self.plugged_at = None
+        self.plug_duration_s = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.ip.close()
+
+    def plug(self):
+        """ Start queueing traffic on the plug lane """
+        # The plug qdisc only changes its limit on a TCQ_PLUG_LIMIT request,
+        # and ignores the one sent with TCQ_PLUG_BUFFER
+        if self.packet_limit is not None:
+            self._request('limit', TCQ_PLUG_LIMIT)
+        self._request('plug', TCQ_PLUG_BUFFER)
+        self.plugged_at = time.time()
+
+    def unplug(self):
+        """ Release queued traffic, and let traffic flow normally """
+        self._request('unplug', TCQ_PLUG_RELEASE_INDEFINITE)
+        if self.plugged_at is not None:
+            self.plug_duration_s = time.time() - self.plugged_at
+            self.plugged_at = None
+
+    def status(self):
+        """ Return the plug qdisc's kind and queue statistics, or None if it
+        doesn't exist """
+        for qdisc in self.ip.get_qdiscs(index=self.index):
+            if qdisc['handle'] != self.handle:
+                continue
+            return dict(
+                queue_stats(qdisc),
+                kind=qdisc.get_attr('TCA_KIND'),
+                plugged=self.plugged_at is not None,
+            )
+        return None
+
+    def _request(self, name, action):
+        start = time.time()
+        try:
+            self._send_plug_options(action)
+        finally:
+            self.timings.append((name, time.time() - start))
+
+    def _send_plug_options(self, action):
+        flags = NLM_F_REQUEST | NLM_F_ACK
+        command = pyroute2.netlink.rtnl.RTM_NEWQDISC
+        # This is a bit of magic sauce, inspired by xen's remus project
+        opts = struct.pack('iI', action, self.packet_limit or 0)
+
+        msg = tcmsg()
+        msg['index'] = self.index
+        msg['handle'] = self.handle
+        msg['parent'] = self.parent
+        msg['attrs'] = [['TCA_KIND', 'plug']]
+        msg['attrs'].append(['TCA_OPTIONS', opts])
+        try:
+            nlm_response = self.ip.nlm_request(
+                msg, msg_type=command, msg_flags=flags)
+        except pyroute2.netlink.NetlinkError as nle:
+            if nle.code == 22:
+                # This is an old kernel and we're talking to a qfifo, chill
+                log.warn('Detected a non plug qdisc, likely due to an old kernel. '
+                         'If you wish to have zero downtime haproxy restarts, '
+                         'upgrade your kernel. '
+                         'Doing nothing to the SYN traffic lane...')
+                return
+            else:
+                raise
+
+        # As per the netlink manpage (man 7 netlink), we expect an
+        # acknowledgment as a NLMSG_ERROR packet with the error field being 0,
+        # which it looks like pyroute2 treats as None. Really we want it to be
+        # non negative.
+        if not(len(nlm_response) > 0 and
+               nlm_response[0]['event'] == 'NLMSG_ERROR' and
+               nlm_response[0]['header']['error'] is None):
+            raise RuntimeError(
+                'Had an error while communicating with netlink: {0}'.format(
+                    nlm_response))
 
 
 def manage_plug(interface, enable_plug):
@@ -238,12 +520,13 @@ def manage_plug(interface, enable_plug):
     Note that when enable_plug is True, traffic is queued, and when
     enable_plug is False, traffic flows normally.
     """
-    if enable_plug:
-        log.info('Plugging traffic on the plug lane ...')
-        _manage_plug_via_netlink(interface, 'plug')
-        log.info('Done.')
-    else:
-        log.info('Unplugging traffic on the plug lane ...')
-        _manage_plug_via_netlink(interface, 'unplug')
-        log.info('Done.')
+    with PlugController(interface) as controller:
+        if enable_plug:
+            log.info('Plugging traffic on the plug lane ...')
+            controller.plug()
+            log.info('Done.')
+        else:
+            log.info('Unplugging traffic on the plug lane ...')
+            controller.unplug()
+            log.info('Done.')
     return 0
@@ -0,0 +1,137 @@
+# -*- coding: utf8 -*-
+""" Wait for a newly started haproxy to be listening on all its ports
+
+haproxy binds every listener, including its stats sockets, before it starts
+serving any of them.  So once the new haproxy answers `show info` on each of
+its stats sockets, it is listening on every port.  That takes one round trip
+per process, however many ports it binds.  Configs without a stats socket
+fall back to looking for each bound port among the processes' listening
+sockets, which means walking all their file descriptors.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import re
+import socket
+import time
+
+import psutil
+
+from synapse_tools.haproxy.server_state import query_socket
+
+
+log = logging.getLogger(__name__)
+
+# Matches e.g. "bind 0.0.0.0:1234", "bind :3212" and "bind *:80 ssl ..."
+BIND_RE = re.compile(r'^\s*bind\s+\S*:(\d+)\b')
+# Matches e.g. "stats socket /var/run/synapse/haproxy.sock level admin"
+STATS_SOCKET_RE = re.compile(r'^\s*stats\s+socket\s+(/\S+)')
+SHOW_INFO_PID_RE = re.compile(r'^Pid:\s*(\d+)\s*$', re.MULTILINE)
+
+DEFAULT_TIMEOUT_S = 1.0
+POLL_INTERVAL_S = 0.001
+
+
+def parse_bind_ports(config_path):
+    """ Return the set of TCP ports bound by an haproxy config file """
+    ports = set()
+    with open(config_path) as fp:
+        for line in fp:
+            match = BIND_RE.match(line)
+            if match is not None:
+                ports.add(int(match.group(1)))
+    return ports
+
+
+def parse_stats_sockets(config_path):
+    """ Return the set of unix stats socket paths in an haproxy config file """
+    paths = set()
+    with open(config_path) as fp:
+        for line in fp:
+            match = STATS_SOCKET_RE.match(line)
+            if match is not None:
+                paths.add(match.group(1))
+    return paths
+
+
+def read_pids(pid_path):
+    """ haproxy writes one pid per line, one for each process """
+    with open(pid_path) as fp:
+        return [int(line) for line in fp.read().split()]
+
+
+def stats_socket_pid(socket_path, timeout_s):
+    """ Return the pid of the haproxy process answering on socket_path, or
+    None if none does """
+    try:
+        info = query_socket(socket_path, 'show info', timeout_s=timeout_s)
+    except socket.error:
+        return None
+    match = SHOW_INFO_PID_RE.search(info)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def listening_ports(pids):
+    ports = set()
+    for pid in pids:
+        try:
+            connections = psutil.Process(pid).connections(kind='tcp')
+        except psutil.NoSuchProcess:
+            continue
+        ports.update(
+            connection.laddr[1] for connection in connections
+            if connection.status == psutil.CONN_LISTEN
+        )
+    return ports
+
+
+def wait_until_listening(pid_path, config_path, timeout_s=DEFAULT_TIMEOUT_S,
+                         poll_interval_s=POLL_INTERVAL_S):
+    """ Wait until the haproxy processes in pid_path are listening on every
+    port bound in config_path, or timeout_s has passed.
+
+    :returns: True if they are all listening
+    """
+    start = time.time()
+    pids = read_pids(pid_path)
+    expected = parse_stats_sockets(config_path)
+    if expected:
+        what = 'stats sockets'
+
+        def check(pending):
+            remaining_s = max(timeout_s - (time.time() - start), POLL_INTERVAL_S)
+            return set(
+                path for path in pending
+                if stats_socket_pid(path, remaining_s) in pids)
+    else:
+        what = 'ports'
+        expected = parse_bind_ports(config_path)
+
+        def check(pending):
+            return listening_ports(pids)
+
+    (ready, checks, check_s) = (set(), 0, 0)
+    while True:
+        check_start = time.time()
+        ready |= check(expected - ready)
+        checks += 1
+        check_s += time.time() - check_start
+
+        missing = expected - ready
+        if not missing:
+            log.info('haproxy {0} listening on {1} {2} after {3:.1f}ms '
+                     '({4} checks taking {5:.1f}ms)'.format(
+                         pids, len(expected), what, (time.time() - start) * 1000,
+                         checks, check_s * 1000))
+            return True
+        if time.time() - start >= timeout_s:
+            log.warn('haproxy {0} still not listening on {1} {2} after '
+                     '{3:.1f}ms ({4} checks taking {5:.1f}ms), giving up'.format(
+                         pids, len(missing), what, (time.time() - start) * 1000,
+                         checks, check_s * 1000))
+            return False
+        time.sleep(poll_interval_s)
@@ -0,0 +1,93 @@
+""" Save haproxy's server state so that a reloaded haproxy can pick it up.
+
+Run by the reload command just before the new haproxy is started.  The new
+haproxy reads the state file named by its server-state-file directive, so
+servers keep their health check state across the reload rather than all
+starting at their defaults.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import errno
+import logging
+import os
+import socket
+import sys
+
+import argparse
+
+from synapse_tools.atomic_file import write_atomically
+
+
+log = logging.getLogger(__name__)
+
+SOCKET_TIMEOUT_S = 5
+
+LOG_FORMAT = '%(levelname)s %(message)s'
+
+
+def query_socket(socket_path, command, timeout_s=SOCKET_TIMEOUT_S):
+    """Send a command to haproxy's stats socket and return its response."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout_s)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(command + '\n')
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return ''.join(chunks)
+    finally:
+        sock.close()
+
+
+def remove_state_file(state_path):
+    try:
+        os.unlink(state_path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def dump_server_state(socket_path, state_path):
+    """Write the running haproxy's server state to state_path.  If it can't be
+    read, any existing state file is removed, since loading an out of date
+    state could mark servers up or down wrongly.
+
+    :returns: True if the state was saved
+    """
+    try:
+        state = query_socket(socket_path, 'show servers state')
+    except socket.error:
+        # Most likely haproxy isn't running yet
+        log.warn('Could not read server state from %s' % socket_path)
+        remove_state_file(state_path)
+        return False
+
+    write_atomically(state_path, state)
+    return True
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('socket_path', help="Path to haproxy's stats socket")
+    parser.add_argument('state_path', help='Where to write the server state')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    args = parse_args()
+    try:
+        dump_server_state(args.socket_path, args.state_path)
+    except Exception:
+        # Never stop the reload that follows
+        log.exception('Failed to save server state')
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
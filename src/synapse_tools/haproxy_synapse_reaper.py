@@ -20,6 +20,7 @@ See SRV-1404 for more background info.
 
 
 import errno
+import glob
 import logging
 import operator
 import os
@@ -39,6 +40,10 @@ DEFAULT_MAX_PROCS = 10
 
 HAPROXY_SYNAPSE_PIDFILE = '/var/run/synapse/haproxy.pid'
 
+# When synapse is sharded, each shard's haproxy has its own pidfile, e.g.
+# /var/run/synapse/haproxy-0.pid
+HAPROXY_SYNAPSE_SHARD_PIDFILES = '/var/run/synapse/haproxy-*.pid'
+
 LOG_FORMAT = '%(levelname)s %(message)s'
 
 log = logging.getLogger()
@@ -57,13 +62,23 @@ def parse_args():
     return parser.parse_args()
 
 
-def get_main_pid():
-    with open(HAPROXY_SYNAPSE_PIDFILE) as fh:
-        return int(fh.readline().strip())
+def read_pids(pidfile):
+    # haproxy writes one pid per line, one for each process when nbproc > 1
+    with open(pidfile) as fh:
+        return set(int(line) for line in fh.read().split())
+
+
+def get_main_pids():
+    pidfiles = glob.glob(HAPROXY_SYNAPSE_SHARD_PIDFILES)
+    # Without any pidfile we can't tell main instances from alumni, so let
+    # reading the unsharded pidfile fail rather than reaping everything
+    if not pidfiles or os.path.exists(HAPROXY_SYNAPSE_PIDFILE):
+        pidfiles.append(HAPROXY_SYNAPSE_PIDFILE)
+    return set().union(*(read_pids(pidfile) for pidfile in pidfiles))
 
 
 def get_alumni(username):
-    main_pid = get_main_pid()
+    main_pids = get_main_pids()
 
     for proc in psutil.process_iter():
         if proc.name() != 'haproxy-synapse':
@@ -72,7 +87,7 @@ def get_alumni(username):
         if proc.username() != username:
             continue
 
-        if proc.pid == main_pid:
+        if proc.pid in main_pids:
             continue
 
         yield proc
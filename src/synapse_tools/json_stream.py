@@ -0,0 +1,65 @@
+"""Incremental JSON serialization of synapse configs.
+
+json.dump needs the whole config in memory before it can write any of it.
+iter_json_chunks instead accepts StreamedDict values, whose items are pulled
+from an iterator one at a time as they are written, and produces exactly the
+same output as json.dumps with the same formatting options.
+"""
+
+import json
+
+
+INDENTED = {'indent': 4, 'separators': (',', ': ')}
+COMPACT = {'separators': (',', ':')}
+
+
+class StreamedDict(object):
+    """A dict whose (key, value) items come from an iterator.  The items must
+    already be sorted by key, and can only be iterated over once."""
+
+    def __init__(self, items):
+        self.items = items
+
+
+def _dumps(obj, compact, level):
+    if compact:
+        return json.dumps(obj, sort_keys=True, **COMPACT)
+    # json.dumps escapes newlines within strings, so every newline in its
+    # output is structural and can be indented safely.
+    serialized = json.dumps(obj, sort_keys=True, **INDENTED)
+    return serialized.replace('\n', '\n' + ' ' * (INDENTED['indent'] * level))
+
+
+def iter_json_chunks(obj, compact=False, level=0):
+    """Yield chunks of the JSON serialization of obj, which may contain
+    StreamedDicts.  Dicts of dicts are walked here so that any StreamedDicts
+    within them are found; everything else is serialized by json.dumps in
+    one go."""
+    if isinstance(obj, StreamedDict):
+        items = obj.items
+    elif isinstance(obj, dict) and any(
+            isinstance(value, (dict, StreamedDict)) for value in obj.itervalues()):
+        items = iter(sorted(obj.iteritems()))
+    else:
+        yield _dumps(obj, compact, level)
+        return
+
+    if compact:
+        (inner_indent, outer_indent, key_separator) = ('', '', ':')
+    else:
+        width = INDENTED['indent']
+        inner_indent = '\n' + ' ' * (width * (level + 1))
+        outer_indent = '\n' + ' ' * (width * level)
+        key_separator = ': '
+
+    empty = True
+    for (key, value) in items:
+        yield ('{' if empty else ',') + inner_indent + json.dumps(key) + key_separator
+        for chunk in iter_json_chunks(value, compact, level + 1):
+            yield chunk
+        empty = False
+
+    if empty:
+        yield '{}'
+    else:
+        yield outer_indent + '}'
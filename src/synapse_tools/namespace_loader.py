@@ -0,0 +1,124 @@
+"""Load smartstack namespaces from soa-configs.
+
+This returns the same (service.namespace, namespace_config) tuples as
+paasta_tools.marathon_tools.get_all_namespaces, but only reads each service's
+smartstack.yaml, parses them with the C libyaml loader across a pool of
+processes, and keeps an index of parsed files keyed by path and mtime so that
+unchanged files are not parsed again.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+
+import yaml
+from paasta_tools.utils import compose_job_id
+from paasta_tools.utils import DEFAULT_SOA_DIR
+
+from synapse_tools.atomic_file import write_json_atomically
+from synapse_tools.resolution_cache import file_signature
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+log = logging.getLogger(__name__)
+
+SMARTSTACK_FILENAME = 'smartstack.yaml'
+
+# Bump this whenever the format of the index changes.
+INDEX_VERSION = 1
+
+# Below this many files to parse, the cost of starting worker processes
+# outweighs the benefit of parsing in parallel.
+MIN_FILES_FOR_POOL = 50
+
+
+def parse_smartstack_file(path):
+    try:
+        with open(path) as fp:
+            return yaml.load(fp, Loader=SafeLoader) or {}
+    except IOError:
+        return {}
+    except Exception:
+        log.error('Failed to parse YAML from %s' % path)
+        raise
+
+
+class NamespaceLoader(object):
+
+    def __init__(self, soa_dir=DEFAULT_SOA_DIR, index=None, processes=None):
+        self.soa_dir = os.path.abspath(soa_dir)
+        self.index = index or {}
+        self.processes = processes or multiprocessing.cpu_count()
+        self.parsed = 0
+
+    @classmethod
+    def load(cls, index_path, soa_dir=DEFAULT_SOA_DIR, processes=None):
+        index = {}
+        try:
+            with open(index_path) as fp:
+                data = json.load(fp)
+            if data.get('version') == INDEX_VERSION:
+                index = data['files']
+        except (IOError, ValueError):
+            log.info('No usable namespace index at %s, starting empty' %
+                     index_path)
+        return cls(soa_dir=soa_dir, index=index, processes=processes)
+
+    def save(self, index_path):
+        try:
+            write_json_atomically(
+                index_path, {'version': INDEX_VERSION, 'files': self.index})
+        except (IOError, OSError):
+            # The index is only an optimization; never fail a run over it
+            log.exception('Failed to save namespace index to %s' % index_path)
+
+    def _parse_files(self, paths):
+        if self.processes > 1 and len(paths) >= MIN_FILES_FOR_POOL:
+            pool = multiprocessing.Pool(self.processes)
+            try:
+                return pool.map(
+                    parse_smartstack_file, paths,
+                    chunksize=max(1, len(paths) // (self.processes * 4)))
+            finally:
+                pool.close()
+                pool.join()
+        return [parse_smartstack_file(path) for path in paths]
+
+    def get_all_namespaces(self):
+        """Get all the smartstack namespaces across all services.
+
+        :returns: A list of tuples of the form (service.namespace,
+            namespace_config), sorted by name.
+        """
+        signatures = {}
+        for service in os.listdir(self.soa_dir):
+            path = os.path.join(self.soa_dir, service, SMARTSTACK_FILENAME)
+            signature = file_signature(path)
+            if signature is not None:
+                signatures[path] = (service, signature)
+
+        stale = [
+            stale_path for (stale_path, (_, current)) in signatures.iteritems()
+            if self.index.get(stale_path, {}).get('signature') != current
+        ]
+        for (path, smartstack) in zip(stale, self._parse_files(stale)):
+            self.index[path] = {
+                'signature': signatures[path][1],
+                'smartstack': smartstack,
+            }
+        self.parsed = len(stale)
+
+        # Forget about files that have been removed
+        for path in set(self.index) - set(signatures):
+            del self.index[path]
+
+        namespace_list = []
+        for (path, (service, _)) in signatures.iteritems():
+            for (namespace, config) in self.index[path]['smartstack'].iteritems():
+                namespace_list.append((compose_job_id(service, namespace), config))
+        return sorted(namespace_list)
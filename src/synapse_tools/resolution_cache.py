@@ -0,0 +1,52 @@
+"""Memoization of values that are read from small files on disk, such as this
+host's location and groupings under /nail/etc.
+
+A cached value is reused for as long as every file it was derived from keeps
+the same mtime and size.  Values derived from files that do not exist are
+never cached, since there is no way to tell when they become stale.
+"""
+
+import os
+
+
+def file_signature(path):
+    """Return a (mtime, size) pair identifying the current contents of path,
+    or None if it does not exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+
+class ResolutionCache(object):
+
+    def __init__(self):
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, paths, loader):
+        """Return the value cached under key, calling loader() to compute it
+        if any of the files in paths have changed since it was cached."""
+        signatures = [file_signature(path) for path in paths]
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == signatures:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        value = loader()
+        if None in signatures:
+            self._entries.pop(key, None)
+        else:
+            self._entries[key] = (signatures, value)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+
+
+# Shared by everything running in this process, so that configuration
+# generators and long-running daemons resolve each location only once.
+shared_resolution_cache = ResolutionCache()
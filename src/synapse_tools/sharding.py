@@ -0,0 +1,58 @@
+"""Partition services across several synapse/HAProxy instances.
+
+A single HAProxy process serves all proxied traffic on one core.  With the
+shards option set in synapse-tools.conf.json, services are instead split
+across that many synapse instances, each managing its own HAProxy.  Each
+service is assigned to a shard by a stable hash of its name, so a service
+only moves when the number of shards changes, unless it is pinned to a
+particular shard with shard_pins.
+"""
+
+import os
+import zlib
+
+
+def get_shard_count(config):
+    """Return the shards option, which must be a whole number of at least
+    1."""
+    shard_count = config.get('shards', 1)
+    if (isinstance(shard_count, bool) or
+            not isinstance(shard_count, (int, long)) or shard_count < 1):
+        raise ValueError('shards must be a whole number of at least 1, not %r' % (
+            shard_count,))
+    return shard_count
+
+
+def shard_for_service(service_name, shard_count, pins=None):
+    """Return the shard that service_name (service.namespace) belongs to.
+    pins maps a service.namespace or a whole service to a shard."""
+    pins = pins or {}
+    for key in (service_name, service_name.split('.', 1)[0]):
+        if key in pins:
+            shard = pins[key]
+            if not 0 <= shard < shard_count:
+                raise ValueError('%s is pinned to shard %d, but there are only %d' % (
+                    key, shard, shard_count))
+            return shard
+    # crc32 is stable across processes and platforms, unlike hash()
+    return (zlib.crc32(service_name) & 0xffffffff) % shard_count
+
+
+def partition_services(services, shard_count, pins=None):
+    """Split (service.namespace, namespace_config) tuples into a list of
+    shard_count lists."""
+    shards = [[] for _ in range(shard_count)]
+    for (service_name, service_info) in services:
+        shards[shard_for_service(service_name, shard_count, pins)].append(
+            (service_name, service_info))
+    return shards
+
+
+def shard_path(path, shard):
+    """Return the shard-specific version of path, e.g. shard 2 of
+    /var/run/synapse/haproxy.cfg is /var/run/synapse/haproxy-2.cfg."""
+    if shard is None:
+        return path
+    (directory, filename) = os.path.split(path)
+    (stem, dot, extension) = filename.partition('.')
+    return os.path.join(directory, '%s-%d%s%s' % (stem, shard, dot, extension))
@@ -0,0 +1,77 @@
+"""Move options shared by every service into the haproxy defaults section.
+
+Synapse writes a single defaults section ahead of every service's frontend
+and backend, so options which all services set identically can be written
+there once instead of once per service.  Only options which are legal in a
+defaults section and harmless on the stats listener (which also inherits
+the defaults) are moved; notably 'capture' is frontend-only.
+"""
+
+# Frontend and listen options which may be moved, by prefix
+HOISTABLE_OPTIONS = (
+    'option httplog',
+    'option tcplog',
+    'http-check send-state',
+    'option allredisp',
+    'option http-keep-alive',
+    'option http-server-close',
+    'retries ',
+    'timeout ',
+)
+
+# Each service's listen options are written into both its frontend and
+# backend, while frontend options also take effect in backends once they
+# are in the defaults section.  So only these sections are considered.
+SECTIONS = ('frontend', 'listen')
+
+
+def is_hoistable(option):
+    return option.startswith(HOISTABLE_OPTIONS)
+
+
+def find_common_options(services):
+    """Return the hoistable options which every service sets, in the order
+    the first service sets them."""
+    entries = [entry['haproxy'] for entry in services.itervalues()]
+    if not entries:
+        return []
+
+    common = []
+    for section in SECTIONS:
+        for option in entries[0].get(section, []):
+            if (is_hoistable(option) and option not in common and
+                    all(option in entry.get(section, []) for entry in entries)):
+                common.append(option)
+    return common
+
+
+def _without(entry, options):
+    """Copy a service entry without options.  Entries may be shared with the
+    stanza cache, so they are never modified in place."""
+    haproxy = dict(entry['haproxy'])
+    for section in SECTIONS:
+        haproxy[section] = [
+            option for option in haproxy.get(section, []) if option not in options
+        ]
+    return dict(entry, haproxy=haproxy)
+
+
+def hoist_common_options(synapse_config):
+    """Return a copy of synapse_config with the hoistable options set by
+    every service moved into the defaults section."""
+    services = synapse_config['services']
+    common = find_common_options(services)
+    if not common:
+        return synapse_config
+
+    haproxy = dict(synapse_config['haproxy'])
+    haproxy['defaults'] = haproxy['defaults'] + [
+        '# common to every service',
+    ] + common
+    return dict(
+        synapse_config,
+        haproxy=haproxy,
+        services=dict(
+            (name, _without(entry, common)) for (name, entry) in services.iteritems()
+        ),
+    )
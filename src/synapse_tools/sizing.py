@@ -0,0 +1,73 @@
+"""Size HAProxy's connection limits and buffers to a memory budget.
+
+Each connection can hold two buffers (request and response) of tune.bufsize
+bytes plus some bookkeeping, so worst case buffer memory is roughly
+maxconn * (2 * bufsize + CONNECTION_OVERHEAD_BYTES).  With the
+haproxy.memory_budget_mb or haproxy.memory_budget_fraction (of host memory)
+options set in synapse-tools.conf.json, maxconn is chosen to fit that budget
+rather than being fixed.  bufsize never shrinks, since smaller buffers break
+requests with large headers.  The budget is for the whole host, and
+is split evenly between every HAProxy process across all shards.
+"""
+
+import psutil
+
+
+# Default of 16k is too small and causes HTTP 400 errors
+BUFSIZE = 32768
+
+# Session, connection and file descriptor state, roughly
+CONNECTION_OVERHEAD_BYTES = 2048
+
+MIN_MAXCONN = 100
+MAX_MAXCONN = 100000
+
+# Connections are concentrated on a few busy services, so each frontend may
+# use this many times its even share of maxconn.
+FRONTEND_OVERCOMMIT = 10
+MIN_FRONTEND_MAXCONN = 100
+
+
+def get_host_memory_bytes():
+    return psutil.virtual_memory().total
+
+
+def get_memory_budget_bytes(synapse_tools_config):
+    """Return the configured memory budget in bytes, or None if sizing is not
+    enabled."""
+    budget_mb = synapse_tools_config.get('haproxy.memory_budget_mb')
+    if budget_mb is not None:
+        return int(budget_mb * 1024 * 1024)
+    fraction = synapse_tools_config.get('haproxy.memory_budget_fraction')
+    if fraction is not None:
+        return int(get_host_memory_bytes() * fraction)
+    return None
+
+
+def _clamp(value, lower, upper):
+    return max(lower, min(value, upper))
+
+
+def compute_sizing(budget_bytes, service_count, processes=1):
+    """Return (maxconn, per-frontend maxconn, comment lines) for each of
+    processes HAProxy processes sharing budget_bytes."""
+    process_budget = budget_bytes // processes
+    connection_bytes = 2 * BUFSIZE + CONNECTION_OVERHEAD_BYTES
+    maxconn = _clamp(process_budget // connection_bytes, MIN_MAXCONN, MAX_MAXCONN)
+    frontend_maxconn = _clamp(
+        maxconn * FRONTEND_OVERCOMMIT // max(service_count, 1),
+        MIN_FRONTEND_MAXCONN, maxconn)
+
+    comments = [
+        '# sizing: %dMB budget for each of %d haproxy processes' % (
+            process_budget // (1024 * 1024), processes),
+        '# sizing: %d bytes per connection (2 x %d byte buffers + %d)' % (
+            connection_bytes, BUFSIZE, CONNECTION_OVERHEAD_BYTES),
+        '# sizing: maxconn %d = budget / bytes per connection, clamped to [%d, %d]' % (
+            maxconn, MIN_MAXCONN, MAX_MAXCONN),
+        '# sizing: frontend maxconn %d = %dx an even share across %d services,'
+        ' clamped to [%d, maxconn]' % (
+            frontend_maxconn, FRONTEND_OVERCOMMIT, service_count,
+            MIN_FRONTEND_MAXCONN),
+    ]
+    return (maxconn, frontend_maxconn, comments)
@@ -0,0 +1,199 @@
+"""Persistent cache of generated synapse service stanzas.
+
+configure_synapse runs every minute, but the inputs to almost every service
+stanza are identical between runs.  Each stanza is stored alongside a hash of
+everything that went into generating it, so only services whose inputs have
+changed need to be regenerated.
+"""
+
+import copy
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from synapse_tools.atomic_file import write_json_atomically
+
+
+log = logging.getLogger(__name__)
+
+# Bump this whenever the output of haproxy_cfg_for_service changes for the
+# same inputs, so that entries written by an older synapse-tools are dropped.
+CACHE_VERSION = 3
+
+
+def hash_inputs(*inputs):
+    """Return a stable digest of the given JSON-serializable inputs."""
+    serialized = json.dumps(inputs, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(serialized).hexdigest()
+
+
+class StanzaCache(object):
+    """Maps service names to (input hash, generated stanza) pairs, and counts
+    how many lookups could be served without regenerating the stanza."""
+
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+        self.hits = 0
+        self.misses = 0
+        self._seen = set()
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path) as fp:
+                data = json.load(fp)
+        except (IOError, ValueError):
+            log.info('No usable stanza cache at %s, starting empty' % path)
+            return cls()
+
+        if data.get('version') != CACHE_VERSION:
+            log.info('Discarding stanza cache from a different version')
+            return cls()
+        return cls(data.get('entries'))
+
+    def save(self, path):
+        """Atomically replace the cache file, dropping services that were not
+        looked up since the cache was loaded."""
+        entries = dict(
+            (service_name, entry)
+            for (service_name, entry) in self.entries.iteritems()
+            if service_name in self._seen
+        )
+        try:
+            write_json_atomically(
+                path, {'version': CACHE_VERSION, 'entries': entries})
+        except (IOError, OSError):
+            # The cache is only an optimization; never fail a run over it
+            log.exception('Failed to save stanza cache to %s' % path)
+
+    def get(self, service_name, key):
+        """Return a copy of the cached stanza for service_name if it was
+        generated from inputs hashing to key, otherwise None.  Callers may
+        modify the copy without affecting later hits."""
+        self._seen.add(service_name)
+        entry = self.entries.get(service_name)
+        if entry is not None and entry['key'] == key:
+            self.hits += 1
+            return copy.deepcopy(entry['stanza'])
+        self.misses += 1
+        return None
+
+    def put(self, service_name, key, stanza):
+        self._seen.add(service_name)
+        self.entries[service_name] = {
+            'key': key, 'stanza': copy.deepcopy(stanza)}
+
+
+class StanzaFileCache(object):
+    """A StanzaCache which keeps stanzas on disk rather than in memory, for
+    streaming_output.  Only each service's input hash and the offset of its
+    stanza in the cache file are held in memory.
+
+    The cache file has a version line, then one JSON line per service.
+    Every stanza looked up or stored is copied to a new file next to it,
+    which replaces it on save, so services which were not looked up are
+    dropped as they are by StanzaCache.save.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        # Map service names to (input hash, offset) in the cache file, and
+        # in the new file being written
+        self._index = {}
+        self._new_index = {}
+        self._fp = None
+        self._new_fp = None
+
+    @classmethod
+    def load(cls, path):
+        cache = cls(path)
+        try:
+            fp = open(path)
+        except IOError:
+            log.info('No usable stanza cache at %s, starting empty' % path)
+            return cache
+
+        try:
+            if json.loads(fp.readline()).get('version') != CACHE_VERSION:
+                log.info('Discarding stanza cache from a different version')
+                fp.close()
+                return cache
+            index = {}
+            while True:
+                offset = fp.tell()
+                line = fp.readline()
+                if not line:
+                    break
+                (service_name, key, _) = json.loads(line)
+                index[service_name] = (key, offset)
+        except (AttributeError, TypeError, ValueError):
+            log.info('No usable stanza cache at %s, starting empty' % path)
+            fp.close()
+            return cache
+
+        cache._fp = fp
+        cache._index = index
+        return cache
+
+    def get(self, service_name, key):
+        """Return the cached stanza for service_name if it was generated from
+        inputs hashing to key, otherwise None."""
+        (cached_key, offset) = self._index.get(service_name, (None, None))
+        if cached_key is not None and cached_key == key:
+            self._fp.seek(offset)
+            line = self._fp.readline()
+            try:
+                (_, _, stanza) = json.loads(line)
+            except (TypeError, ValueError):
+                stanza = None
+            if stanza is not None:
+                self._copy_line(service_name, key, line)
+                self.hits += 1
+                return stanza
+        self.misses += 1
+        return None
+
+    def put(self, service_name, key, stanza):
+        self._copy_line(
+            service_name, key, json.dumps([service_name, key, stanza]) + '\n')
+
+    def _start_new_file(self):
+        self._new_fp = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(self.path)), delete=False)
+        self._new_fp.write(json.dumps({'version': CACHE_VERSION}) + '\n')
+
+    def _copy_line(self, service_name, key, line):
+        if self._new_fp is None:
+            self._start_new_file()
+        self._new_index[service_name] = (key, self._new_fp.tell())
+        self._new_fp.write(line)
+
+    def save(self, path):
+        """Replace the cache file at path with the stanzas looked up or stored
+        since the last save, and serve later lookups from it."""
+        if self._new_fp is None:
+            # Nothing was looked up, so nothing is kept
+            self._start_new_file()
+        try:
+            self._new_fp.close()
+            os.rename(self._new_fp.name, path)
+            fp = open(path)
+        except (IOError, OSError):
+            # The cache is only an optimization; never fail a run over it
+            log.exception('Failed to save stanza cache to %s' % path)
+            self._new_index = {}
+            if os.path.exists(self._new_fp.name):
+                os.unlink(self._new_fp.name)
+            fp = None
+        self.close()
+        (self.path, self._fp, self._index) = (path, fp, self._new_index)
+        (self._new_fp, self._new_index) = (None, {})
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
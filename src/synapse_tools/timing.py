@@ -0,0 +1,57 @@
+"""Timing instrumentation for configure_synapse runs."""
+
+import contextlib
+import json
+import logging
+import time
+
+
+log = logging.getLogger(__name__)
+
+# How many of the slowest services to report per run
+SLOWEST_SERVICES_TO_REPORT = 10
+
+
+class PhaseTimer(object):
+    """Records how long each phase of a run takes, plus how long each service
+    took to generate."""
+
+    def __init__(self):
+        self.phases = []
+        self.service_timings = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - start))
+
+    def record_service(self, service_name, duration_s):
+        self.service_timings.append((service_name, duration_s))
+
+    def slowest_services(self, count=SLOWEST_SERVICES_TO_REPORT):
+        return sorted(
+            self.service_timings, key=lambda timing: timing[1], reverse=True
+        )[:count]
+
+    def phase_totals(self):
+        """Total time spent in each phase, which may have run more than once
+        (e.g. once per shard)."""
+        totals = {}
+        for (name, duration) in self.phases:
+            totals[name] = totals.get(name, 0) + duration
+        return totals
+
+    def as_dict(self):
+        return {
+            'phases_s': self.phase_totals(),
+            'total_s': sum(duration for (_, duration) in self.phases),
+            'services': len(self.service_timings),
+            'slowest_services_s': self.slowest_services(),
+        }
+
+    def emit(self):
+        """Log the timings as a single JSON line."""
+        log.info(json.dumps(self.as_dict(), sort_keys=True))
@@ -0,0 +1,77 @@
+"""Per-service traffic priorities on the loopback interface.
+
+A service may declare a priority in its smartstack.yaml, one of PRIORITIES.
+configure_synapse writes the proxy port of every service that does to a
+priority map file.  synapse_qdisc_tool setup then marks traffic to and from
+those ports with iptables, and steers it into the matching band of the prio
+qdisc on lo, so latency-critical traffic doesn't queue behind bulk
+transfers.  Services without a priority are left to the qdisc's default
+priomap, which puts best effort traffic in the band between the two.
+"""
+
+import json
+import logging
+import os
+
+from synapse_tools.atomic_file import write_json_atomically
+
+
+log = logging.getLogger(__name__)
+
+PRIORITY_MAP_PATH = '/var/run/synapse/priority_ports.json'
+
+# Highest first; each has its own band of the prio qdisc
+PRIORITIES = ('fastest', 'slow')
+
+
+def validate_priorities(services):
+    """Return services with any unknown priority dropped, so that everything
+    downstream can use service_info['priority'] as is."""
+    validated = []
+    for (service_name, service_info) in services:
+        priority = service_info.get('priority')
+        if priority is not None and priority not in PRIORITIES:
+            log.warn('Ignoring unknown priority %s for %s' % (priority, service_name))
+            service_info = dict(service_info)
+            del service_info['priority']
+        validated.append((service_name, service_info))
+    return validated
+
+
+def port_priorities(services):
+    """Map the proxy port of each service with a priority to that priority.
+    services must have been through validate_priorities."""
+    ports = {}
+    for (service_name, service_info) in services:
+        proxy_port = service_info.get('proxy_port')
+        priority = service_info.get('priority')
+        if proxy_port is not None and priority is not None:
+            ports[int(proxy_port)] = priority
+    return ports
+
+
+def read_priority_map(path=PRIORITY_MAP_PATH):
+    try:
+        with open(path) as fp:
+            data = json.load(fp)
+    except (IOError, ValueError):
+        return {}
+    return dict((int(port), priority) for (port, priority) in data.iteritems())
+
+
+def update_priority_map(ports, path=PRIORITY_MAP_PATH):
+    """Write ports to the priority map file if they've changed.  Nothing is
+    written on hosts where no service has ever declared a priority.
+
+    :returns: True if the file was written
+    """
+    if not ports and not os.path.exists(path):
+        return False
+    if read_priority_map(path) == ports:
+        return False
+    write_json_atomically(path, dict(
+        (str(port), priority) for (port, priority) in ports.iteritems()))
+    log.info('Wrote priorities for %d ports to %s; they take effect at the '
+             'next synapse_qdisc_tool setup, and synapse_qdisc_tool '
+             'needs_setup reports them until then' % (len(ports), path))
+    return True
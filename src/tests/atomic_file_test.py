@@ -0,0 +1,31 @@
+import os
+
+from synapse_tools import atomic_file
+
+
+def test_write_atomically(tmpdir):
+    path = tmpdir.join('synapse.conf.json')
+    path.write('old')
+    atomic_file.write_atomically(str(path), 'new', mode=0644)
+    assert path.read() == 'new'
+    assert oct(path.stat().mode & 0777) == '0644'
+    assert os.listdir(str(tmpdir)) == ['synapse.conf.json']
+
+
+def test_content_hash_round_trip(tmpdir):
+    path = tmpdir.join('synapse.conf.json')
+    assert atomic_file.read_content_hash(str(path)) is None
+
+    atomic_file.write_atomically(str(path), 'contents')
+    atomic_file.write_content_hash(str(path), 'abc123')
+    assert atomic_file.read_content_hash(str(path)) == 'abc123'
+
+
+def test_content_hash_ignored_when_file_replaced(tmpdir):
+    path = tmpdir.join('synapse.conf.json')
+    atomic_file.write_atomically(str(path), 'contents')
+    atomic_file.write_content_hash(str(path), 'abc123')
+
+    # e.g. someone hand-editing the file
+    atomic_file.write_atomically(str(path), 'other contents')
+    assert atomic_file.read_content_hash(str(path)) is None
@@ -0,0 +1,77 @@
+import contextlib
+
+import mock
+
+from benchmarks import config_generation
+from benchmarks import haproxy_reload
+from benchmarks import synthetic
+from synapse_tools import configure_synapse
+
+
+def test_generate_services_is_deterministic():
+    services = synthetic.generate_services(50)
+    assert services == synthetic.generate_services(50)
+    assert len(set(name for (name, _) in services)) == 50
+    assert len(set(config['proxy_port'] for (_, config) in services)) == 50
+
+
+def test_synthetic_services_generate():
+    with synthetic.fake_host_location():
+        synapse_config = configure_synapse.generate_configuration(
+            {'bind_addr': '0.0.0.0'},
+            synthetic.generate_zookeeper_topology(),
+            synthetic.generate_services(200),
+        )
+    assert len(synapse_config['services']) == 200
+
+
+def test_find_regressions():
+    baselines = {
+        '100': {'wall_time_s': 1.0, 'peak_rss_kb': 10000, 'output_bytes': 1000},
+    }
+    ok = {'100': {'wall_time_s': 1.2, 'peak_rss_kb': 11000, 'output_bytes': 1000}}
+    assert config_generation.find_regressions(ok, baselines) == []
+
+    slow = {'100': {'wall_time_s': 2.0, 'peak_rss_kb': 11000, 'output_bytes': 1000}}
+    assert config_generation.find_regressions(slow, baselines) == [
+        '100 services: wall_time_s of 2.0 exceeds limit of 1.55',
+    ]
+
+    unknown = {'5': {'wall_time_s': 2.0, 'peak_rss_kb': 11000, 'output_bytes': 1000}}
+    assert config_generation.find_regressions(unknown, baselines) == []
+
+
+def test_render_haproxy_cfg():
+    with synthetic.fake_host_location():
+        synapse_config = configure_synapse.generate_configuration(
+            {'bind_addr': '127.0.0.1'},
+            synthetic.generate_zookeeper_topology(),
+            [('a_service.main', {'proxy_port': 20000})],
+        )
+    rendered = haproxy_reload.render_haproxy_cfg(
+        synapse_config, '/tmp/haproxy.sock', servers_per_service=1)
+
+    assert '\tstats socket /tmp/haproxy.sock level admin\n' in rendered
+    assert 'listen stats' not in rendered
+    assert '\nfrontend a_service.main\n' in rendered
+    assert '\tbind 127.0.0.1:20000\n\tdefault_backend a_service.main\n' in rendered
+    assert '\tserver 10.1.0.1:31000_a_service.main 10.1.0.1:31000 check port 6666 observe layer7\n' in rendered
+
+
+def test_first_count_over_budget():
+    results = {
+        100: {'reload_s': 0.01},
+        1000: {'reload_s': 0.2},
+        10000: {'reload_s': 2.0},
+    }
+    assert haproxy_reload.first_count_over_budget(results, 100) == 1000
+    assert haproxy_reload.first_count_over_budget(results, 5000) is None
+
+
+def test_haproxy_reload_skips_without_haproxy(tmpdir):
+    argv = ['haproxy_reload', '--haproxy', str(tmpdir.join('haproxy'))]
+    with contextlib.nested(
+            mock.patch('sys.argv', argv),
+            mock.patch.object(haproxy_reload, 'measure')) as (_, mock_measure):
+        assert haproxy_reload.main() == 0
+    assert not mock_measure.called
@@ -0,0 +1,70 @@
+import copy
+
+from synapse_tools import config_diff
+
+
+def make_config():
+    return {
+        'file_output': {'output_directory': '/var/run/synapse/services'},
+        'haproxy': {'global': ['daemon'], 'defaults': ['mode http']},
+        'services': {
+            'service_one.main': {
+                'default_servers': [],
+                'use_previous_backends': False,
+                'discovery': {'method': 'zookeeper', 'path': '/nerve/region:r/service_one.main'},
+                'haproxy': {'port': '1234', 'frontend': [], 'backend': [], 'listen': []},
+            },
+            'service_two.main': {
+                'default_servers': [],
+                'use_previous_backends': False,
+                'discovery': {'method': 'zookeeper', 'path': '/nerve/region:r/service_two.main'},
+                'haproxy': {'port': '1235', 'frontend': [], 'backend': [], 'listen': []},
+            },
+        },
+    }
+
+
+def test_no_change():
+    diff = config_diff.diff_configs(make_config(), make_config())
+    assert diff.change_classes == set([config_diff.NO_CHANGE])
+    assert diff.action == config_diff.ACTION_NONE
+    assert diff.summary() == 'no changes'
+
+
+def test_no_existing_config():
+    diff = config_diff.diff_configs(None, make_config())
+    assert config_diff.GLOBAL_CHANGE in diff.change_classes
+    assert diff.action == config_diff.ACTION_RESTART
+
+
+def test_global_change():
+    new = make_config()
+    new['haproxy']['global'].append('maxconn 10')
+    diff = config_diff.diff_configs(make_config(), new)
+    assert diff.change_classes == set([config_diff.GLOBAL_CHANGE])
+    assert diff.global_changes == ['haproxy.global']
+    assert diff.action == config_diff.ACTION_RESTART
+
+
+def test_service_changes():
+    old = make_config()
+    new = copy.deepcopy(old)
+    new['services']['service_one.main']['haproxy']['listen'].append('retries 2')
+    new['services']['service_two.main']['discovery']['method'] = 'base'
+    new['services']['service_three.main'] = copy.deepcopy(old['services']['service_two.main'])
+
+    diff = config_diff.diff_configs(old, new)
+    assert diff.change_classes == set([
+        config_diff.SERVICE_HAPROXY_CHANGE,
+        config_diff.DISCOVERY_CHANGE,
+        config_diff.SERVICES_ADDED_OR_REMOVED,
+    ])
+    assert diff.haproxy_changed == ['service_one.main']
+    assert diff.discovery_changed == ['service_two.main']
+    assert diff.added == ['service_three.main']
+    assert diff.removed == []
+    assert diff.summary() == (
+        'added: service_three.main; '
+        'haproxy changed: service_one.main; '
+        'discovery changed: service_two.main'
+    )
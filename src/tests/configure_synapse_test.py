@@ -1,9 +1,20 @@
 import contextlib
+import json
+import os
+import pstats
+import socket
+import subprocess
 
 import mock
 import pytest
 
 from synapse_tools import configure_synapse
+from synapse_tools.config_diff import config_digests
+from synapse_tools.resolution_cache import ResolutionCache
+from synapse_tools.stanza_cache import hash_inputs
+from synapse_tools.stanza_cache import StanzaCache
+from synapse_tools.stanza_cache import StanzaFileCache
+from synapse_tools.timing import PhaseTimer
 
 
 @pytest.yield_fixture
@@ -103,54 +114,426 @@ def test_generate_configuration_empty():
     assert actual_configuration == expected_configuration
 
 
+def test_generate_configuration_with_stanza_cache(mock_get_current_location):
+    services = [
+        ('test_service', {'proxy_port': 1234}),
+        ('other_service', {'proxy_port': 1235}),
+    ]
+    cache = StanzaCache()
+    first = configure_synapse.generate_configuration(
+        synapse_tools_config={'bind_addr': '0.0.0.0'},
+        zookeeper_topology=['1.2.3.4'],
+        services=services,
+        stanza_cache=cache,
+    )
+    assert (cache.hits, cache.misses) == (0, 2)
+
+    services[1] = ('other_service', {'proxy_port': 1236})
+    with mock.patch.object(configure_synapse, 'haproxy_cfg_for_service',
+                           wraps=configure_synapse.haproxy_cfg_for_service) as cfg_mock:
+        second = configure_synapse.generate_configuration(
+            synapse_tools_config={'bind_addr': '0.0.0.0'},
+            zookeeper_topology=['1.2.3.4'],
+            services=services,
+            stanza_cache=cache,
+        )
+    assert (cache.hits, cache.misses) == (1, 3)
+    cfg_mock.assert_called_once_with('other_service', {'proxy_port': 1236}, ['1.2.3.4'])
+    assert second['services']['test_service'] == first['services']['test_service']
+    assert second['services']['other_service']['haproxy']['port'] == '1236'
+
+
+def test_generate_configuration_records_service_timings(mock_get_current_location):
+    timer = PhaseTimer()
+    configure_synapse.generate_configuration(
+        synapse_tools_config={'bind_addr': '0.0.0.0'},
+        zookeeper_topology=['1.2.3.4'],
+        services=[
+            ('test_service', {'proxy_port': 1234}),
+            ('unproxied_service', {}),
+        ],
+        timer=timer,
+    )
+    assert [name for (name, _) in timer.service_timings] == ['test_service']
+
+
+def test_stanza_cache_key_changes_with_topology(mock_get_current_location):
+    service_info = {'proxy_port': 1234}
+    key_1 = configure_synapse.stanza_cache_key(
+        'test_service', service_info, hash_inputs(['1.2.3.4']))
+    key_2 = configure_synapse.stanza_cache_key(
+        'test_service', service_info, hash_inputs(['2.3.4.5']))
+    assert key_1 != key_2
+
+
 @contextlib.contextmanager
-def setup_mocks_for_main():
-    mock_tmp_file = mock.MagicMock()
-    mock_file_cmp = mock.Mock()
-    mock_copy = mock.Mock()
+def setup_mocks_for_main(config_file):
     mock_subprocess_check_call = mock.Mock()
 
     with contextlib.nested(
             mock.patch('synapse_tools.configure_synapse.get_zookeeper_topology'),
-            mock.patch('synapse_tools.configure_synapse.get_all_namespaces'),
-            mock.patch('synapse_tools.configure_synapse.generate_configuration'),
-            mock.patch('synapse_tools.configure_synapse.get_config', return_value={'bind_addr': '0.0.0.0', 'config_file': '/etc/synapse/synapse.conf.json'}),
-            mock.patch('tempfile.NamedTemporaryFile', return_value=mock_tmp_file),
-            mock.patch('synapse_tools.configure_synapse.open', create=True),
-            mock.patch('json.dump'),
-            mock.patch('os.chmod'),
-            mock.patch('filecmp.cmp', mock_file_cmp),
-            mock.patch('shutil.copy', mock_copy),
-            mock.patch('subprocess.check_call', mock_subprocess_check_call)):
-        yield(mock_tmp_file, mock_file_cmp, mock_copy, mock_subprocess_check_call)
+            mock.patch('synapse_tools.configure_synapse.NamespaceLoader'),
+            mock.patch('synapse_tools.configure_synapse.generate_configuration', return_value={'services': {}}),
+            mock.patch('synapse_tools.configure_synapse.get_config', return_value={'bind_addr': '0.0.0.0', 'config_file': config_file}),
+            mock.patch('subprocess.check_call', mock_subprocess_check_call),
+            mock.patch('synapse_tools.configure_synapse.StanzaCache'),
+            mock.patch('sys.argv', ['configure_synapse'])):
+        yield mock_subprocess_check_call
 
 
-def test_synapse_restarted_when_config_files_differ():
-    with setup_mocks_for_main() as (
-            mock_tmp_file, mock_file_cmp, mock_copy, mock_subprocess_check_call):
+def test_synapse_restarted_when_config_files_differ(tmpdir):
+    config_file = tmpdir.join('synapse.conf.json')
+    config_file.write('{"services": {"foo.main": {}}}')
 
-        # New and existing synapse configs differ
-        mock_file_cmp.return_value = False
+    with setup_mocks_for_main(str(config_file)) as mock_subprocess_check_call:
+        configure_synapse.main()
+
+    assert json.loads(config_file.read()) == {'services': {}}
+    assert oct(config_file.stat().mode & 0777) == '0644'
+    mock_subprocess_check_call.assert_called_with(['service', 'synapse', 'restart'])
+
+
+def test_synapse_not_restarted_when_config_files_are_identical(tmpdir):
+    config_file = tmpdir.join('synapse.conf.json')
 
+    with setup_mocks_for_main(str(config_file)) as mock_subprocess_check_call:
         configure_synapse.main()
+        assert mock_subprocess_check_call.call_count == 1
+
+        inode = config_file.stat().ino
+        os.utime(str(config_file), (0, 0))
+        configure_synapse.main()
+
+    # Unchanged configs are not rewritten, but their mtime is still updated
+    # for the benefit of monitoring
+    assert mock_subprocess_check_call.call_count == 1
+    assert config_file.stat().ino == inode
+    assert config_file.mtime() > 0
+
+
+def test_synapse_not_restarted_when_only_formatting_differs(tmpdir):
+    config_file = tmpdir.join('synapse.conf.json')
+    config_file.write('{"services":{}}')
+
+    with setup_mocks_for_main(str(config_file)) as mock_subprocess_check_call:
+        configure_synapse.main()
+
+    assert config_file.read() == '{\n    "services": {}\n}'
+    assert not mock_subprocess_check_call.called
+
+
+def test_streaming_output_matches_generate_configuration(mock_get_current_location):
+    services = [
+        ('b_service', {'proxy_port': 1235, 'mode': 'tcp'}),
+        ('a_service', {'proxy_port': 1234, 'extra_headers': {'X-Mode': 'ro'}}),
+        ('unproxied_service', {}),
+    ]
+    for compact in (False, True):
+        my_config = {'bind_addr': '0.0.0.0', 'compact_output': compact}
+        expected = configure_synapse.serialize_synapse_config(
+            configure_synapse.generate_configuration(my_config, ['1.2.3.4'], services),
+            compact=compact,
+        )
+        chunks = configure_synapse.generate_configuration_chunks(
+            my_config, ['1.2.3.4'], services)
+        assert ''.join(chunks) == expected
 
-        mock_copy.assert_called_with(
-            mock_tmp_file.__enter__().name, '/etc/synapse/synapse.conf.json')
-        mock_subprocess_check_call.assert_called_with(['service', 'synapse', 'restart'])
 
+def test_update_synapse_config_from_chunks(tmpdir):
+    config_file = tmpdir.join('synapse.conf.json')
+    my_config = {'config_file': str(config_file)}
+    digests = config_digests({'services': {}})
 
-def test_synapse_not_restarted_when_config_files_are_identical():
-    with setup_mocks_for_main() as (
-            mock_tmp_file, mock_file_cmp, mock_copy, mock_subprocess_check_call):
+    with mock.patch('subprocess.check_call') as mock_check_call:
+        configure_synapse.update_synapse_config_from_chunks(
+            my_config, iter(['{"services": ', '{}}']), digests)
+        assert config_file.read() == '{"services": {}}'
+        assert mock_check_call.call_count == 1
 
-        # New and existing synapse configs are identical
-        mock_file_cmp.return_value = True
+        inode = config_file.stat().ino
+        configure_synapse.update_synapse_config_from_chunks(
+            my_config, iter(['{"services": ', '{}}']), digests)
+        assert config_file.stat().ino == inode
+        assert mock_check_call.call_count == 1
 
+    assert sorted(os.listdir(str(tmpdir))) == [
+        'synapse.conf.json', 'synapse.conf.json.digests', 'synapse.conf.json.sha1']
+
+
+def test_streaming_output_diffs_without_reading_configs(tmpdir, mock_get_current_location):
+    my_config = {
+        'bind_addr': '0.0.0.0',
+        'config_file': str(tmpdir.join('synapse.conf.json')),
+        'streaming_output': True,
+    }
+    services = [
+        ('a_service', {'proxy_port': 1234}),
+        ('b_service', {'proxy_port': 1235}),
+    ]
+    with contextlib.nested(
+            mock.patch('subprocess.check_call'),
+            mock.patch.object(configure_synapse, 'apply_config_change'),
+            mock.patch.object(configure_synapse, 'read_synapse_config')) as (
+            _, mock_apply_config_change, mock_read_synapse_config):
+        configure_synapse.generate_and_update_shard(
+            my_config, ['1.2.3.4'], services, None, PhaseTimer())
+        services[1] = ('b_service', {'proxy_port': 1235, 'retries': 2})
+        configure_synapse.generate_and_update_shard(
+            my_config, ['1.2.3.4'], services, None, PhaseTimer())
+
+    assert not mock_read_synapse_config.called
+    (first_diff, second_diff) = [
+        call[0][0] for call in mock_apply_config_change.call_args_list]
+    assert first_diff.global_changes == ['config']
+    assert second_diff.global_changes == []
+    assert second_diff.haproxy_changed == ['b_service']
+    assert second_diff.discovery_changed == []
+
+    # The streamed digests match those of the whole config
+    digests = configure_synapse.read_config_digests(my_config['config_file'])
+    with open(my_config['config_file']) as fp:
+        assert dict(digests, content_hash=None) == dict(
+            config_digests(json.load(fp)), content_hash=None)
+
+
+def test_generate_base_config_for_shard():
+    base_config = configure_synapse.generate_base_config(
+        {'bind_addr': '0.0.0.0', 'shard': 2})
+    haproxy = base_config['haproxy']
+    assert haproxy['config_file_path'] == '/var/run/synapse/haproxy-2.cfg'
+    assert haproxy['socket_file_path'] == '/var/run/synapse/haproxy-2.sock'
+    assert haproxy['state_file_path'] == '/var/run/synapse/state-2.json'
+    assert '-p /var/run/synapse/haproxy-2.pid' in haproxy['reload_command']
+    assert 'stats socket /var/run/synapse/haproxy-2.sock level admin' in haproxy['global']
+    assert haproxy['extra_sections']['listen stats'][0] == 'bind :3214'
+    assert base_config['file_output'] == {'output_directory': '/var/run/synapse/services-2'}
+
+
+def test_generate_and_update_restarts_only_changed_shards(tmpdir, mock_get_current_location):
+    my_config = {
+        'bind_addr': '0.0.0.0',
+        'config_file': str(tmpdir.join('synapse.conf.json')),
+        'shards': 2,
+        'shard_pins': {'a_service': 0, 'b_service': 1},
+    }
+    services = [
+        ('a_service.main', {'proxy_port': 1234}),
+        ('b_service.main', {'proxy_port': 1235}),
+    ]
+
+    with mock.patch('subprocess.check_call') as mock_check_call:
+        configure_synapse.generate_and_update(
+            my_config, ['1.2.3.4'], services, None, PhaseTimer())
+        assert mock_check_call.call_args_list == [
+            mock.call(['service', 'synapse-0', 'restart']),
+            mock.call(['service', 'synapse-1', 'restart']),
+        ]
+
+        mock_check_call.reset_mock()
+        services[1] = ('b_service.main', {'proxy_port': 1236})
+        configure_synapse.generate_and_update(
+            my_config, ['1.2.3.4'], services, None, PhaseTimer())
+        assert mock_check_call.call_args_list == [
+            mock.call(['service', 'synapse-1', 'restart']),
+        ]
+
+    shard_0 = json.loads(tmpdir.join('synapse-0.conf.json').read())
+    assert shard_0['services'].keys() == ['a_service.main']
+    # Monitoring checks the age of the shard index, which lists the shards
+    assert json.loads(tmpdir.join('synapse.conf.json.shards').read()) == {
+        'shards': [str(tmpdir.join('synapse-0.conf.json')), str(tmpdir.join('synapse-1.conf.json'))],
+    }
+    # The unsharded synapse's config is left alone
+    assert not tmpdir.join('synapse.conf.json').check()
+
+
+def test_update_shard_index_touches_unchanged_index(tmpdir):
+    index = tmpdir.join('synapse.conf.json.shards')
+    configure_synapse.update_shard_index(str(index), ['a', 'b'])
+    inode = index.stat().ino
+    index.setmtime(1000)
+
+    configure_synapse.update_shard_index(str(index), ['a', 'b'])
+    assert index.stat().ino == inode
+    assert index.stat().mtime > 1000
+
+    configure_synapse.update_shard_index(str(index), ['a'])
+    assert json.loads(index.read()) == {'shards': ['a']}
+
+
+def test_generate_configuration_hoists_common_options(mock_get_current_location):
+    services = [
+        ('a_service', {'proxy_port': 1234}),
+        ('b_service', {'proxy_port': 1235, 'retries': 2}),
+    ]
+    plain = configure_synapse.generate_configuration(
+        {'bind_addr': '0.0.0.0'}, ['1.2.3.4'], services)
+    hoisted = configure_synapse.generate_configuration(
+        {'bind_addr': '0.0.0.0', 'hoist_common_options': True}, ['1.2.3.4'], services)
+
+    assert hoisted['haproxy']['defaults'][-2:] == ['option httplog', 'http-check send-state']
+    for name in ('a_service', 'b_service'):
+        assert 'option httplog' in plain['services'][name]['haproxy']['frontend']
+        assert 'option httplog' not in hoisted['services'][name]['haproxy']['frontend']
+        assert 'http-check send-state' not in hoisted['services'][name]['haproxy']['listen']
+    assert 'retries 2' in hoisted['services']['b_service']['haproxy']['listen']
+
+
+def test_main_profile(tmpdir):
+    profile_path = str(tmpdir.join('configure_synapse.prof'))
+    with setup_mocks_for_main(str(tmpdir.join('synapse.conf.json'))):
+        with mock.patch('sys.argv', ['configure_synapse', '--profile', profile_path]):
+            configure_synapse.main()
+    assert pstats.Stats(profile_path).total_calls > 0
+
+
+def test_run_once_records_phases(tmpdir):
+    timer = PhaseTimer()
+    with setup_mocks_for_main(str(tmpdir.join('synapse.conf.json'))):
+        configure_synapse.run_once(timer)
+    assert [name for (name, _) in timer.phases] == [
+        'get_config',
+        'get_zookeeper_topology',
+        'get_all_namespaces',
+        'generate_configuration',
+        'serialization',
+        'comparison',
+        'publish',
+        'restart',
+    ]
+
+
+def test_main_watch_mode():
+    with contextlib.nested(
+            mock.patch('sys.argv', ['configure_synapse', '--watch']),
+            mock.patch('synapse_tools.configure_synapse.get_config'),
+            mock.patch('synapse_tools.configure_synapse.watch')) as (
+            _, mock_get_config, mock_watch):
         configure_synapse.main()
+    assert mock_watch.called
+    assert not mock_get_config.called
 
-        mock_copy.assert_called_with(
-            mock_tmp_file.__enter__().name, '/etc/synapse/synapse.conf.json')
-        assert not mock_subprocess_check_call.called
+
+def test_watch_reloads_only_changed_inputs():
+    mock_watcher = mock.Mock()
+    mock_watcher.wait_for_changes.side_effect = [
+        set([configure_synapse.ZOOKEEPER_TOPOLOGY_PATH]),
+        StopIteration,
+    ]
+    with contextlib.nested(
+            mock.patch('synapse_tools.configure_synapse.FileWatcher', return_value=mock_watcher),
+            mock.patch('synapse_tools.configure_synapse.get_config', return_value={'config_file': 'foo'}),
+            mock.patch('synapse_tools.configure_synapse.get_zookeeper_topology', side_effect=[['zk1:2181'], ['zk2:2181']]),
+            mock.patch('synapse_tools.configure_synapse.NamespaceLoader'),
+            mock.patch('synapse_tools.configure_synapse.generate_configuration'),
+            mock.patch('synapse_tools.configure_synapse.update_synapse_config')) as (
+            _, mock_get_config, _, mock_namespace_loader, mock_generate, mock_update):
+        with pytest.raises(StopIteration):
+            configure_synapse.watch()
+
+    assert mock_get_config.call_count == 1
+    assert mock_namespace_loader.return_value.get_all_namespaces.call_count == 1
+    assert [c[0][1] for c in mock_generate.call_args_list] == [['zk1:2181'], ['zk2:2181']]
+    assert mock_update.call_count == 2
+
+
+def test_watch_stanza_cache(tmpdir):
+    with mock.patch.object(configure_synapse, 'STANZA_FILE_CACHE_PATH',
+                           str(tmpdir.join('stanza_cache.jsonl'))):
+        cache = configure_synapse.watch_stanza_cache({}, None)
+        assert isinstance(cache, StanzaCache)
+        assert configure_synapse.watch_stanza_cache({}, cache) is cache
+
+        # Streaming keeps stanzas on disk rather than in memory
+        file_cache = configure_synapse.watch_stanza_cache(
+            {'streaming_output': True}, cache)
+        assert isinstance(file_cache, StanzaFileCache)
+        assert configure_synapse.watch_stanza_cache(
+            {'streaming_output': True}, file_cache) is file_cache
+        assert isinstance(configure_synapse.watch_stanza_cache({}, file_cache), StanzaCache)
+
+
+def haproxy_for_service(service_info):
+    actual_configuration = configure_synapse.generate_configuration(
+        synapse_tools_config={'bind_addr': '0.0.0.0'},
+        zookeeper_topology=['1.2.3.4'],
+        services=[('test_service', dict(service_info, proxy_port=1234))]
+    )
+    return actual_configuration['services']['test_service']['haproxy']
+
+
+def test_keepalive_defaults_to_forceclose(mock_get_current_location):
+    haproxy = haproxy_for_service({})
+    assert not any('keep-alive' in option for option in haproxy['listen'])
+    assert haproxy['backend'] == []
+
+
+def test_keepalive_mode(mock_get_current_location):
+    haproxy = haproxy_for_service({
+        'keepalive_mode': 'http-server-close', 'timeout_keepalive_ms': 500})
+    assert haproxy['listen'][-2:] == [
+        'option http-server-close', 'timeout http-keep-alive 500ms']
+    assert haproxy['backend'] == []
+
+
+def test_http_reuse_implies_keepalive(mock_get_current_location):
+    haproxy = haproxy_for_service({'http_reuse': 'safe'})
+    assert haproxy['listen'][-2:] == [
+        'option http-keep-alive', 'timeout http-keep-alive 1000ms']
+    assert haproxy['backend'] == ['http-reuse safe']
+
+
+def test_http_reuse_ignored_with_forceclose(mock_get_current_location):
+    with mock.patch.object(configure_synapse, 'log') as mock_log:
+        haproxy = haproxy_for_service(
+            {'keepalive_mode': 'forceclose', 'http_reuse': 'safe'})
+    assert haproxy['backend'] == []
+    assert mock_log.warn.call_count == 1
+    assert 'http_reuse safe' in mock_log.warn.call_args[0][0]
+
+
+def test_keepalive_ignored_for_tcp_and_unknown_modes(mock_get_current_location):
+    for service_info in (
+            {'mode': 'tcp', 'keepalive_mode': 'http-keep-alive'},
+            {'keepalive_mode': 'bogus', 'http_reuse': 'bogus'}):
+        haproxy = haproxy_for_service(service_info)
+        assert not any('keep-alive' in option for option in haproxy['listen'])
+        assert haproxy['backend'] == []
+
+
+def test_service_priority(mock_get_current_location):
+    services = [
+        ('a_service', {'proxy_port': 1234, 'priority': 'fastest'}),
+        ('b_service', {'proxy_port': 1235}),
+    ]
+    synapse_config = configure_synapse.generate_configuration(
+        {'bind_addr': '0.0.0.0'}, ['1.2.3.4'], services)
+    assert synapse_config['services']['a_service']['priority'] == 'fastest'
+    assert 'priority' not in synapse_config['services']['b_service']
+
+
+def test_generate_and_update_writes_priority_map(tmpdir, mock_get_current_location):
+    my_config = {
+        'bind_addr': '0.0.0.0',
+        'config_file': str(tmpdir.join('synapse.conf.json')),
+    }
+    services = [
+        ('a_service.main', {'proxy_port': 1234, 'priority': 'slow'}),
+        ('b_service.main', {'proxy_port': 1235, 'priority': 'bogus'}),
+    ]
+    with contextlib.nested(
+            mock.patch('subprocess.check_call'),
+            mock.patch('synapse_tools.traffic_priority.log'),
+            mock.patch.object(configure_synapse, 'update_priority_map')) as (
+            _, mock_log, mock_update_priority_map):
+        configure_synapse.generate_and_update(
+            my_config, ['1.2.3.4'], services, None, PhaseTimer())
+    mock_update_priority_map.assert_called_once_with(
+        {1234: 'slow'}, configure_synapse.PRIORITY_MAP_PATH)
+    # The unknown priority is only reported once, and not written out
+    assert mock_log.warn.call_count == 1
+    synapse_config = json.loads(tmpdir.join('synapse.conf.json').read())
+    assert 'priority' not in synapse_config['services']['b_service.main']
 
 
 def test_chaos_delay(mock_get_current_location):
@@ -213,3 +596,169 @@ def test_chaos_error_503(mock_get_current_location):
             ]
         )
         assert actual_configuration['services']['test_service']['discovery']['method'] == 'base'
+
+
+def test_resolve_grouping_is_memoized(tmpdir):
+    tmpdir.join('ecosystem').write('my_ecosystem\n')
+    with contextlib.nested(
+            mock.patch.object(configure_synapse, 'GROUPINGS_DIR', str(tmpdir)),
+            mock.patch.object(configure_synapse, 'shared_resolution_cache', ResolutionCache()),
+            mock.patch.object(configure_synapse, 'get_my_grouping',
+                              wraps=configure_synapse.get_my_grouping)) as (
+            _, _, grouping_mock):
+        assert configure_synapse.resolve_grouping('ecosystem') == 'my_ecosystem'
+        assert configure_synapse.resolve_grouping('ecosystem') == 'my_ecosystem'
+    grouping_mock.assert_called_once_with('ecosystem')
+
+
+def test_generate_base_config_preserves_server_state():
+    with mock.patch.object(configure_synapse, 'resolve_haproxy_version', return_value=(1, 6)):
+        haproxy = configure_synapse.generate_base_config(
+            {'bind_addr': '0.0.0.0', 'haproxy.preserve_server_state': True, 'shard': 1})['haproxy']
+    assert 'server-state-file /var/run/synapse/haproxy-1.state' in haproxy['global']
+    assert haproxy['defaults'][-1] == 'load-server-state-from-file global'
+    assert haproxy['reload_command'].startswith(
+        '/usr/bin/synapse_dump_server_state /var/run/synapse/haproxy-1.sock '
+        '/var/run/synapse/haproxy-1.state; sudo ')
+
+
+def test_server_state_needs_haproxy_1_6():
+    my_config = {'bind_addr': '0.0.0.0', 'haproxy.preserve_server_state': True}
+    expected = configure_synapse.generate_base_config({'bind_addr': '0.0.0.0'})
+    for version in ((1, 5), None):
+        with contextlib.nested(
+                mock.patch.object(configure_synapse, 'resolve_haproxy_version', return_value=version),
+                mock.patch.object(configure_synapse, 'log')) as (_, mock_log):
+            assert configure_synapse.generate_base_config(my_config) == expected
+        assert mock_log.warn.call_count == 1
+
+
+def test_generate_base_config_plug_limits():
+    default = configure_synapse.generate_base_config({'bind_addr': '0.0.0.0'})['haproxy']
+    assert default['reload_command'].startswith(
+        'sudo /usr/bin/synapse_qdisc_tool protect --wait-listening ')
+
+    haproxy = configure_synapse.generate_base_config({
+        'bind_addr': '0.0.0.0',
+        'haproxy.plug_limit_min_bytes': 5000,
+        'haproxy.plug_limit_max_bytes': 200000,
+    })['haproxy']
+    assert haproxy['reload_command'].startswith(
+        'sudo /usr/bin/synapse_qdisc_tool protect '
+        '--min-plug-limit-bytes 5000 --max-plug-limit-bytes 200000 --wait-listening ')
+
+
+def test_get_haproxy_version():
+    for (output, version) in (
+            ('HA-Proxy version 1.5.14 2015/07/02\nCopyright 2000-2015 Willy Tarreau\n', (1, 5)),
+            ('HAProxy version 2.4.22-0ubuntu0.22.04.2 2023/08/14 - https://haproxy.org/\n', (2, 4)),
+            ('something else\n', None)):
+        with mock.patch('subprocess.check_output', return_value=output):
+            assert configure_synapse.get_haproxy_version() == version
+    with mock.patch('subprocess.check_output', side_effect=OSError):
+        assert configure_synapse.get_haproxy_version() is None
+
+
+def test_seamless_reload():
+    my_config = {'bind_addr': '0.0.0.0', 'haproxy.reload_strategy': 'seamless'}
+    with mock.patch.object(configure_synapse, 'resolve_haproxy_version', return_value=(1, 8)):
+        haproxy = configure_synapse.generate_base_config(my_config)['haproxy']
+    assert ('stats socket /var/run/synapse/haproxy.sock level admin expose-fd listeners'
+            in haproxy['global'])
+    assert haproxy['reload_command'].startswith(
+        'touch /var/run/synapse/haproxy.pid && PID=$(cat /var/run/synapse/haproxy.pid) && '
+        '{ [ -S /var/run/synapse/haproxy.sock ] && '
+        'cmp -s /var/run/synapse/haproxy.pid /var/run/synapse/haproxy.pid.exposed && '
+        'kill -0 $PID && '
+        '/usr/bin/haproxy-synapse -f /var/run/synapse/haproxy.cfg -p /var/run/synapse/haproxy.pid '
+        '-x /var/run/synapse/haproxy.sock -sf $PID || '
+        'sudo /usr/bin/synapse_qdisc_tool protect ')
+    assert haproxy['reload_command'].endswith(
+        '; } && cp /var/run/synapse/haproxy.pid /var/run/synapse/haproxy.pid.exposed')
+
+
+@pytest.yield_fixture
+def seamless_reload(tmpdir):
+    """Run the seamless reload command against a fake haproxy, which logs
+    its arguments, and a fake protected reload, which logs 'protected'.  The
+    fake haproxy fails to fetch the sockets if fail_x exists."""
+    log = tmpdir.join('log')
+    haproxy = tmpdir.join('haproxy')
+    haproxy.write(
+        '#!/bin/bash\n'
+        'echo "$@" >> {0}\n'
+        'if [[ "$*" == *" -x "* && -e {1} ]]; then exit 1; fi\n'.format(
+            log, tmpdir.join('fail_x')))
+    haproxy.chmod(0755)
+    paths = dict(
+        (name, tmpdir.join(name)) for name in ('haproxy.cfg', 'haproxy.pid', 'haproxy.sock'))
+    with contextlib.nested(
+            mock.patch.object(configure_synapse, 'HAPROXY_PATH', str(haproxy)),
+            mock.patch.object(configure_synapse, 'HAPROXY_PROTECTED_RELOAD_CMD',
+                              'echo protected >> {0}'.format(log))):
+        command = configure_synapse.haproxy_reload_command(
+            str(paths['haproxy.cfg']), str(paths['haproxy.pid']),
+            socket_path=str(paths['haproxy.sock']), seamless=True)
+
+    def reload():
+        if log.check():
+            log.remove()
+        subprocess.check_call(['bash', '-c', command])
+        return log.read().splitlines()
+
+    yield (reload, paths)
+
+
+def test_seamless_reload_without_old_process(tmpdir, seamless_reload):
+    (reload, paths) = seamless_reload
+    # Nothing is running yet, as at boot
+    assert reload() == ['protected']
+    # The haproxy started by the protected reload exposes its listeners
+    assert tmpdir.join('haproxy.pid.exposed').check()
+
+    # A stale socket left by a crashed haproxy isn't used either
+    sock = socket.socket(socket.AF_UNIX)
+    sock.bind(str(paths['haproxy.sock']))
+    paths['haproxy.pid'].write('999999999\n')
+    paths['haproxy.pid'].copy(tmpdir.join('haproxy.pid.exposed'))
+    assert reload() == ['protected']
+    sock.close()
+
+
+def test_seamless_reload_hands_over_sockets(tmpdir, seamless_reload):
+    (reload, paths) = seamless_reload
+    sock = socket.socket(socket.AF_UNIX)
+    sock.bind(str(paths['haproxy.sock']))
+    paths['haproxy.pid'].write('%d\n' % os.getpid())
+
+    # The running haproxy wasn't started with expose-fd listeners
+    assert reload() == ['protected']
+
+    (line,) = reload()
+    assert ' -x {0} -sf {1}'.format(paths['haproxy.sock'], os.getpid()) in line
+
+    tmpdir.join('fail_x').write('')
+    assert reload()[1:] == ['protected']
+    sock.close()
+
+
+def test_seamless_reload_falls_back_to_qdisc():
+    my_config = {'bind_addr': '0.0.0.0', 'haproxy.reload_strategy': 'seamless'}
+    expected = configure_synapse.generate_base_config({'bind_addr': '0.0.0.0'})
+    for version in ((1, 5), None):
+        with mock.patch.object(configure_synapse, 'resolve_haproxy_version', return_value=version):
+            assert configure_synapse.generate_base_config(my_config) == expected
+
+
+def test_unknown_reload_strategy():
+    my_config = {'bind_addr': '0.0.0.0', 'haproxy.reload_strategy': 'seamles'}
+    with pytest.raises(ValueError):
+        configure_synapse.generate_base_config(my_config)
+
+
+def test_get_config_rejects_invalid_shards(tmpdir):
+    config_path = tmpdir.join('synapse-tools.conf.json')
+    config_path.write('{"shards": 0}')
+    with mock.patch.object(configure_synapse, 'SYNAPSE_TOOLS_CONFIG_PATH', str(config_path)):
+        with pytest.raises(ValueError):
+            configure_synapse.get_config()
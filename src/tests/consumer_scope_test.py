@@ -0,0 +1,77 @@
+import mock
+
+from synapse_tools import consumer_scope
+
+
+SERVICES = [
+    ('service_one.main', {'proxy_port': 1}),
+    ('service_one.canary', {'proxy_port': 2}),
+    ('service_two.main', {'proxy_port': 3}),
+    ('service_three.main', {'proxy_port': 4}),
+    ('service_four.main', {}),
+]
+
+
+def test_scope_services_is_a_no_op_when_not_configured():
+    assert consumer_scope.scope_services({}, SERVICES) == SERVICES
+
+
+def test_filter_services_matches_namespaces_and_whole_services():
+    scoped = consumer_scope.filter_services(
+        SERVICES, set(['service_one', 'service_two.main']))
+    assert [name for (name, _) in scoped] == [
+        'service_one.main', 'service_one.canary', 'service_two.main']
+
+
+def test_scope_services_from_file_and_local_services(tmpdir):
+    dependencies_file = tmpdir.join('dependencies.yaml')
+    dependencies_file.write('- service_three.main\n')
+    tmpdir.mkdir('soa').mkdir('service_four').join('dependencies.yaml').write(
+        'main:\n'
+        '  - smartstack: service_two.main\n'
+        '  - well-known: memcached\n'
+        'canary:\n'
+        '  - smartstack: service_one.canary\n'
+    )
+
+    scoped = consumer_scope.scope_services(
+        {
+            'consumer_dependencies_file': str(dependencies_file),
+            'consumer_local_services': ['service_four', 'service_missing'],
+        },
+        SERVICES,
+        soa_dir=str(tmpdir.join('soa')),
+    )
+
+    assert [name for (name, _) in scoped] == [
+        'service_one.canary', 'service_two.main', 'service_three.main']
+
+
+def test_unusable_dependencies_file_disables_scoping(tmpdir):
+    dependencies_file = tmpdir.join('dependencies.yaml')
+    for contents in ('', '[]\n', '{not: a list}\n', '- [unclosed\n'):
+        dependencies_file.write(contents)
+        assert consumer_scope.scope_services(
+            {'consumer_dependencies_file': str(dependencies_file),
+             'consumer_local_services': ['service_missing']},
+            SERVICES, soa_dir=str(tmpdir)) == SERVICES
+
+    assert consumer_scope.scope_services(
+        {'consumer_dependencies_file': str(tmpdir.join('missing.yaml'))},
+        SERVICES) == SERVICES
+
+
+def test_no_local_dependencies_disables_scoping(tmpdir):
+    assert consumer_scope.scope_services(
+        {'consumer_local_services': ['service_missing']},
+        SERVICES, soa_dir=str(tmpdir)) == SERVICES
+
+
+def test_scope_services_counts_only_proxied_services(tmpdir):
+    dependencies_file = tmpdir.join('dependencies.yaml')
+    dependencies_file.write('- service_one\n')
+    with mock.patch.object(consumer_scope, 'log') as mock_log:
+        consumer_scope.scope_services(
+            {'consumer_dependencies_file': str(dependencies_file)}, SERVICES)
+    mock_log.info.assert_called_once_with(
+        'Consumer scoping kept 2 of 4 proxied services (2 dropped)')
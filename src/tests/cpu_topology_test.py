@@ -0,0 +1,94 @@
+import mock
+import pytest
+
+from synapse_tools import configure_synapse
+from synapse_tools import cpu_topology
+
+
+def make_cpuinfo(cpus):
+    return '\n\n'.join(
+        'processor\t: %d\nmodel name\t: Fake CPU\nphysical id\t: %d\ncore id\t\t: %d' % cpu
+        for cpu in cpus
+    ) + '\n\n'
+
+
+# Two sockets of two cores with two hyperthreads each, numbered the way Linux
+# usually does: every core's first thread, then every core's second thread.
+TWO_SOCKETS_WITH_HYPERTHREADS = [
+    (0, 0, 0), (1, 0, 1), (2, 1, 0), (3, 1, 1),
+    (4, 0, 0), (5, 0, 1), (6, 1, 0), (7, 1, 1),
+]
+
+# Siblings numbered adjacently instead
+ADJACENT_SIBLINGS = [(0, 0, 0), (1, 0, 0), (2, 0, 1), (3, 0, 1)]
+
+
+def test_parse_cpuinfo():
+    cpuinfo = make_cpuinfo(TWO_SOCKETS_WITH_HYPERTHREADS)
+    assert cpu_topology.parse_cpuinfo(cpuinfo) == TWO_SOCKETS_WITH_HYPERTHREADS
+
+
+def test_parse_cpuinfo_without_topology():
+    cpuinfo = 'processor\t: 0\nmodel name\t: VM\n\nprocessor\t: 1\nmodel name\t: VM\n'
+    topology = cpu_topology.parse_cpuinfo(cpuinfo)
+    assert topology == [(0, 0, 0), (1, 0, 1)]
+    assert cpu_topology.physical_core_count(topology) == 2
+
+
+def test_spread_cpus_prefers_physical_cores():
+    assert cpu_topology.physical_core_count(TWO_SOCKETS_WITH_HYPERTHREADS) == 4
+    assert cpu_topology.spread_cpus(TWO_SOCKETS_WITH_HYPERTHREADS) == [0, 1, 2, 3, 4, 5, 6, 7]
+    assert cpu_topology.spread_cpus(ADJACENT_SIBLINGS) == [0, 2, 1, 3]
+
+
+def test_haproxy_concurrency_not_configured():
+    read_topology = mock.Mock()
+    assert cpu_topology.haproxy_concurrency({}, read_topology=read_topology) == (1, 1, [])
+    assert not read_topology.called
+
+
+def test_haproxy_concurrency_auto_processes():
+    (processes, threads, lines) = cpu_topology.haproxy_concurrency(
+        {'haproxy.nbproc': 'auto'}, read_topology=lambda: ADJACENT_SIBLINGS)
+    assert (processes, threads) == (2, 1)
+    assert lines == ['nbproc 2', 'cpu-map 1 0', 'cpu-map 2 2']
+
+
+def test_haproxy_concurrency_threads_per_shard():
+    (processes, threads, lines) = cpu_topology.haproxy_concurrency(
+        {'haproxy.nbthread': 3, 'haproxy.cpu_map': True}, shard=1,
+        read_topology=lambda: TWO_SOCKETS_WITH_HYPERTHREADS)
+    assert (processes, threads) == (1, 3)
+    assert lines == ['nbthread 3', 'cpu-map 1/1 3', 'cpu-map 1/2 4', 'cpu-map 1/3 5']
+
+
+def test_haproxy_concurrency_without_cpu_map():
+    assert cpu_topology.haproxy_concurrency(
+        {'haproxy.nbthread': 2, 'haproxy.cpu_map': False},
+        read_topology=lambda: ADJACENT_SIBLINGS) == (1, 2, ['nbthread 2'])
+
+
+def test_haproxy_concurrency_rejects_processes_and_threads():
+    with pytest.raises(ValueError):
+        cpu_topology.haproxy_concurrency(
+            {'haproxy.nbproc': 2, 'haproxy.nbthread': 2},
+            read_topology=lambda: ADJACENT_SIBLINGS)
+
+
+def test_generate_base_config_with_processes():
+    with mock.patch.object(cpu_topology, 'read_cpu_topology', return_value=ADJACENT_SIBLINGS):
+        base_config = configure_synapse.generate_base_config(
+            {'bind_addr': '0.0.0.0', 'haproxy.nbproc': 2})
+
+    haproxy = base_config['haproxy']
+    assert haproxy['global'][:6] == [
+        'daemon',
+        'nbproc 2',
+        'cpu-map 1 0',
+        'cpu-map 2 2',
+        'maxconn 10000',
+        'stats socket /var/run/synapse/haproxy.sock level admin process 1',
+    ]
+    assert 'stats socket /var/run/synapse/haproxy.sock.2 level admin process 2' in haproxy['global']
+    assert haproxy['extra_sections']['listen stats'][:2] == ['bind :3212', 'bind-process 1']
+    assert haproxy['do_socket'] is False
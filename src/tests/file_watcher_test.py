@@ -0,0 +1,29 @@
+import os
+
+from synapse_tools.file_watcher import FileWatcher
+
+
+def test_watch_file_detects_replacement(tmpdir):
+    path = tmpdir.join('synapse-tools.conf.json')
+    path.write('{}')
+    watcher = FileWatcher()
+    watcher.watch_file(str(path))
+
+    tmpdir.join('unrelated').write('')
+    assert watcher.wait_for_changes(0.05) == set()
+
+    tmpdir.join('new').write('{"bind_addr": "0.0.0.0"}')
+    os.rename(str(tmpdir.join('new')), str(path))
+    assert watcher.wait_for_changes(1, settle_s=0.01) == set([str(path)])
+
+
+def test_watch_tree_detects_nested_changes(tmpdir):
+    soa_dir = tmpdir.mkdir('services')
+    soa_dir.mkdir('service_one').join('smartstack.yaml').write('main: {}')
+    watcher = FileWatcher()
+    watcher.watch_tree(str(soa_dir))
+
+    soa_dir.join('service_one', 'smartstack.yaml').write('main: {proxy_port: 1}')
+    soa_dir.join('service_one', 'port').write('1')
+    assert watcher.wait_for_changes(1, settle_s=0.01) == set([str(soa_dir)])
+    assert watcher.wait_for_changes(0.05) == set()
@@ -1,4 +1,7 @@
+import contextlib
+
 import mock
+import pytest
 
 from synapse_tools import haproxy_synapse_reaper
 
@@ -46,8 +49,8 @@ def create_mock_process(pid, name='haproxy-synapse', create_time=0):
 
 
 @mock.patch('synapse_tools.haproxy_synapse_reaper.psutil.process_iter')
-@mock.patch('synapse_tools.haproxy_synapse_reaper.get_main_pid')
-def test_get_alumni(mock_get_main_pid, mock_process_iter):
+@mock.patch('synapse_tools.haproxy_synapse_reaper.get_main_pids')
+def test_get_alumni(mock_get_main_pids, mock_process_iter):
     # main instance
     proc_0 = create_mock_process(pid=0)
 
@@ -59,7 +62,7 @@ def test_get_alumni(mock_get_main_pid, mock_process_iter):
     proc_3 = create_mock_process(pid=5, name='some-other-proc')
 
     mock_process_iter.return_value = [proc_0, proc_1, proc_2, proc_3]
-    mock_get_main_pid.return_value = 0
+    mock_get_main_pids.return_value = set([0])
 
     expected = [proc_1, proc_2]
     actual = haproxy_synapse_reaper.get_alumni('nobody')
@@ -67,6 +70,37 @@ def test_get_alumni(mock_get_main_pid, mock_process_iter):
     assert expected == list(actual)
 
 
+def test_get_main_pids_includes_every_shard(tmpdir):
+    for (name, pid) in (('haproxy-0.pid', '10\n'), ('haproxy-1.pid', '11\n')):
+        tmpdir.join(name).write(pid)
+    with contextlib.nested(
+            mock.patch.object(haproxy_synapse_reaper, 'HAPROXY_SYNAPSE_PIDFILE',
+                              str(tmpdir.join('haproxy.pid'))),
+            mock.patch.object(haproxy_synapse_reaper, 'HAPROXY_SYNAPSE_SHARD_PIDFILES',
+                              str(tmpdir.join('haproxy-*.pid')))):
+        assert haproxy_synapse_reaper.get_main_pids() == set([10, 11])
+
+        for name in ('haproxy-0.pid', 'haproxy-1.pid'):
+            tmpdir.join(name).remove()
+        with pytest.raises(IOError):
+            haproxy_synapse_reaper.get_main_pids()
+
+
+def test_get_main_pids_includes_every_process(tmpdir):
+    tmpdir.join('haproxy.pid').write('10\n11\n12\n')
+    with contextlib.nested(
+            mock.patch.object(haproxy_synapse_reaper, 'HAPROXY_SYNAPSE_PIDFILE',
+                              str(tmpdir.join('haproxy.pid'))),
+            mock.patch.object(haproxy_synapse_reaper, 'HAPROXY_SYNAPSE_SHARD_PIDFILES',
+                              str(tmpdir.join('haproxy-*.pid')))):
+        assert haproxy_synapse_reaper.get_main_pids() == set([10, 11, 12])
+
+        tmpdir.join('haproxy-0.pid').write('20\n21\n')
+        tmpdir.join('haproxy-1.pid').write('30\n')
+        tmpdir.join('haproxy.pid').remove()
+        assert haproxy_synapse_reaper.get_main_pids() == set([20, 21, 30])
+
+
 @mock.patch('synapse_tools.haproxy_synapse_reaper.time.time')
 @mock.patch('synapse_tools.haproxy_synapse_reaper.os.path.getctime')
 @mock.patch('synapse_tools.haproxy_synapse_reaper.os.path.exists')
@@ -0,0 +1,93 @@
+import mock
+import pytest
+
+from synapse_tools.haproxy import iptables_rules
+
+
+SAVE_OUTPUT = """# Generated by iptables-save v1.4.21
+*mangle
+:PREROUTING ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+-A OUTPUT -p udp -j ACCEPT
+-A OUTPUT -s 1.2.3.4/32 -m comment --comment synapse_qdisc_tool -j MARK --set-xmark 0x1/0xffffffff
+-A OUTPUT -s 1.2.3.4/32 -m comment --comment synapse_qdisc_tool -j MARK --set-xmark 0x1/0xffffffff
+-A OUTPUT -s 5.6.7.8/32 -j MARK --set-xmark 0x1/0xffffffff
+-A PREROUTING -m comment --comment synapse_qdisc_tool -j ACCEPT
+COMMIT
+"""
+
+LEGACY_RULE = '-A OUTPUT -s 5.6.7.8/32 -j MARK --set-xmark 0x1/0xffffffff'
+
+
+@pytest.fixture
+def manager():
+    return iptables_rules.RuleManager(legacy_rules=[LEGACY_RULE])
+
+
+@pytest.yield_fixture
+def mock_local():
+    save = mock.Mock(return_value=SAVE_OUTPUT)
+    restore = mock.MagicMock()
+    with mock.patch.object(
+        iptables_rules, 'local', {'iptables-save': save, 'iptables-restore': restore},
+    ):
+        yield (save, restore)
+
+
+def test_rule(manager):
+    assert manager.rule('-s 1.2.3.4/32', 'ACCEPT') == (
+        '-A OUTPUT -s 1.2.3.4/32 -m comment --comment synapse_qdisc_tool -j ACCEPT'
+    )
+
+
+def test_current_rules(manager, mock_local):
+    (save, _) = mock_local
+    assert manager.current_rules() == [
+        manager.rule('-s 1.2.3.4/32', 'MARK --set-xmark 0x1/0xffffffff'),
+        manager.rule('-s 1.2.3.4/32', 'MARK --set-xmark 0x1/0xffffffff'),
+        LEGACY_RULE,
+    ]
+    save.assert_called_once_with('-t', 'mangle')
+
+
+def test_plan(manager):
+    a = manager.rule('-s 1.2.3.4/32', 'ACCEPT')
+    b = manager.rule('-s 5.6.7.8/32', 'ACCEPT')
+    assert manager.plan([a, b], [a, b]) == ([], [])
+    assert manager.plan([a, a, LEGACY_RULE], [a, b]) == ([a, LEGACY_RULE], [b])
+    assert manager.plan([a, b], []) == ([a, b], [])
+
+
+def test_restore_input(manager):
+    a = manager.rule('-s 1.2.3.4/32', 'ACCEPT')
+    b = manager.rule('-s 5.6.7.8/32', 'ACCEPT')
+    assert manager.restore_input([LEGACY_RULE], [a, b]) == '\n'.join([
+        '*mangle',
+        '-D OUTPUT -s 5.6.7.8/32 -j MARK --set-xmark 0x1/0xffffffff',
+        '-I OUTPUT 1 -s 1.2.3.4/32 -m comment --comment synapse_qdisc_tool -j ACCEPT',
+        '-I OUTPUT 2 -s 5.6.7.8/32 -m comment --comment synapse_qdisc_tool -j ACCEPT',
+        'COMMIT',
+    ]) + '\n'
+
+
+def test_sync_applies_changes_in_one_restore(manager, mock_local):
+    (_, restore) = mock_local
+    rule = manager.rule('-s 1.2.3.4/32', 'MARK --set-xmark 0x1/0xffffffff')
+
+    changes = manager.sync([rule])
+
+    assert changes == ['-D' + rule[2:], '-D' + LEGACY_RULE[2:]]
+    noflush = restore.__getitem__.return_value
+    restore.__getitem__.assert_called_once_with('--noflush')
+    noflush.__lshift__.assert_called_once_with(
+        manager.restore_input([rule, LEGACY_RULE], []))
+    noflush.__lshift__.return_value.assert_called_once_with()
+
+
+def test_sync_is_idempotent(manager, mock_local):
+    (save, restore) = mock_local
+    rule = manager.rule('-s 1.2.3.4/32', 'MARK --set-xmark 0x1/0xffffffff')
+    save.return_value = '*mangle\n%s\nCOMMIT\n' % rule
+
+    assert manager.sync([rule]) == []
+    assert not restore.__getitem__.called
@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+from synapse_tools.json_stream import COMPACT
+from synapse_tools.json_stream import INDENTED
+from synapse_tools.json_stream import iter_json_chunks
+from synapse_tools.json_stream import StreamedDict
+
+
+CONFIG = {
+    'file_output': {'output_directory': '/var/run/synapse/services'},
+    'haproxy': {
+        'global': ['daemon', 'maxconn 10000'],
+        'extra_sections': {'listen stats': ['bind :3212']},
+        'do_writes': True,
+    },
+    'services': {
+        'service_one.main': {'haproxy': {'listen': ['option httpchk GET /\\r\\nX-Mode:\\ ro']}},
+        'service_two.main': {'discovery': {'method': 'base'}, 'default_servers': []},
+    },
+}
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_matches_json_dumps(compact):
+    streamed = dict(CONFIG, services=StreamedDict(iter(sorted(CONFIG['services'].items()))))
+    expected = json.dumps(CONFIG, sort_keys=True, **(COMPACT if compact else INDENTED))
+    assert ''.join(iter_json_chunks(streamed, compact=compact)) == expected
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_empty_streamed_dict(compact):
+    streamed = dict(CONFIG, services=StreamedDict(iter([])))
+    expected = json.dumps(dict(CONFIG, services={}), sort_keys=True, **(COMPACT if compact else INDENTED))
+    assert ''.join(iter_json_chunks(streamed, compact=compact)) == expected
+
+
+def test_items_are_consumed_lazily():
+    consumed = []
+
+    def items():
+        for name in ('a', 'b'):
+            consumed.append(name)
+            yield (name, {})
+
+    chunks = iter_json_chunks({'services': StreamedDict(items())})
+    assert consumed == []
+    next(chunks)
+    next(chunks)
+    assert consumed == ['a']
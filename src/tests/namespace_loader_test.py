@@ -0,0 +1,66 @@
+import os
+
+import mock
+
+from synapse_tools import namespace_loader
+from synapse_tools.namespace_loader import NamespaceLoader
+
+
+def write_smartstack(soa_dir, service, contents):
+    service_dir = soa_dir.join(service)
+    if not service_dir.check():
+        service_dir.mkdir()
+    service_dir.join('smartstack.yaml').write(contents)
+
+
+def test_get_all_namespaces(tmpdir):
+    write_smartstack(tmpdir, 'service_two', 'main:\n  proxy_port: 20090\n')
+    write_smartstack(tmpdir, 'service_one', 'main:\n  proxy_port: 20028\ncanary:\n  mode: tcp\n')
+    tmpdir.mkdir('service_three').join('port').write('1024')
+
+    loader = NamespaceLoader(soa_dir=str(tmpdir), processes=1)
+    assert loader.get_all_namespaces() == [
+        ('service_one.canary', {'mode': 'tcp'}),
+        ('service_one.main', {'proxy_port': 20028}),
+        ('service_two.main', {'proxy_port': 20090}),
+    ]
+    assert loader.parsed == 2
+
+
+def test_unchanged_files_are_not_reparsed(tmpdir):
+    write_smartstack(tmpdir, 'service_one', 'main:\n  proxy_port: 20028\n')
+    write_smartstack(tmpdir, 'service_two', 'main:\n  proxy_port: 20090\n')
+    index_path = str(tmpdir.join('index.json'))
+
+    loader = NamespaceLoader(soa_dir=str(tmpdir), processes=1)
+    loader.get_all_namespaces()
+    loader.save(index_path)
+
+    write_smartstack(tmpdir, 'service_two', 'main:\n  proxy_port: 20091\n')
+    path = str(tmpdir.join('service_two', 'smartstack.yaml'))
+    os.utime(path, (0, 0))
+    tmpdir.join('service_one').remove()
+
+    loader = NamespaceLoader.load(index_path, soa_dir=str(tmpdir), processes=1)
+    with mock.patch.object(namespace_loader, 'parse_smartstack_file',
+                           wraps=namespace_loader.parse_smartstack_file) as parse_mock:
+        assert loader.get_all_namespaces() == [('service_two.main', {'proxy_port': 20091})]
+    parse_mock.assert_called_once_with(path)
+    assert loader.index.keys() == [path]
+
+
+def test_large_changes_are_parsed_in_a_pool(tmpdir):
+    for i in range(namespace_loader.MIN_FILES_FOR_POOL):
+        write_smartstack(tmpdir, 'service_%d' % i, 'main:\n  proxy_port: %d\n' % i)
+
+    loader = NamespaceLoader(soa_dir=str(tmpdir), processes=2)
+    with mock.patch.object(namespace_loader.multiprocessing, 'Pool',
+                           wraps=namespace_loader.multiprocessing.Pool) as pool_mock:
+        namespaces = loader.get_all_namespaces()
+    pool_mock.assert_called_once_with(2)
+    assert len(namespaces) == namespace_loader.MIN_FILES_FOR_POOL
+
+
+def test_load_missing_index(tmpdir):
+    loader = NamespaceLoader.load(str(tmpdir.join('missing')), soa_dir=str(tmpdir))
+    assert loader.index == {}
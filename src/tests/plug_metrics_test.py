@@ -0,0 +1,125 @@
+from synapse_tools.haproxy import plug_metrics
+
+
+def test_build_record():
+    record = plug_metrics.build_record(
+        plug_start=100.0,
+        plug_end=100.25,
+        command_runtime_s=0.2,
+        status_at_plug={'packets': 10, 'drops': 1, 'qlen': 0, 'backlog': 0},
+        status_at_unplug={'packets': 10, 'drops': 3, 'qlen': 5, 'backlog': 300},
+        returncode=0,
+        plug_limit_bytes=10000,
+    )
+    assert record == {
+        'plug_start': 100.0,
+        'plug_end': 100.25,
+        'plug_duration_ms': 250.0,
+        'command_runtime_ms': 200.0,
+        'plug_backlog_bytes': 300,
+        'plug_qlen': 5,
+        'plug_packets': 7,
+        'plug_drops': 2,
+        'plug_packets_total': 10,
+        'plug_limit_bytes': 10000,
+        'returncode': 0,
+    }
+
+
+def test_build_record_without_status():
+    record = plug_metrics.build_record(100.0, 101.0, None, None, None, None)
+    assert record['plug_duration_ms'] == 1000.0
+    assert record['command_runtime_ms'] is None
+    assert record['plug_drops'] is None
+    assert record['plug_backlog_bytes'] is None
+
+
+def test_append_and_read_records(tmpdir):
+    path = str(tmpdir.join('plug_metrics.jsonl'))
+    assert plug_metrics.read_records(path) == []
+
+    for i in range(5):
+        plug_metrics.append_record({'plug_duration_ms': i}, path)
+    with open(path, 'a') as fp:
+        fp.write('{"partial')
+
+    assert plug_metrics.read_records(path, limit=2) == [
+        {'plug_duration_ms': 3}, {'plug_duration_ms': 4},
+    ]
+
+
+def test_append_record_trims_file(tmpdir, monkeypatch):
+    path = str(tmpdir.join('plug_metrics.jsonl'))
+    monkeypatch.setattr(plug_metrics, 'MAX_FILE_BYTES', 100)
+    monkeypatch.setattr(plug_metrics, 'KEEP_RECORDS', 2)
+
+    for i in range(10):
+        plug_metrics.append_record({'plug_duration_ms': i}, path)
+
+    records = plug_metrics.read_records(path)
+    assert len(records) <= 4
+    assert records[-1] == {'plug_duration_ms': 9}
+
+
+def test_percentile():
+    values = range(1, 101)
+    assert plug_metrics.percentile(values, 50) == 50
+    assert plug_metrics.percentile(values, 99) == 99
+    assert plug_metrics.percentile(values, 100) == 100
+    assert plug_metrics.percentile([7], 90) == 7
+
+
+def test_summarize():
+    records = [
+        {'plug_duration_ms': float(i), 'plug_drops': 0} for i in range(1, 11)
+    ] + [{'plug_duration_ms': 50.0, 'plug_drops': None}]
+
+    records[3]['plug_drops'] = 2
+    summary = plug_metrics.summarize(records)
+
+    assert summary['plug_duration_ms'] == {
+        'p50': 6.0, 'p90': 10.0, 'p99': 50.0, 'max': 50.0, 'count': 11,
+    }
+    assert summary['plug_drops']['count'] == 10
+    assert summary['plug_drops']['overflows'] == 1
+    assert 'command_runtime_ms' not in summary
+    assert '11 reloads, 1 of which dropped packets' in plug_metrics.format_summary(summary, 11)
+
+
+def test_syn_rates():
+    records = [
+        {'plug_start': 100.0, 'plug_packets_total': 1000, 'plug_packets': 5,
+         'plug_duration_ms': 100.0},
+        {'plug_start': 110.0, 'plug_packets_total': 1500},
+        # The qdisc was recreated, so its counter restarted
+        {'plug_start': 120.0, 'plug_packets_total': 20, 'plug_packets': 0,
+         'plug_duration_ms': 100.0},
+    ]
+    assert plug_metrics.syn_rates(records) == [50.0, 50.0]
+
+
+def test_syn_bytes():
+    assert plug_metrics.syn_bytes([]) == plug_metrics.DEFAULT_SYN_BYTES
+    assert plug_metrics.syn_bytes([
+        {'plug_qlen': 2, 'plug_backlog_bytes': 148},
+        {'plug_qlen': 0, 'plug_backlog_bytes': 0},
+    ]) == 74
+
+
+def test_adaptive_plug_limit():
+    assert plug_metrics.adaptive_plug_limit([], min_bytes=5000) is None
+    assert plug_metrics.adaptive_plug_limit(
+        [{'plug_packets': 10, 'plug_duration_ms': None}], min_bytes=5000) is None
+
+    # 1000 SYNs/s of 100 bytes for 0.5s, doubled
+    records = [
+        {'plug_packets': 500, 'plug_duration_ms': 500.0,
+         'plug_qlen': 1, 'plug_backlog_bytes': 100},
+        {'plug_packets': 10, 'plug_duration_ms': 100.0},
+    ]
+    assert plug_metrics.adaptive_plug_limit(
+        records, min_bytes=1000, max_bytes=10 ** 6) == 100000
+    assert plug_metrics.adaptive_plug_limit(
+        records, min_bytes=1000, max_bytes=50000) == 50000
+    assert plug_metrics.adaptive_plug_limit(
+        records, min_bytes=200000, max_bytes=10 ** 6) == 200000
@@ -0,0 +1,81 @@
+import contextlib
+import json
+import subprocess
+
+import mock
+import pytest
+
+# qdisc_tool imports qdisc_util, which imports the tc command
+qdisc_tool = pytest.importorskip('synapse_tools.haproxy.qdisc_tool')
+
+
+@pytest.yield_fixture
+def mock_controller():
+    with contextlib.nested(
+        mock.patch.object(qdisc_tool, 'PlugController'),
+        mock.patch.object(qdisc_tool.os, 'getuid', return_value=0),
+    ) as (mock_controller_class, _):
+        controller = mock_controller_class.return_value
+        controller.timings = []
+        controller.status.side_effect = [
+            {'packets': 10, 'drops': 0, 'qlen': 0, 'backlog': 0},
+            {'packets': 10, 'drops': 1, 'qlen': 2, 'backlog': 120},
+        ]
+        yield controller
+
+
+def protect_args(metrics_file, cmd='true'):
+    return mock.Mock(
+        cmd=cmd, args=[], wait_listening=None, metrics_file=metrics_file,
+        min_plug_limit_bytes=1000, max_plug_limit_bytes=100000)
+
+
+def test_protect_records_metrics(mock_controller, tmpdir):
+    metrics_file = str(tmpdir.join('plug_metrics.jsonl'))
+    with mock.patch.object(qdisc_tool.subprocess, 'check_call'):
+        qdisc_tool.protect_call_cmd(protect_args(metrics_file))
+
+    assert mock_controller.method_calls[:4] == [
+        mock.call.plug(), mock.call.status(), mock.call.status(), mock.call.unplug(),
+    ]
+    with open(metrics_file) as fp:
+        (record,) = [json.loads(line) for line in fp]
+    assert record['returncode'] == 0
+    assert record['plug_packets'] == 3
+    assert record['plug_drops'] == 1
+    assert record['plug_qlen'] == 2
+    assert record['plug_backlog_bytes'] == 120
+    assert record['plug_end'] >= record['plug_start']
+    assert record['command_runtime_ms'] >= 0
+    # Without any history, the plug keeps its current limit
+    qdisc_tool.PlugController.assert_called_once_with('lo', None)
+    assert record['plug_limit_bytes'] is None
+
+
+def test_protect_sizes_plug_limit_from_metrics(mock_controller, tmpdir):
+    metrics_file = str(tmpdir.join('plug_metrics.jsonl'))
+    plug_metrics = qdisc_tool.plug_metrics
+    plug_metrics.append_record(
+        {'plug_packets': 100, 'plug_duration_ms': 200.0,
+         'plug_qlen': 1, 'plug_backlog_bytes': 80}, metrics_file)
+
+    with mock.patch.object(qdisc_tool.subprocess, 'check_call'):
+        qdisc_tool.protect_call_cmd(protect_args(metrics_file))
+
+    # 500 SYNs/s of 80 bytes for 0.2s, doubled
+    qdisc_tool.PlugController.assert_called_once_with('lo', 16000)
+    assert plug_metrics.read_records(metrics_file)[-1]['plug_limit_bytes'] == 16000
+
+
+def test_protect_records_failed_command(mock_controller, tmpdir):
+    metrics_file = str(tmpdir.join('plug_metrics.jsonl'))
+    with mock.patch.object(
+        qdisc_tool.subprocess, 'check_call',
+        side_effect=subprocess.CalledProcessError(3, 'false'),
+    ):
+        with pytest.raises(subprocess.CalledProcessError):
+            qdisc_tool.protect_call_cmd(protect_args(metrics_file))
+
+    assert mock_controller.unplug.call_count == 1
+    with open(metrics_file) as fp:
+        assert json.loads(fp.read())['returncode'] == 3
@@ -0,0 +1,234 @@
+import contextlib
+import struct
+
+import mock
+import pytest
+
+# qdisc_util imports the tc command, so needs it installed
+qdisc_util = pytest.importorskip('synapse_tools.haproxy.qdisc_util')
+
+
+ACK = [{'event': 'NLMSG_ERROR', 'header': {'error': None}}]
+
+
+@pytest.yield_fixture
+def mock_iproute():
+    with mock.patch.object(qdisc_util, 'IPRoute') as mock_iproute_class:
+        ip = mock_iproute_class.return_value
+        ip.link_lookup.return_value = [1]
+        ip.nlm_request.return_value = ACK
+        yield ip
+
+
+def test_plug_controller_reuses_one_socket(mock_iproute):
+    with qdisc_util.PlugController('lo') as controller:
+        controller.plug()
+        controller.unplug()
+        controller.unplug()
+
+    assert mock_iproute.link_lookup.call_count == 1
+    assert mock_iproute.nlm_request.call_count == 3
+    assert mock_iproute.close.call_count == 1
+    # Without a limit, the plug qdisc keeps the one it has
+    assert [name for (name, _) in controller.timings] == [
+        'plug', 'unplug', 'unplug']
+    assert controller.plug_duration_s >= 0
+    assert controller.plugged_at is None
+
+    msg = mock_iproute.nlm_request.call_args_list[0][0][0]
+    assert msg['index'] == 1
+    assert msg['handle'] == 0x400000
+    assert msg['parent'] == 0x10004
+
+
+def test_plug_controller_sets_limit_before_plugging(mock_iproute):
+    with qdisc_util.PlugController('lo', 16000) as controller:
+        controller.plug()
+        controller.unplug()
+
+    options = [
+        struct.unpack('iI', dict(call[0][0]['attrs'])['TCA_OPTIONS'])
+        for call in mock_iproute.nlm_request.call_args_list
+    ]
+    assert options == [
+        (qdisc_util.TCQ_PLUG_LIMIT, 16000),
+        (qdisc_util.TCQ_PLUG_BUFFER, 16000),
+        (qdisc_util.TCQ_PLUG_RELEASE_INDEFINITE, 16000),
+    ]
+
+
+def test_plug_controller_raises_without_ack(mock_iproute):
+    mock_iproute.nlm_request.return_value = []
+    with qdisc_util.PlugController('lo') as controller:
+        with pytest.raises(RuntimeError):
+            controller.plug()
+    assert controller.plugged_at is None
+
+
+def test_plug_controller_status(mock_iproute):
+    qdisc = mock.Mock()
+    qdisc.__getitem__ = lambda self, key: {'handle': 0x400000}[key]
+    qdisc.get_attr.side_effect = {
+        'TCA_KIND': 'plug',
+        'TCA_STATS': {'packets': 5, 'drop': 1, 'qlen': 2, 'backlog': 120},
+    }.get
+    mock_iproute.get_qdiscs.return_value = [qdisc]
+
+    with qdisc_util.PlugController('lo') as controller:
+        assert controller.status() == {
+            'kind': 'plug', 'plugged': False,
+            'packets': 5, 'drops': 1, 'overlimits': None, 'qlen': 2, 'backlog': 120,
+        }
+        mock_iproute.get_qdiscs.return_value = []
+        assert controller.status() is None
+
+
+def expected_description(plug_kind='plug'):
+    qdiscs = [
+        {'handle': handle, 'parent': parent, 'kind': kinds[0]}
+        for (handle, (parent, kinds)) in qdisc_util.EXPECTED_QDISCS.items()
+    ]
+    for qdisc in qdiscs:
+        if qdisc['handle'] == qdisc_util.PLUG_QDISC:
+            qdisc['kind'] = plug_kind
+    return {
+        'qdiscs': qdiscs,
+        'filters': [
+            {'kind': kind, 'handle': handle, 'classid': classid}
+            for (kind, handle, classid) in qdisc_util.EXPECTED_FILTERS
+        ],
+    }
+
+
+def test_format_handle():
+    assert qdisc_util.format_handle(0x10000) == '1:'
+    assert qdisc_util.format_handle(0x10004) == '1:4'
+    assert qdisc_util.format_handle(0x400000) == '40:'
+    assert qdisc_util.format_handle(qdisc_util.TC_H_ROOT) == 'root'
+
+
+def test_find_setup_problems():
+    assert qdisc_util.find_setup_problems(expected_description()) == []
+    # Older kernels get a fifo instead of a plug
+    assert qdisc_util.find_setup_problems(expected_description('pfifo')) == []
+
+    description = expected_description('noqueue')
+    description['filters'] = description['filters'][1:]
+    description['qdiscs'] = [q for q in description['qdiscs'] if q['handle'] != '10:']
+    assert qdisc_util.find_setup_problems(description) == [
+        'qdisc 10: is missing',
+        'qdisc 40: is noqueue under 1:4, expected plug/pfifo under 1:4',
+        "filter ('fw', 1, '1:4') is missing",
+    ]
+
+    # Setups from before service priorities have no filters for their bands
+    description = expected_description()
+    description['filters'] = description['filters'][:1]
+    assert qdisc_util.find_setup_problems(description) == [
+        "filter ('fw', 2, '1:1') is missing",
+        "filter ('fw', 4, '1:3') is missing",
+    ]
+
+
+def test_check_setup():
+    syn_rule = qdisc_util.desired_iptables_rules(qdisc_util.syn_mark_rule_manager(), '1.2.3.4')[0]
+    current_rules = mock.patch.object(qdisc_util.RuleManager, 'current_rules')
+    with mock.patch.object(qdisc_util, 'describe_setup', return_value=expected_description()):
+        with current_rules as mock_current_rules:
+            mock_current_rules.return_value = [syn_rule]
+            assert qdisc_util.check_setup('lo') == 0
+            mock_current_rules.return_value = []
+            assert qdisc_util.check_setup('lo') == 2
+            mock_current_rules.side_effect = OSError('no iptables-save')
+            assert qdisc_util.check_setup('lo') == 2
+
+    no_setup = {'qdiscs': [{'handle': '0:', 'parent': 'root', 'kind': 'noqueue'}], 'filters': []}
+    with mock.patch.object(qdisc_util, 'describe_setup', return_value=no_setup):
+        with mock.patch.object(qdisc_util.RuleManager, 'current_rules', return_value=[]):
+            assert qdisc_util.check_setup('lo') == 1
+
+
+def test_check_setup_reports_priority_map_drift(tmpdir):
+    priority_map = tmpdir.join('priority_ports.json')
+    priority_map.write('{"10000": "fastest"}')
+    manager = qdisc_util.syn_mark_rule_manager('1.2.3.4')
+    syn_rule = qdisc_util.desired_iptables_rules(manager, '1.2.3.4')[0]
+    with contextlib.nested(
+        mock.patch.object(qdisc_util, 'describe_setup', return_value=expected_description()),
+        mock.patch.object(qdisc_util.RuleManager, 'current_rules', return_value=[syn_rule]),
+    ) as (_, mock_current_rules):
+        # Without a source_ip, as setup checks, only the SYN mark matters
+        assert qdisc_util.check_setup('lo') == 0
+        mock_current_rules.reset_mock()
+        assert qdisc_util.check_setup('lo', '1.2.3.4', str(priority_map)) == 2
+        # The rules are read once for both the mark and the drift checks
+        assert mock_current_rules.call_count == 1
+        assert qdisc_util.needs_setup('lo', '1.2.3.4', str(priority_map)) == 0
+
+        priority_map.write('{}')
+        assert qdisc_util.check_setup('lo', '1.2.3.4', str(priority_map)) == 0
+
+
+def test_desired_iptables_rules_replace_legacy_rule():
+    manager = qdisc_util.syn_mark_rule_manager('1.2.3.4')
+    (legacy_rule,) = manager.legacy_rules
+    desired = qdisc_util.desired_iptables_rules(manager, '1.2.3.4')
+
+    assert desired == [
+        '-A OUTPUT -s 1.2.3.4/32 -p tcp -m tcp --tcp-flags FIN,SYN,RST,ACK SYN '
+        '-m comment --comment synapse_qdisc_tool -j MARK --set-xmark 0x1/0xffffffff',
+    ]
+    assert manager.plan([legacy_rule], desired) == ([legacy_rule], desired)
+
+
+def test_priority_rules():
+    manager = qdisc_util.syn_mark_rule_manager()
+    port_priorities = dict((port, 'slow') for port in range(20000, 20016))
+    port_priorities[10000] = 'fastest'
+
+    rules = qdisc_util.priority_rules(manager, 'lo', port_priorities)
+
+    assert rules == [
+        manager.rule(
+            '-o lo -p tcp -m multiport --dports 10000 '
+            '-m tcp ! --tcp-flags FIN,SYN,RST,ACK SYN',
+            'MARK --set-xmark 0x2/0xffffffff'),
+        manager.rule(
+            '-o lo -p tcp -m multiport --sports 10000 '
+            '-m tcp ! --tcp-flags FIN,SYN,RST,ACK SYN',
+            'MARK --set-xmark 0x2/0xffffffff'),
+        manager.rule(
+            '-o lo -p tcp -m multiport --dports %s '
+            '-m tcp ! --tcp-flags FIN,SYN,RST,ACK SYN' % ','.join(
+                str(port) for port in range(20000, 20015)),
+            'MARK --set-xmark 0x4/0xffffffff'),
+        manager.rule(
+            '-o lo -p tcp -m multiport --sports %s '
+            '-m tcp ! --tcp-flags FIN,SYN,RST,ACK SYN' % ','.join(
+                str(port) for port in range(20000, 20015)),
+            'MARK --set-xmark 0x4/0xffffffff'),
+        manager.rule(
+            '-o lo -p tcp -m multiport --dports 20015 '
+            '-m tcp ! --tcp-flags FIN,SYN,RST,ACK SYN',
+            'MARK --set-xmark 0x4/0xffffffff'),
+        manager.rule(
+            '-o lo -p tcp -m multiport --sports 20015 '
+            '-m tcp ! --tcp-flags FIN,SYN,RST,ACK SYN',
+            'MARK --set-xmark 0x4/0xffffffff'),
+    ]
+
+
+def test_setup_syncs_iptables_rules_when_qdiscs_exist(tmpdir):
+    priority_map = tmpdir.join('priority_ports.json')
+    priority_map.write('{"10000": "fastest"}')
+    with contextlib.nested(
+        mock.patch.object(qdisc_util, 'check_setup', return_value=0),
+        mock.patch.object(qdisc_util, '_apply_tc_rules'),
+        mock.patch.object(qdisc_util.RuleManager, 'sync'),
+    ) as (_, mock_apply_tc_rules, mock_sync):
+        assert qdisc_util.setup('lo', '1.2.3.4', str(priority_map)) == 0
+
+    assert not mock_apply_tc_rules.called
+    (desired,) = mock_sync.call_args[0]
+    assert len(desired) == 3
+    assert desired[1].endswith('-j MARK --set-xmark 0x2/0xffffffff')
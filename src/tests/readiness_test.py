@@ -0,0 +1,89 @@
+import os
+import socket
+import threading
+
+import pytest
+
+from synapse_tools.haproxy import readiness
+
+
+def write_config(tmpdir, ports, stats_sockets=()):
+    config = tmpdir.join('haproxy.cfg')
+    config.write(
+        'global\n\tdaemon\n' +
+        ''.join('\tstats socket %s level admin\n' % path for path in stats_sockets) +
+        '\nlisten stats\n\tbind :%d\n\tmode http\n' % ports[0] +
+        ''.join('\nfrontend s%d\n\tbind 0.0.0.0:%d\n\tdefault_backend s%d\n' % (p, p, p)
+                for p in ports[1:])
+    )
+    return str(config)
+
+
+def test_parse_bind_ports(tmpdir):
+    assert readiness.parse_bind_ports(write_config(tmpdir, [3212, 1234, 1235])) == set([3212, 1234, 1235])
+
+
+def test_parse_stats_sockets(tmpdir):
+    config_path = write_config(tmpdir, [3212], ['/run/haproxy.sock', '/run/haproxy.sock.2'])
+    assert readiness.parse_stats_sockets(config_path) == set(['/run/haproxy.sock', '/run/haproxy.sock.2'])
+
+
+@pytest.yield_fixture
+def stats_socket(tmpdir):
+    """A fake stats socket, answering show info with the pid in its pid
+    list, or not at all if the list is empty"""
+    path = str(tmpdir.join('haproxy.sock'))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(5)
+    answering_pid = []
+
+    def serve():
+        while True:
+            try:
+                (conn, _) = server.accept()
+            except socket.error:
+                return
+            assert conn.recv(1024) == 'show info\n'
+            if answering_pid:
+                conn.sendall('Name: HAProxy\nPid: %d\nProcess_num: 1\n' % answering_pid[0])
+            conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    yield (path, answering_pid)
+    server.shutdown(socket.SHUT_RDWR)
+    server.close()
+
+
+def test_wait_until_stats_socket_answers(tmpdir, stats_socket):
+    (path, answering_pid) = stats_socket
+    pid_file = tmpdir.join('haproxy.pid')
+    pid_file.write('%d\n' % os.getpid())
+    # Ports are not checked when there is a stats socket
+    config_path = write_config(tmpdir, [1], [path])
+
+    assert not readiness.wait_until_listening(str(pid_file), config_path, timeout_s=0.01)
+    # The old haproxy is still answering
+    answering_pid.append(os.getpid() + 1)
+    assert not readiness.wait_until_listening(str(pid_file), config_path, timeout_s=0.01)
+    answering_pid[0] = os.getpid()
+    assert readiness.wait_until_listening(str(pid_file), config_path, timeout_s=0.01)
+
+
+def test_wait_until_listening(tmpdir):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    pid_file = tmpdir.join('haproxy.pid')
+    pid_file.write('%d\n' % os.getpid())
+    config_path = write_config(tmpdir, [port])
+
+    try:
+        # Bound but not yet listening
+        assert not readiness.wait_until_listening(str(pid_file), config_path, timeout_s=0.01)
+        listener.listen(1)
+        assert readiness.wait_until_listening(str(pid_file), config_path, timeout_s=0.01)
+    finally:
+        listener.close()
@@ -0,0 +1,30 @@
+import os
+
+import mock
+
+from synapse_tools.resolution_cache import ResolutionCache
+
+
+def test_value_is_reused_until_file_changes(tmpdir):
+    path = tmpdir.join('habitat')
+    path.write('uswest1aprod')
+    loader = mock.Mock(side_effect=['first', 'second'])
+    cache = ResolutionCache()
+
+    assert cache.get('habitat', [str(path)], loader) == 'first'
+    assert cache.get('habitat', [str(path)], loader) == 'first'
+    assert loader.call_count == 1
+
+    path.write('uswest1bprod')
+    os.utime(str(path), (0, 0))
+    assert cache.get('habitat', [str(path)], loader) == 'second'
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_value_from_missing_file_is_not_cached(tmpdir):
+    loader = mock.Mock(side_effect=['first', 'second'])
+    cache = ResolutionCache()
+    path = str(tmpdir.join('missing'))
+
+    assert cache.get('habitat', [path], loader) == 'first'
+    assert cache.get('habitat', [path], loader) == 'second'
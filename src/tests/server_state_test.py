@@ -0,0 +1,48 @@
+import socket
+import threading
+
+from synapse_tools.haproxy import server_state
+
+
+STATE = '1\n# be_id be_name srv_id srv_name srv_addr srv_op_state\n3 foo.main 1 10.1.0.1:31000_foo.main 10.1.0.1 2\n'
+
+
+def serve_once(socket_path, response):
+    """Answer a single stats socket command, and return the commands
+    received."""
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(1)
+    received = []
+
+    def handle():
+        (conn, _) = listener.accept()
+        received.append(conn.recv(1024))
+        conn.sendall(response)
+        conn.close()
+        listener.close()
+
+    thread = threading.Thread(target=handle)
+    thread.start()
+    return (thread, received)
+
+
+def test_dump_server_state(tmpdir):
+    socket_path = str(tmpdir.join('haproxy.sock'))
+    state_file = tmpdir.join('haproxy.state')
+    (thread, received) = serve_once(socket_path, STATE)
+
+    assert server_state.dump_server_state(socket_path, str(state_file))
+    thread.join()
+
+    assert received == ['show servers state\n']
+    assert state_file.read() == STATE
+
+
+def test_dump_server_state_removes_stale_state(tmpdir):
+    state_file = tmpdir.join('haproxy.state')
+    state_file.write(STATE)
+
+    assert not server_state.dump_server_state(
+        str(tmpdir.join('missing.sock')), str(state_file))
+    assert not state_file.check()
@@ -0,0 +1,40 @@
+import pytest
+
+from synapse_tools import sharding
+
+
+def test_shard_for_service_is_stable_and_in_range():
+    shards = [sharding.shard_for_service('service_%d.main' % i, 4) for i in range(100)]
+    assert set(shards) == set([0, 1, 2, 3])
+    assert shards == [sharding.shard_for_service('service_%d.main' % i, 4) for i in range(100)]
+
+
+def test_get_shard_count():
+    assert sharding.get_shard_count({}) == 1
+    assert sharding.get_shard_count({'shards': 3}) == 3
+    for shards in (0, -1, 1.5, '2', True, None):
+        with pytest.raises(ValueError):
+            sharding.get_shard_count({'shards': shards})
+
+
+def test_shard_for_service_pins():
+    pins = {'pinned.main': 3, 'whole_service': 2}
+    assert sharding.shard_for_service('pinned.main', 4, pins) == 3
+    assert sharding.shard_for_service('whole_service.main', 4, pins) == 2
+    assert sharding.shard_for_service('whole_service.canary', 4, pins) == 2
+    with pytest.raises(ValueError):
+        sharding.shard_for_service('pinned.main', 2, pins)
+
+
+def test_partition_services():
+    services = [('service_%d.main' % i, {}) for i in range(20)]
+    partitions = sharding.partition_services(services, 3, {'service_0.main': 1})
+    assert len(partitions) == 3
+    assert sorted(sum(partitions, [])) == sorted(services)
+    assert ('service_0.main', {}) in partitions[1]
+
+
+def test_shard_path():
+    assert sharding.shard_path('/var/run/synapse/haproxy.cfg', None) == '/var/run/synapse/haproxy.cfg'
+    assert sharding.shard_path('/var/run/synapse/haproxy.cfg', 2) == '/var/run/synapse/haproxy-2.cfg'
+    assert sharding.shard_path('/etc/synapse/synapse.conf.json', 0) == '/etc/synapse/synapse-0.conf.json'
@@ -0,0 +1,40 @@
+import copy
+
+from synapse_tools import shared_options
+
+
+def make_entry(frontend, listen, backend=()):
+    return {'haproxy': {'frontend': list(frontend), 'listen': list(listen), 'backend': list(backend)}}
+
+
+def test_find_common_options_only_returns_hoistable_options_set_everywhere():
+    services = {
+        'a.main': make_entry(
+            ['capture request header X-B3-Flags len 10', 'option httplog'],
+            ['option httpchk GET /a', 'http-check send-state', 'retries 2']),
+        'b.main': make_entry(
+            ['capture request header X-B3-Flags len 10', 'option httplog'],
+            ['option httpchk GET /b', 'http-check send-state']),
+    }
+    assert shared_options.find_common_options(services) == [
+        'option httplog', 'http-check send-state']
+    assert shared_options.find_common_options({}) == []
+
+
+def test_hoist_common_options_does_not_modify_entries():
+    services = {
+        'a.main': make_entry(['option httplog'], ['http-check send-state'], ['reqadd X']),
+        'b.main': make_entry(['option httplog'], ['http-check send-state', 'retries 2']),
+    }
+    synapse_config = {'haproxy': {'defaults': ['mode http']}, 'services': services}
+    original = copy.deepcopy(synapse_config)
+
+    hoisted = shared_options.hoist_common_options(synapse_config)
+
+    assert synapse_config == original
+    assert hoisted['haproxy']['defaults'] == [
+        'mode http', '# common to every service', 'option httplog', 'http-check send-state']
+    assert hoisted['services'] == {
+        'a.main': make_entry([], [], ['reqadd X']),
+        'b.main': make_entry([], ['retries 2']),
+    }
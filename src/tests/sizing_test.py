@@ -0,0 +1,50 @@
+import mock
+
+from synapse_tools import configure_synapse
+from synapse_tools import sizing
+
+
+MB = 1024 * 1024
+
+
+def test_get_memory_budget_bytes():
+    assert sizing.get_memory_budget_bytes({}) is None
+    assert sizing.get_memory_budget_bytes({'haproxy.memory_budget_mb': 512}) == 512 * MB
+    with mock.patch.object(sizing, 'get_host_memory_bytes', return_value=8192 * MB):
+        assert sizing.get_memory_budget_bytes(
+            {'haproxy.memory_budget_fraction': 0.25}) == 2048 * MB
+
+
+def test_compute_sizing_large_budget():
+    (maxconn, frontend_maxconn, comments) = sizing.compute_sizing(4096 * MB, 1000)
+    assert (maxconn, frontend_maxconn) == (63550, 635)
+    assert all(comment.startswith('# sizing: ') for comment in comments)
+
+
+def test_compute_sizing_splits_budget_between_processes():
+    (maxconn, frontend_maxconn, _) = sizing.compute_sizing(4096 * MB, 1000, processes=4)
+    assert (maxconn, frontend_maxconn) == (15887, 158)
+
+
+def test_compute_sizing_small_budget_lowers_maxconn_not_bufsize():
+    (maxconn, frontend_maxconn, comments) = sizing.compute_sizing(64 * MB, 10)
+    assert (maxconn, frontend_maxconn) == (992, 992)
+    assert '2 x 32768 byte buffers' in comments[1]
+
+
+def test_compute_sizing_clamps():
+    assert sizing.compute_sizing(MB, 0)[:2] == (100, 100)
+    assert sizing.compute_sizing(1024 * 1024 * MB, 1)[:2] == (100000, 100000)
+
+
+def test_generate_configuration_with_memory_budget():
+    synapse_config = configure_synapse.generate_configuration(
+        {'bind_addr': '0.0.0.0', 'haproxy.memory_budget_mb': 4096},
+        ['1.2.3.4'],
+        [('service_%d.main' % i, {}) for i in range(1000)],
+    )
+    haproxy = synapse_config['haproxy']
+    assert 'maxconn 63550' in haproxy['global']
+    assert 'tune.bufsize 32768' in haproxy['global']
+    # Services without a proxy_port are not counted
+    assert haproxy['defaults'][-1] == 'maxconn 63550'
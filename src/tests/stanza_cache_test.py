@@ -0,0 +1,108 @@
+import json
+import os
+
+from synapse_tools import stanza_cache
+
+
+def test_hash_inputs_is_order_independent_for_dicts():
+    assert (stanza_cache.hash_inputs({'a': 1, 'b': 2}) ==
+            stanza_cache.hash_inputs({'b': 2, 'a': 1}))
+    assert stanza_cache.hash_inputs({'a': 1}) != stanza_cache.hash_inputs({'a': 2})
+
+
+def test_get_counts_hits_and_misses():
+    cache = stanza_cache.StanzaCache()
+    assert cache.get('foo.main', 'key') is None
+    cache.put('foo.main', 'key', {'haproxy': {}})
+    assert cache.get('foo.main', 'key') == {'haproxy': {}}
+    assert cache.get('foo.main', 'other_key') is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_save_and_load_round_trip(tmpdir):
+    path = str(tmpdir.join('stanza_cache.json'))
+    cache = stanza_cache.StanzaCache()
+    cache.put('foo.main', 'key', {'haproxy': {'port': '1234'}})
+    cache.save(path)
+
+    loaded = stanza_cache.StanzaCache.load(path)
+    assert loaded.get('foo.main', 'key') == {'haproxy': {'port': '1234'}}
+    assert os.listdir(str(tmpdir)) == ['stanza_cache.json']
+
+
+def test_save_drops_services_not_seen(tmpdir):
+    path = str(tmpdir.join('stanza_cache.json'))
+    cache = stanza_cache.StanzaCache({
+        'gone.main': {'key': 'key', 'stanza': {}},
+        'kept.main': {'key': 'key', 'stanza': {}},
+    })
+    cache.get('kept.main', 'key')
+    cache.save(path)
+
+    with open(path) as fp:
+        assert json.load(fp)['entries'].keys() == ['kept.main']
+
+
+def test_load_missing_or_stale_cache(tmpdir):
+    assert stanza_cache.StanzaCache.load(str(tmpdir.join('missing'))).entries == {}
+
+    path = tmpdir.join('stanza_cache.json')
+    path.write(json.dumps({'version': -1, 'entries': {'foo.main': {}}}))
+    assert stanza_cache.StanzaCache.load(str(path)).entries == {}
+
+
+def test_cached_stanzas_are_copies():
+    cache = stanza_cache.StanzaCache()
+    stanza = {'haproxy': {'frontend': ['option httplog']}}
+    cache.put('foo.main', 'key', stanza)
+    stanza['haproxy']['frontend'].append('put-mutation')
+
+    hit = cache.get('foo.main', 'key')
+    hit['haproxy']['frontend'].append('get-mutation')
+
+    assert cache.get('foo.main', 'key') == {'haproxy': {'frontend': ['option httplog']}}
+
+
+def test_file_cache_round_trip(tmpdir):
+    path = str(tmpdir.join('stanza_cache.jsonl'))
+    cache = stanza_cache.StanzaFileCache.load(path)
+    assert cache.get('foo.main', 'key') is None
+    cache.put('foo.main', 'key', {'haproxy': {'port': '1234'}})
+    cache.put('gone.main', 'key', {})
+    cache.save(path)
+
+    # Later lookups are served from the saved file
+    assert cache.get('foo.main', 'key') == {'haproxy': {'port': '1234'}}
+    cache.save(path)
+    assert os.listdir(str(tmpdir)) == ['stanza_cache.jsonl']
+
+    loaded = stanza_cache.StanzaFileCache.load(path)
+    assert loaded.get('gone.main', 'key') is None
+    assert loaded.get('foo.main', 'other_key') is None
+    assert loaded.get('foo.main', 'key') == {'haproxy': {'port': '1234'}}
+    assert (loaded.hits, loaded.misses) == (1, 2)
+    loaded.close()
+
+
+def test_file_cache_keeps_only_offsets_in_memory(tmpdir):
+    path = str(tmpdir.join('stanza_cache.jsonl'))
+    cache = stanza_cache.StanzaFileCache.load(path)
+    cache.put('foo.main', 'key', {'haproxy': {'frontend': ['option httplog']}})
+    cache.save(path)
+
+    loaded = stanza_cache.StanzaFileCache.load(path)
+    assert 'option httplog' not in repr(vars(loaded))
+    loaded.close()
+
+
+def test_file_cache_load_missing_or_stale(tmpdir):
+    assert stanza_cache.StanzaFileCache.load(
+        str(tmpdir.join('missing'))).get('foo.main', 'key') is None
+
+    path = tmpdir.join('stanza_cache.jsonl')
+    path.write(json.dumps({'version': -1}) + '\n' +
+               json.dumps(['foo.main', 'key', {}]) + '\n')
+    assert stanza_cache.StanzaFileCache.load(str(path)).get('foo.main', 'key') is None
+
+    path.write('not json\n')
+    assert stanza_cache.StanzaFileCache.load(str(path)).get('foo.main', 'key') is None
@@ -0,0 +1,40 @@
+import json
+
+import mock
+
+from synapse_tools import timing
+
+
+def test_phase_timer():
+    timer = timing.PhaseTimer()
+    with mock.patch.object(timing.time, 'time', side_effect=[10.0, 10.5, 11.0, 13.0]):
+        with timer.phase('get_config'):
+            pass
+        with timer.phase('generate_configuration'):
+            pass
+    timer.record_service('fast.main', 0.001)
+    timer.record_service('slow.main', 0.1)
+
+    assert timer.as_dict() == {
+        'phases_s': {'get_config': 0.5, 'generate_configuration': 2.0},
+        'total_s': 2.5,
+        'services': 2,
+        'slowest_services_s': [('slow.main', 0.1), ('fast.main', 0.001)],
+    }
+    assert timer.slowest_services(1) == [('slow.main', 0.1)]
+
+
+def test_repeated_phases_are_summed():
+    timer = timing.PhaseTimer()
+    with mock.patch.object(timing.time, 'time', side_effect=[0.0, 1.0, 1.0, 3.0]):
+        for _ in range(2):
+            with timer.phase('publish'):
+                pass
+    assert timer.phase_totals() == {'publish': 3.0}
+
+
+def test_emit_logs_a_json_line():
+    timer = timing.PhaseTimer()
+    with mock.patch.object(timing, 'log') as mock_log:
+        timer.emit()
+    assert json.loads(mock_log.info.call_args[0][0])['total_s'] == 0
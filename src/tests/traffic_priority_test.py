@@ -0,0 +1,57 @@
+import json
+
+import mock
+
+from synapse_tools import traffic_priority
+
+
+def test_validate_priorities():
+    # There is no fast: best effort traffic already gets the middle band
+    b_service = {'proxy_port': 1235, 'priority': 'fast'}
+    services = [
+        ('a_service.main', {'proxy_port': 1234, 'priority': 'fastest'}),
+        ('b_service.main', b_service),
+    ]
+    with mock.patch.object(traffic_priority, 'log') as mock_log:
+        assert traffic_priority.validate_priorities(services) == [
+            ('a_service.main', {'proxy_port': 1234, 'priority': 'fastest'}),
+            ('b_service.main', {'proxy_port': 1235}),
+        ]
+    assert mock_log.warn.call_count == 1
+    assert b_service['priority'] == 'fast'
+
+
+def test_port_priorities():
+    services = [
+        ('a_service.main', {'proxy_port': 1234, 'priority': 'fastest'}),
+        ('c_service.main', {'proxy_port': 1236}),
+        ('d_service.main', {'priority': 'slow'}),
+        ('e_service.main', {'proxy_port': 1237, 'priority': 'slow'}),
+    ]
+    assert traffic_priority.port_priorities(services) == {
+        1234: 'fastest', 1237: 'slow',
+    }
+
+
+def test_update_priority_map(tmpdir):
+    path = str(tmpdir.join('priority_ports.json'))
+
+    # Nothing is written until a service has a priority
+    assert not traffic_priority.update_priority_map({}, path)
+    assert not tmpdir.join('priority_ports.json').check()
+
+    assert traffic_priority.update_priority_map({1234: 'slow'}, path)
+    assert json.loads(tmpdir.join('priority_ports.json').read()) == {'1234': 'slow'}
+    assert traffic_priority.read_priority_map(path) == {1234: 'slow'}
+    assert not traffic_priority.update_priority_map({1234: 'slow'}, path)
+
+    # Once written, removing every priority empties it
+    assert traffic_priority.update_priority_map({}, path)
+    assert traffic_priority.read_priority_map(path) == {}
+
+
+def test_read_priority_map_missing_or_corrupt(tmpdir):
+    path = tmpdir.join('priority_ports.json')
+    assert traffic_priority.read_priority_map(str(path)) == {}
+    path.write('{"12')
+    assert traffic_priority.read_priority_map(str(path)) == {}